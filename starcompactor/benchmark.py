@@ -0,0 +1,189 @@
+# coding: utf-8
+"""Benchmarks for the trace extraction stages.
+
+Each benchmark runs the current implementation of a stage next to a reference
+implementation on the same input and reports the best of a few runs.
+
+    python -m starcompactor.benchmark audit-decode data/chi_tacc/openstack_audit.audit_nova_instances.parquet
+    python -m starcompactor.benchmark refine
+    python -m starcompactor.benchmark backup --instance-type baremetal backups/*.sql.bz2
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import time
+
+import pandas as pd
+
+from . import machine_event_dump
+from .extractors import audit, machine
+from .extractors.event_table import EVENTS, MachineEventTable
+
+LOG = logging.getLogger(__name__)
+
+
+def _best_of(repeat, func, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _decode_audit_rowwise(path):
+    """Per-row reference decoder: one json.loads per audit row."""
+    df = pd.read_parquet(path)
+    rows = []
+    for _, row in df.iterrows():
+        payload = json.loads(row['data'])
+        payload['audit_event_type'] = row['audit_event_type']
+        payload['audit_changed_at'] = row['audit_changed_at']
+        rows.append(payload)
+    return pd.DataFrame(rows)
+
+
+def bench_audit_decode(args):
+    for path in args.files:
+        t_rowwise, df_rowwise = _best_of(args.repeat, _decode_audit_rowwise, path)
+        t_columnar, df_columnar = _best_of(args.repeat, audit.read_audit_parquet, path)
+        if len(df_rowwise) != len(df_columnar) or set(df_rowwise.columns) != set(df_columnar.columns):
+            LOG.warning('{}: decoders disagree ({} vs {})'.format(path, df_rowwise.shape, df_columnar.shape))
+        print('{}: {} rows, {} columns'.format(path, len(df_columnar), len(df_columnar.columns)))
+        print('  row-wise  {:8.3f}s'.format(t_rowwise))
+        print('  columnar  {:8.3f}s  ({:.1f}x)'.format(t_columnar, t_rowwise / t_columnar if t_columnar else float('inf')))
+
+
+def _random_machine_events(rng, n_events, n_hosts):
+    """Random machine events with many duplicate times and property sets,
+    including equal property dicts with different key order."""
+    property_sets = [{}, {'rack': 'r1', 'vcpu': 48}, {'vcpu': 48, 'rack': 'r1'}, {'rack': 'r1', 'vcpu': 40},
+                     {'rack': 'r2', 'vcpu': 40}]
+    start = datetime.datetime(2016, 1, 1)
+    events = {}
+    for _ in range(n_events):
+        key = (start + datetime.timedelta(days=rng.randrange(n_events // n_hosts + 1)),
+               'host{}'.format(rng.randrange(n_hosts)), rng.choice(EVENTS))
+        events[key] = dict(rng.choice(property_sets))
+    return events
+
+
+def bench_refine(args):
+    rng = random.Random(args.seed)
+    t_sequential = t_vectorized = 0.0
+    for case in range(args.cases):
+        events = _random_machine_events(rng, rng.randrange(1, args.events), rng.randrange(1, 20))
+        start = time.perf_counter()
+        expected = machine_event_dump.refine_machine_events_sequential(dict(events))
+        t_sequential += time.perf_counter() - start
+        table = MachineEventTable(events)
+        start = time.perf_counter()
+        refined = machine_event_dump.refine_machine_events(table)
+        t_vectorized += time.perf_counter() - start
+        if list(expected.items()) != list(refined.items()):
+            LOG.warning('case {}: refinements disagree ({} vs {} events)'.format(case, len(expected), len(refined)))
+    print('{} random cases of up to {} events'.format(args.cases, args.events))
+    print('  sequential  {:8.3f}s'.format(t_sequential))
+    print('  vectorized  {:8.3f}s  ({:.1f}x)'.format(
+        t_vectorized, t_sequential / t_vectorized if t_vectorized else float('inf')))
+
+
+def _read_backup(open_backup, path):
+    h = hashlib.sha1()
+    with open_backup(path) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def bench_bz2(args):
+    commands = [command.split() for command in args.command] or [
+        command for command in machine.PARALLEL_BZ2_COMMANDS if shutil.which(command[0])]
+    if not commands:
+        LOG.warning('none of {} is installed; only timing the in-process reader'.format(
+            ', '.join(command[0] for command in machine.PARALLEL_BZ2_COMMANDS)))
+    for path in args.files:
+        size = os.path.getsize(path)
+        t_bz2, digest = _best_of(args.repeat, _read_backup, lambda p: machine.open_by_suffix(p, parallel=False), path)
+        print('{}: {:.1f} MB compressed'.format(path, size / 1e6))
+        print('  {:<20} {:8.3f}s'.format('bz2.BZ2File', t_bz2))
+        for command in commands:
+            t_pipe, pipe_digest = _best_of(
+                args.repeat, _read_backup, lambda p: machine.DecompressorPipe(command, p), path)
+            if pipe_digest != digest:
+                LOG.warning('{}: {} output differs from bz2.BZ2File'.format(path, ' '.join(command)))
+            print('  {:<20} {:8.3f}s  ({:.1f}x)'.format(
+                ' '.join(command), t_pipe, t_bz2 / t_pipe if t_pipe else float('inf')))
+
+
+def _extract_backup(backend, instance_type, path):
+    # time the extraction itself, not the reuse of an unchanged previous backup
+    machine._previous_backup.clear()
+    result = machine._get_machine_event(path, None, instance_type, backend, 'python')
+    return list(result['machine_events'].items()) if result else None
+
+
+def bench_backup(args):
+    backends = args.backend or ['python', 'sqlite']
+    for path in args.files:
+        print('{}: {:.1f} MB'.format(path, os.path.getsize(path) / 1e6))
+        reference = None
+        for backend in backends:
+            t_backend, events = _best_of(args.repeat, _extract_backup, backend, args.instance_type, path)
+            if reference is None:
+                reference = events
+            elif events != reference:
+                LOG.warning('{}: {} backend events differ from the {} backend'.format(path, backend, backends[0]))
+            print('  {:<10} {:8.3f}s  {} events'.format(backend, t_backend, len(events or [])))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Number of runs per implementation; the best time is reported.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    audit_decode = subparsers.add_parser('audit-decode',
+        help='Decode audit parquet JSON payloads row by row vs in bulk.')
+    audit_decode.add_argument('files', nargs='+', help='openstack_audit parquet files')
+    audit_decode.set_defaults(func=bench_audit_decode)
+
+    refine = subparsers.add_parser('refine',
+        help='Refine random machine events sequentially vs vectorized; also checks they agree.')
+    refine.add_argument('--cases', type=int, default=200, help='number of random event sets')
+    refine.add_argument('--events', type=int, default=2000, help='maximum number of events per set')
+    refine.add_argument('--seed', type=int, default=0)
+    refine.set_defaults(func=bench_refine)
+
+    bz2_parser = subparsers.add_parser('bz2',
+        help='Decompress .bz2 backups with bz2.BZ2File vs a block-parallel decompressor; also checks they agree.')
+    bz2_parser.add_argument('--command', action='append', default=[],
+        help='decompressor command line to compare, e.g. "lbzip2 -d -c -n 8" (defaulting to the installed ones of {})'.format(
+            ', '.join(command[0] for command in machine.PARALLEL_BZ2_COMMANDS)))
+    bz2_parser.add_argument('files', nargs='+', help='.bz2 backup files')
+    bz2_parser.set_defaults(func=bench_bz2)
+
+    backup = subparsers.add_parser('backup',
+        help='Extract machine events from mysqldump backups with each backend; also checks they agree.')
+    backup.add_argument('--instance-type', type=str, default='vm', choices=['vm', 'baremetal'],
+        help='instance type of the events (defaulting to "%(default)s")')
+    backup.add_argument('--backend', action='append', choices=machine.BACKUP_BACKENDS,
+        help='backend to time, repeatable (defaulting to python and sqlite, which need no MySQL server)')
+    backup.add_argument('files', nargs='+', help='mysqldump backup files (.sql, .sql.gz or .sql.bz2)')
+    backup.set_defaults(func=bench_backup)
+
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,312 @@
+# coding: utf-8
+"""Readers for openstack_audit parquet files.
+
+Each audit row wraps the original database row as a JSON string in a 'data'
+column, next to the 'audit_event_type' and 'audit_changed_at' columns of the
+audit record itself.  Rather than calling json.loads once per row, the whole
+'data' column is handed to Arrow's JSON reader as newline-delimited JSON, which
+decodes it into typed columns in one pass.
+
+If an audit cache directory is configured, each file is decoded once and
+later reads scan the decoded copy instead (see audit_cache).
+"""
+import configparser
+import json
+import logging
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.json as pa_json
+from dateutil.parser import parse as dateparse
+
+from . import audit_cache
+
+LOG = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('starcompactor.config')
+
+AUDIT_COLUMNS = ['audit_event_type', 'audit_changed_at']
+
+# Arrow parses newline-delimited JSON in blocks; a single payload must fit in
+# one block, so keep this comfortably above the largest row we expect.
+JSON_BLOCK_SIZE = 8 << 20
+
+# Payloads decoded first to find the keys Arrow would read as timestamps.
+JSON_SAMPLE_ROWS = 1000
+
+# Rows per record batch when streaming an audit file.
+BATCH_SIZE = 100000
+
+AUDIT_CACHE_DIR = config.get('cache', 'audit_cache_dir', fallback='')
+AUDIT_CACHE_MAX_MB = config.get('cache', 'audit_cache_max_mb', fallback='')
+CACHE = audit_cache.AuditCache(
+    AUDIT_CACHE_DIR, int(AUDIT_CACHE_MAX_MB) << 20 if AUDIT_CACHE_MAX_MB else None) if AUDIT_CACHE_DIR else None
+
+
+def _json_lines(data):
+    """Join a column of JSON strings into one newline-delimited buffer."""
+    if isinstance(data, pa.ChunkedArray):
+        data = data.combine_chunks()
+    data = pc.fill_null(data.cast(pa.large_string()), '{}')
+    lists = pa.LargeListArray.from_arrays(pa.array([0, len(data)], pa.int64()), data)
+    return pc.binary_join(lists, pa.scalar('\n', pa.large_string()))[0].as_buffer()
+
+
+def _read_json(data, string_fields=()):
+    return pa_json.read_json(
+        pa.BufferReader(_json_lines(data)),
+        read_options=pa_json.ReadOptions(block_size=JSON_BLOCK_SIZE),
+        parse_options=pa_json.ParseOptions(
+            explicit_schema=pa.schema([(name, pa.string()) for name in string_fields]),
+            unexpected_field_behavior='infer'))
+
+
+def _timestamp_fields(table):
+    return [field.name for field in table.schema if pa.types.is_timestamp(field.type)]
+
+
+def _read_json_payloads(data):
+    """Decode JSON payloads with Arrow, keeping times as strings.
+
+    Arrow would read some time formats as timestamps, converting any UTC
+    offset, and leave the others as strings; the keys it would read as
+    timestamps (found on a sample first) are read as strings instead, so
+    that naive_datetimes converts every value the same way.
+    """
+    string_fields = _timestamp_fields(_read_json(data.slice(0, JSON_SAMPLE_ROWS)))
+    table = _read_json(data, string_fields)
+    missed = _timestamp_fields(table)
+    if missed:
+        # keys that only appear after the sample
+        table = _read_json(data, string_fields + missed)
+    return table
+
+
+def decode_payloads(data, columns=None):
+    """Decode a column of JSON payload strings into a DataFrame in bulk.
+
+    Parameters
+    ----------
+    data : pyarrow.Array or pyarrow.ChunkedArray
+        The 'data' column of an audit table.
+    columns : list of str or None
+        Payload keys to keep.  Other keys are dropped while still in Arrow
+        form, before the (much larger) pandas frame is built.  None keeps all.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per payload and one column per payload key; keys missing from
+        a payload are null.  Arrow infers column types, so numbers come back
+        numeric; times come back as strings, see naive_datetimes.
+    """
+    if len(data) == 0:
+        return pd.DataFrame()
+    try:
+        table = _read_json_payloads(data)
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.column_names])
+        return table.to_pandas()
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        # e.g. a key that is a number in one row and a string in another;
+        # Arrow refuses to guess, so fall back to a batched json.loads.
+        LOG.debug('Arrow JSON decode failed (%s), falling back to json.loads', e)
+    payloads = (json.loads(v) if v else {} for v in data.to_pylist())
+    if columns is not None:
+        payloads = ({k: p[k] for k in columns if k in p} for p in payloads)
+    return pd.DataFrame(list(payloads))
+
+
+def naive_datetime(val):
+    """Convert a payload value to a naive Python datetime, or None."""
+    if val is None:
+        return None
+    if isinstance(val, pd.Timestamp):
+        if pd.isnull(val):
+            return None
+        dt = val.to_pydatetime()
+    else:
+        try:
+            dt = dateparse(str(val))
+        except Exception:
+            return None
+    return dt.replace(tzinfo=None) if dt.tzinfo is not None else dt
+
+
+def naive_datetimes(values):
+    """Column-wise naive_datetime: a naive datetime64 Series, NaT where
+    naive_datetime gives None.  Time zones are dropped, not converted."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        parsed = values
+    else:
+        try:
+            parsed = pd.to_datetime(values, errors='coerce', format='ISO8601')
+        except (ValueError, TypeError):
+            # e.g. mixed UTC offsets, which pandas refuses to put in one column
+            parsed = pd.to_datetime(values.map(naive_datetime))
+    if parsed.dt.tz is not None:
+        parsed = parsed.dt.tz_localize(None)
+    # Anything ISO8601 parsing missed gets the same lenient dateparse as naive_datetime
+    missed = parsed.isna() & values.notna()
+    if missed.any():
+        parsed = parsed.astype(object)
+        parsed[missed] = values[missed].map(naive_datetime)
+        parsed = pd.to_datetime(parsed)
+    return parsed
+
+
+def _timestamp_scalar(value, timestamp_type):
+    """Convert a datetime to a scalar comparable with a timestamp column.
+
+    Naive datetimes are taken to be in the column's time zone, matching how
+    the extractors strip tzinfo from audit timestamps.
+    """
+    value = pd.Timestamp(value)
+    if timestamp_type.tz is None:
+        value = value.tz_localize(None)
+    elif value.tz is None:
+        value = value.tz_localize(timestamp_type.tz)
+    else:
+        value = value.tz_convert(timestamp_type.tz)
+    return pa.scalar(value.to_pydatetime(), type=timestamp_type)
+
+
+def audit_filter(schema, event_types=None, changed_after=None, changed_before=None, changed_since=None):
+    """Build a dataset filter expression on the audit columns, or None.
+
+    The expression is evaluated during the parquet scan, so row groups whose
+    statistics rule it out are skipped without being read or decoded.
+    *changed_after* and *changed_before* bound audit_changed_at inclusively
+    and *changed_since* exclusively; they are ignored if the column is not
+    stored as a timestamp.
+    """
+    conditions = []
+    if event_types is not None:
+        conditions.append(ds.field('audit_event_type').isin(list(event_types)))
+    if changed_after is not None or changed_before is not None or changed_since is not None:
+        changed_at = ds.field('audit_changed_at')
+        changed_at_type = schema.field('audit_changed_at').type
+        if not pa.types.is_timestamp(changed_at_type):
+            LOG.debug('audit_changed_at is %s, not pushing time bounds into the scan', changed_at_type)
+        else:
+            if changed_after is not None:
+                conditions.append(changed_at >= _timestamp_scalar(changed_after, changed_at_type))
+            if changed_before is not None:
+                conditions.append(changed_at <= _timestamp_scalar(changed_before, changed_at_type))
+            if changed_since is not None:
+                conditions.append(changed_at > _timestamp_scalar(changed_since, changed_at_type))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _decode_audit_table(table, columns=None):
+    """Decode the payloads of an audit Table or RecordBatch into a DataFrame."""
+    df = decode_payloads(table.column('data'), columns=columns)
+    for column in AUDIT_COLUMNS:
+        df[column] = table.column(column).to_pandas()
+    return df
+
+
+def _decode_audit_file(path):
+    """Decode every payload of an audit file into one Arrow table for the
+    cache, or return None if the payloads don't fit a typed table."""
+    table = ds.dataset(path, format='parquet').to_table(columns=['data'] + AUDIT_COLUMNS)
+    if table.num_rows == 0:
+        decoded = pa.table({})
+    else:
+        try:
+            decoded = _read_json_payloads(table.column('data'))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            try:
+                decoded = pa.Table.from_pandas(decode_payloads(table.column('data')), preserve_index=False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                LOG.info('Not caching %s: %s', path, e)
+                return None
+    for column in AUDIT_COLUMNS:
+        decoded = decoded.append_column(column, table.column(column))
+    return decoded
+
+
+def _open_dataset(path):
+    """Return the dataset to scan for *path* and whether its payloads are
+    already decoded, i.e. whether it comes from the audit cache."""
+    if CACHE is not None:
+        cached_path = CACHE.lookup(path, _decode_audit_file)
+        if cached_path is not None:
+            return ds.dataset(cached_path, format='parquet'), True
+    return ds.dataset(path, format='parquet'), False
+
+
+def _scan_columns(dataset, decoded, columns=None):
+    if not decoded:
+        return ['data'] + AUDIT_COLUMNS
+    payload_columns = [c for c in dataset.schema.names if c not in AUDIT_COLUMNS]
+    if columns is not None:
+        payload_columns = [c for c in columns if c in payload_columns]
+    return payload_columns + AUDIT_COLUMNS
+
+
+def read_audit_parquet(path, columns=None, event_types=None, changed_after=None, changed_before=None,
+                       changed_since=None):
+    """Read an audit parquet file and decode its JSON payloads in bulk.
+
+    Returns a DataFrame with one column per payload key (or only the keys
+    listed in *columns*) plus the audit_event_type and audit_changed_at
+    columns of the audit row.
+
+    Only audit rows whose audit_event_type is in *event_types* and whose
+    audit_changed_at lies within [*changed_after*, *changed_before*] and after
+    *changed_since* are read; see audit_filter.
+    """
+    dataset, decoded = _open_dataset(path)
+    table = dataset.to_table(
+        columns=_scan_columns(dataset, decoded, columns),
+        filter=audit_filter(dataset.schema, event_types, changed_after, changed_before, changed_since))
+    if decoded:
+        return table.to_pandas()
+    return _decode_audit_table(table, columns)
+
+
+def iter_audit_parquet(path, columns=None, batch_size=BATCH_SIZE, event_types=None, changed_after=None, changed_before=None,
+                       changed_since=None):
+    """Like read_audit_parquet, but yield one DataFrame per record batch of
+    at most *batch_size* rows, so the whole file is never held in memory.
+
+    Column types are inferred per batch, so a payload key that is null
+    throughout one batch may come back with another type than in the rest.
+    """
+    dataset, decoded = _open_dataset(path)
+    batches = dataset.to_batches(
+        columns=_scan_columns(dataset, decoded, columns),
+        filter=audit_filter(dataset.schema, event_types, changed_after, changed_before, changed_since),
+        batch_size=batch_size)
+    for batch in batches:
+        if batch.num_rows:
+            yield batch.to_pandas() if decoded else _decode_audit_table(batch, columns)
+
+
+def changed_at_range(path, event_types=None):
+    """Earliest and latest audit_changed_at among the rows of *path* whose
+    audit_event_type is in *event_types*, or (None, None) if there are none.
+
+    Only the audit columns are scanned; no payload is decoded.
+    """
+    dataset = ds.dataset(path, format='parquet')
+    changed_at_type = dataset.schema.field('audit_changed_at').type
+    if not pa.types.is_timestamp(changed_at_type):
+        raise ValueError('{}: audit_changed_at is {}, not a timestamp'.format(path, changed_at_type))
+    table = dataset.to_table(columns=['audit_changed_at'], filter=audit_filter(dataset.schema, event_types))
+    earliest, latest = pc.min_max(table.column('audit_changed_at')).values()
+    if not latest.is_valid:
+        return None, None
+    return pd.Timestamp(earliest.as_py()), pd.Timestamp(latest.as_py())
+
+
+def max_changed_at(path, event_types=None):
+    """Latest audit_changed_at, see changed_at_range."""
+    return changed_at_range(path, event_types)[1]
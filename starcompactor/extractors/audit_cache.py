@@ -0,0 +1,130 @@
+# coding: utf-8
+"""On-disk cache of decoded audit tables.
+
+Decoding the JSON payloads of an audit file is the expensive part of reading
+it, and the instance and machine dumps of a site (and every rerun after an
+rclone sync) decode the same files again.  The cache keeps each decoded file
+as a plain parquet table so later reads can scan it with column projection and
+filters, like the original file, without decoding anything.
+
+Layout of the cache directory::
+
+    index/<sha1 of source path>.json                   source path, size, mtime and sha256
+    tables/<sha256 of source>.v<TABLE_FORMAT>.parquet  decoded table
+
+A source whose size and mtime match its index entry is a hit without reading
+it.  Otherwise its content hash is computed, so a file that was merely touched
+(as rclone/rsync copies tend to be) still hits.  Tables are evicted least
+recently used first once their total size exceeds the limit.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import pyarrow.parquet as pq
+
+from ..util import atomic_write
+
+LOG = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# Part of the table names, so tables decoded differently by an older version
+# are missed (and evicted in time).  2: payload times are kept as strings.
+TABLE_FORMAT = 2
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AuditCache(object):
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_dir = os.path.join(directory, 'index')
+        self.tables_dir = os.path.join(directory, 'tables')
+
+    def _index_path(self, source):
+        key = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()
+        return os.path.join(self.index_dir, '{}.json'.format(key))
+
+    def _table_path(self, digest):
+        return os.path.join(self.tables_dir, '{}.v{}.parquet'.format(digest, TABLE_FORMAT))
+
+    def _read_index(self, source):
+        try:
+            with open(self._index_path(source)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_index(self, source, entry):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+        atomic_write(self._index_path(source), write)
+
+    def lookup(self, source, decode):
+        """Return the path of the decoded table for *source*.
+
+        On a miss, ``decode(source)`` is called to build a pyarrow Table,
+        which is stored before its path is returned.  If *decode* returns
+        None the file can't be cached and None is returned.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        os.makedirs(self.tables_dir, exist_ok=True)
+        st = os.stat(source)
+        entry = self._read_index(source)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            digest = entry['sha256']
+        else:
+            digest = file_sha256(source)
+        table_path = self._table_path(digest)
+
+        if os.path.exists(table_path):
+            LOG.debug('audit cache hit for %s', source)
+            os.utime(table_path)
+        else:
+            LOG.debug('audit cache miss for %s', source)
+            table = decode(source)
+            if table is None:
+                return None
+            atomic_write(table_path, lambda tmp_path: pq.write_table(table, tmp_path))
+            self.evict(keep=table_path)
+
+        if not entry or entry['sha256'] != digest or entry['mtime'] != st.st_mtime_ns:
+            self._write_index(source, {'path': os.path.abspath(source), 'size': st.st_size,
+                                       'mtime': st.st_mtime_ns, 'sha256': digest})
+        return table_path
+
+    def evict(self, keep=None):
+        """Remove least recently used tables until the cache fits max_bytes."""
+        if self.max_bytes is None:
+            return
+        tables = []
+        for name in os.listdir(self.tables_dir):
+            path = os.path.join(self.tables_dir, name)
+            if name.endswith('.parquet'):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                tables.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in tables)
+        for _, size, path in sorted(tables):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            LOG.debug('evicting %s from audit cache', path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
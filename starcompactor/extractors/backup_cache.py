@@ -0,0 +1,100 @@
+# coding: utf-8
+"""On-disk cache of the machine events extracted from daily backups.
+
+A backup never changes once written, yet every machine dump from backups
+extracts all of them again.  The cache keeps the result of each backup (its
+MachineEventTable and host set) as a gzipped pickle, so a nightly run only
+extracts the backups that arrived since.
+
+Layout of the cache directory::
+
+    index/<sha1 of backup path>.json              backup path, size, mtime and sha256
+    results/<sha256 of backup>-<settings>.pkl.gz  extracted result
+
+<settings> fingerprints everything besides the backup that the result
+depends on (instance type, backup backend and the extraction settings of
+starcompactor.config), so changing them never returns a stale result.  As in
+audit_cache, a backup whose size and mtime match its index entry is a hit
+without reading it, and a touched but unchanged backup still hits through its
+content hash.  The file_time of a result comes from the backup's current
+mtime, not from the cache.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from ..util import atomic_write
+from .audit_cache import file_sha256
+
+LOG = logging.getLogger(__name__)
+
+# bump when the cached results change shape
+CACHE_VERSION = 1
+
+
+def settings_fingerprint(settings):
+    encoded = json.dumps([CACHE_VERSION, settings], sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class BackupCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_dir = os.path.join(directory, 'index')
+        self.results_dir = os.path.join(directory, 'results')
+
+    def _index_path(self, backup_file):
+        key = hashlib.sha1(os.path.abspath(backup_file).encode('utf-8')).hexdigest()
+        return os.path.join(self.index_dir, '{}.json'.format(key))
+
+    def _result_path(self, digest, settings):
+        return os.path.join(self.results_dir, '{}-{}.pkl.gz'.format(digest, settings_fingerprint(settings)))
+
+    def _digest(self, backup_file, st):
+        try:
+            with open(self._index_path(backup_file)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            entry = None
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            return entry['sha256']
+        digest = file_sha256(backup_file)
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump({'path': os.path.abspath(backup_file), 'size': st.st_size,
+                           'mtime': st.st_mtime_ns, 'sha256': digest}, f)
+        atomic_write(self._index_path(backup_file), write)
+        return digest
+
+    def lookup(self, backup_file, settings, extract):
+        """The result of ``extract()`` for *backup_file* with *settings*,
+        from the cache if possible.  Empty results (failed extractions) are
+        not cached."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        os.makedirs(self.results_dir, exist_ok=True)
+        st = os.stat(backup_file)
+        result_path = self._result_path(self._digest(backup_file, st), settings)
+
+        if os.path.exists(result_path):
+            LOG.debug('backup cache hit for %s', backup_file)
+            try:
+                with gzip.open(result_path, 'rb') as f:
+                    machine_events, hosts = pickle.load(f)
+                return {'machine_events': machine_events, 'hosts': hosts,
+                        'file_time': datetime.datetime.fromtimestamp(st.st_mtime)}
+            except (IOError, OSError, EOFError, pickle.UnpicklingError) as e:
+                LOG.warning('ignoring unreadable backup cache entry %s: %s', result_path, e)
+
+        LOG.debug('backup cache miss for %s', backup_file)
+        result = extract()
+        if result and 'machine_events' in result:
+            def write(tmp_path):
+                with gzip.open(tmp_path, 'wb') as f:
+                    pickle.dump((result['machine_events'], result['hosts']), f, protocol=pickle.HIGHEST_PROTOCOL)
+            atomic_write(result_path, write)
+        return result
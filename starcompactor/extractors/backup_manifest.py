@@ -0,0 +1,153 @@
+# coding: utf-8
+"""Manifest of the daily backups in backup_dir.
+
+Ordering backups by mtime breaks as soon as they are copied around (rclone
+and rsync do not always keep mtimes), and listing and statting the whole
+directory tells nothing about what earlier runs found.  The manifest is a
+JSON file with an entry per backup file name::
+
+    {"version": 1,
+     "backups": {"mysql_backup_20170101-000000.sql.bz2": {
+         "time": "2017-01-01T00:00:00",
+         "size": 123456, "mtime": 1483228800000000000, "sha256": "...",
+         "extracted": {"vm": {"settings": "...", "status": "done", "hosts": [...],
+                              "created_hosts": [...]}}}}}
+
+The time of a backup is parsed from the groups of backup_file_regex (the
+date and time of ``mysql_backup_(\\d{8})-(\\d{6}).sql.bz2``), falling back
+to its mtime if the name has none.  As in audit_cache, the checksum is only
+recomputed when the size or mtime of a backup change, and a backup whose
+content changed loses what was extracted from it.  For each instance type,
+the extraction status, the host set of a backup and the hosts created as of
+the backup are recorded along with the fingerprint of the extraction
+settings (see backup_cache), so a --since run takes the hosts of the backup
+before its window from the manifest.  If that backup's status with the
+current settings is not done (it failed, or was never extracted with them),
+the run extracts it again first.  The backups within the window are
+extracted on every run: backup_cache returns the results of those done
+before and keeps no failed ones, so failures are retried.
+"""
+import datetime
+import json
+import logging
+import os
+import re
+
+from dateutil.parser import parse as dateparse
+
+from ..util import atomic_write
+from .audit_cache import file_sha256
+from .backup_cache import settings_fingerprint
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def backup_time(name, regex, path):
+    """Time of backup *name*: its backup_file_regex groups read as a date,
+    or else the mtime of *path*."""
+    m = re.match(regex, name)
+    groups = [group for group in m.groups() if group] if m else []
+    if groups:
+        try:
+            return dateparse(' '.join(groups))
+        except (ValueError, OverflowError):
+            LOG.warning('no date in the backup_file_regex groups {} of {}, using its mtime'.format(groups, name))
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def created_hosts(machine_events, until):
+    """Hosts whose last CREATE or DELETE event up to *until*, in (time,
+    event) order as refinement walks them, is a CREATE."""
+    last = {}
+    for event_time, host, event in machine_events:
+        if event in ('CREATE', 'DELETE') and event_time is not None and event_time <= until:
+            last[host] = max(last.get(host, (event_time, event)), (event_time, event))
+    return {host for host, (_, event) in last.items() if event == 'CREATE'}
+
+
+class BackupManifest(object):
+    def __init__(self, path=None):
+        """Manifest stored in *path*; with no path it only lives for this
+        run and backups are not checksummed."""
+        self.path = path
+        self.backups = {}
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            LOG.warning('ignoring unreadable backup manifest {}: {}'.format(path, e))
+            return
+        if manifest.get('version') != MANIFEST_VERSION:
+            LOG.warning('ignoring backup manifest {} of version {}'.format(path, manifest.get('version')))
+            return
+        self.backups = manifest['backups']
+
+    def scan(self, backup_dir, regex):
+        """Bring the manifest up to date with the backups in *backup_dir*
+        matching *regex*, and return their names, oldest first."""
+        names = [f for f in os.listdir(backup_dir) if os.path.isfile(os.path.join(backup_dir, f)) and re.match(regex, f)]
+        for name in names:
+            path = os.path.join(backup_dir, name)
+            st = os.stat(path)
+            entry = self.backups.get(name)
+            if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime_ns:
+                digest = file_sha256(path) if self.path is not None else None
+                if entry is None or digest is None or entry['sha256'] != digest:
+                    LOG.debug('new or changed backup {}'.format(name))
+                    entry = {'extracted': {}}
+                entry.update(size=st.st_size, mtime=st.st_mtime_ns, sha256=digest)
+                self.backups[name] = entry
+            entry['time'] = backup_time(name, regex, path).isoformat()
+        for name in set(self.backups).difference(names):
+            LOG.debug('backup {} is gone'.format(name))
+            del self.backups[name]
+        return sorted(names, key=lambda name: (self.time(name), name))
+
+    def time(self, name):
+        return datetime.datetime.fromisoformat(self.backups[name]['time'])
+
+    def record(self, name, instance_type, settings, result):
+        """Record the result of extracting *instance_type* events from
+        backup *name* with *settings* (see machine.get_machine_event)."""
+        extracted = {'settings': settings_fingerprint(settings), 'status': 'failed'}
+        if result and 'hosts' in result:
+            extracted.update(status='done', hosts=sorted(result['hosts'], key=str),
+                             created_hosts=sorted(created_hosts(result['machine_events'], result['file_time']), key=str))
+        self.backups[name]['extracted'][instance_type] = extracted
+
+    def status(self, name, instance_type, settings):
+        """'done' or 'failed' for the last extraction of *instance_type*
+        events from backup *name* with *settings*, or None if there was
+        none."""
+        extracted = self.backups[name]['extracted'].get(instance_type)
+        if not extracted or extracted['settings'] != settings_fingerprint(settings):
+            return None
+        return extracted['status']
+
+    def hosts(self, name, instance_type, settings):
+        """Hosts of backup *name* found by the last extraction with
+        *settings*, or None if there was none or it failed."""
+        if self.status(name, instance_type, settings) != 'done':
+            return None
+        return set(self.backups[name]['extracted'][instance_type]['hosts'])
+
+    def created_hosts(self, name, instance_type, settings):
+        """Hosts created as of backup *name* (see created_hosts), or None
+        if they are not known."""
+        extracted = self.backups[name]['extracted'].get(instance_type)
+        if self.hosts(name, instance_type, settings) is None or 'created_hosts' not in extracted:
+            return None
+        return set(extracted['created_hosts'])
+
+    def save(self):
+        if self.path is None:
+            return
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'backups': self.backups}, f, indent=1, sort_keys=True)
+        atomic_write(self.path, write)
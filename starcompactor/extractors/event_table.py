@@ -0,0 +1,246 @@
+# coding: utf-8
+"""Compact store for machine events.
+
+Machine events used to be kept in a dict mapping (event_time, host, event)
+tuples to a property dict per event.  A multi-year run over daily backups
+produces millions of such entries, nearly all of which repeat one of a few
+property dicts, so the tuple, datetime and dict objects dominate memory.
+
+MachineEventTable keeps the same mapping as parallel arrays instead: event
+time as integer microseconds, and host, event type and property set as small
+integer codes into interned tables.  It offers the dict operations the
+extractors and machine_event_dump use (item assignment and lookup, deletion,
+update, iteration in insertion order), so it can stand in for the dict.
+Assigning to an existing key replaces its properties but keeps its position,
+like a dict.
+
+Properties are stored as interned tuples, so the dict returned for a key is
+a fresh copy and changing it does not change the table; build a property
+dict completely before assigning it.
+"""
+import array
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# Sorted, so ordering event codes orders event names.
+EVENTS = ('CREATE', 'DELETE', 'DISABLE', 'ENABLE', 'UPDATE')
+EVENT_CODES = {event: code for code, event in enumerate(EVENTS)}
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+# Time code of a missing event time; sorts before every real time.
+NO_TIME = -(1 << 63)
+
+
+def time_code(t):
+    if t is None or t is pd.NaT:
+        return NO_TIME
+    if not isinstance(t, datetime.datetime):
+        raise TypeError('event time must be a datetime, not {}'.format(repr(t)))
+    # wall-clock time, ignoring tzinfo; much faster than subtracting datetimes,
+    # especially for pandas Timestamps
+    seconds = (t.toordinal() - _EPOCH_ORDINAL) * 86400 + t.hour * 3600 + t.minute * 60 + t.second
+    return seconds * 1000000 + t.microsecond
+
+
+def code_time(code):
+    if code == NO_TIME:
+        return None
+    return _EPOCH + datetime.timedelta(microseconds=code)
+
+
+class MachineEventTable(object):
+    def __init__(self, events=None):
+        self.times = array.array('q')
+        self.host_codes = array.array('i')
+        self.event_codes = array.array('b')
+        self.property_codes = array.array('i')
+        self.alive = bytearray()
+        self.hosts = []
+        self.property_sets = []
+        self._host_index = {}
+        self._property_index = {}
+        self._rows = {}  # packed (time, host, event) code -> row
+        if events is not None:
+            self.update(events)
+
+    def __getstate__(self):
+        # the indexes are rebuilt on unpickling, which keeps cached and
+        # inter-process copies small
+        state = self.__dict__.copy()
+        for name in ('_host_index', '_property_index', '_rows'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._host_index = {host: code for code, host in enumerate(self.hosts)}
+        self._property_index = {items: code for code, items in enumerate(self.property_sets)}
+        self._rows = {self._pack(self.times[row], self.host_codes[row], self.event_codes[row]): row
+                      for row in self.rows()}
+
+    def _host_code(self, host, add=False):
+        code = self._host_index.get(host)
+        if code is None and add:
+            code = self._host_index[host] = len(self.hosts)
+            self.hosts.append(host)
+        return code
+
+    def _property_code(self, properties):
+        items = tuple(properties.items())
+        code = self._property_index.get(items)
+        if code is None:
+            code = self._property_index[items] = len(self.property_sets)
+            self.property_sets.append(items)
+        return code
+
+    @staticmethod
+    def _pack(time, host_code, event_code):
+        return (((time - NO_TIME) << 32 | host_code) << 3) | event_code
+
+    def _codes(self, key, add=False):
+        """(time, host, event) codes of *key*, or None if its host is unknown."""
+        event_time, host, event = key
+        host_code = self._host_code(host, add)
+        if host_code is None:
+            return None
+        return time_code(event_time), host_code, EVENT_CODES[event]
+
+    def _row(self, key):
+        codes = self._codes(key)
+        return self._rows.get(self._pack(*codes)) if codes is not None else None
+
+    def __setitem__(self, key, properties):
+        codes = self._codes(key, add=True)
+        packed = self._pack(*codes)
+        property_code = self._property_code(properties)
+        row = self._rows.get(packed)
+        if row is not None:
+            self.property_codes[row] = property_code
+            return
+        self._rows[packed] = len(self.times)
+        self.times.append(codes[0])
+        self.host_codes.append(codes[1])
+        self.event_codes.append(codes[2])
+        self.property_codes.append(property_code)
+        self.alive.append(1)
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        return dict(self.property_sets[self.property_codes[row]])
+
+    def __delitem__(self, key):
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        del self._rows[self._pack(*self._codes(key))]
+        self.alive[row] = 0
+
+    def __contains__(self, key):
+        return self._row(key) is not None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def row(self, key):
+        """Row index of *key*, or None."""
+        return self._row(key)
+
+    def key(self, row):
+        return (code_time(self.times[row]), self.hosts[self.host_codes[row]], EVENTS[self.event_codes[row]])
+
+    def rows(self):
+        """Indices of the live rows, in insertion order."""
+        return [row for row, alive in enumerate(self.alive) if alive]
+
+    def __iter__(self):
+        for row in self.rows():
+            yield self.key(row)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        for row in self.rows():
+            yield self.key(row), dict(self.property_sets[self.property_codes[row]])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, events):
+        for key, properties in events.items():
+            self[key] = properties
+
+    def property_values(self, name):
+        """Distinct values of property *name* over the live events."""
+        values = set()
+        for code in set(self.property_codes[row] for row in self.rows()):
+            properties = dict(self.property_sets[code])
+            if name in properties:
+                values.add(properties[name])
+        return values
+
+    def frame(self):
+        """The live events as a DataFrame sorted by host name, time and event
+        name, with integer columns row, host, time, event and properties.
+
+        *host* is the rank of the host name.  *properties* gives equal
+        property dicts (regardless of key order) the same number.
+        """
+        rows = np.array(self.rows(), dtype=np.int64)
+        host_rank = np.empty(len(self.hosts), dtype=np.int64)
+        host_rank[sorted(range(len(self.hosts)), key=self.hosts.__getitem__)] = np.arange(len(self.hosts))
+        canonical = {}
+        property_ids = np.array([canonical.setdefault(frozenset(items), len(canonical))
+                                 for items in self.property_sets], dtype=np.int64)
+
+        def column(codes, dtype):
+            return np.frombuffer(codes, dtype=dtype)[rows] if len(rows) else np.array([], dtype=np.int64)
+
+        df = pd.DataFrame({
+            'row': rows,
+            'host': host_rank[column(self.host_codes, np.int32)],
+            'time': column(self.times, np.int64),
+            'event': column(self.event_codes, np.int8),
+            'properties': property_ids[column(self.property_codes, np.int32)],
+        })
+        return df.sort_values(['host', 'time', 'event'], kind='stable', ignore_index=True)
+
+    def drop_rows(self, rows):
+        """Delete the events at the given row indices."""
+        for row in rows:
+            del self._rows[self._pack(self.times[row], self.host_codes[row], self.event_codes[row])]
+            self.alive[row] = 0
+
+    def take(self, rows):
+        """A new table holding the events at the given row indices, in that
+        order; row i of the new table is rows[i] of this one."""
+        table = MachineEventTable()
+        host_codes = {}
+        property_codes = {}
+        for row in rows:
+            host_code = self.host_codes[row]
+            if host_code not in host_codes:
+                host_codes[host_code] = table._host_code(self.hosts[host_code], add=True)
+            property_code = self.property_codes[row]
+            if property_code not in property_codes:
+                property_codes[property_code] = table._property_code(dict(self.property_sets[property_code]))
+            time, new_host_code, event_code = self.times[row], host_codes[host_code], self.event_codes[row]
+            table._rows[self._pack(time, new_host_code, event_code)] = len(table.times)
+            table.times.append(time)
+            table.host_codes.append(new_host_code)
+            table.event_codes.append(event_code)
+            table.property_codes.append(property_codes[property_code])
+            table.alive.append(1)
+        return table
+
+    def copy(self):
+        """A new table holding the live events, in order."""
+        return self.take(self.rows())
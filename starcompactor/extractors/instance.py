@@ -10,107 +10,59 @@ column, identical to the machine event audit files.  The relevant tables are:
   openstack_audit.audit_nova_instance_actions.parquet
   openstack_audit.audit_nova_instance_actions_events.parquet
 """
-import json
+import datetime
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-from dateutil.parser import parse as dateparse
+import pyarrow as pa
+
+from . import audit
 
 LOG = logging.getLogger(__name__)
 
+INSTANCES_FILE = 'openstack_audit.audit_nova_instances.parquet'
+ACTIONS_FILE = 'openstack_audit.audit_nova_instance_actions.parquet'
+EVENTS_FILE = 'openstack_audit.audit_nova_instance_actions_events.parquet'
 
-def _parse_audit_parquet(path):
-    """Read an audit parquet file, parse JSON payloads, and return a DataFrame.
-
-    Each audit row's 'data' column is a JSON-encoded dict of the original DB
-    row.  This mirrors _read_and_load_parquet in machine.py.
-    """
-    df = pd.read_parquet(path)
-    rows = []
-    for _, row in df.iterrows():
-        payload = json.loads(row['data'])
-        payload['audit_event_type'] = row['audit_event_type']
-        payload['audit_changed_at'] = row['audit_changed_at']
-        rows.append(payload)
-    return pd.DataFrame(rows)
-
-
-def _to_dt(val):
-    """Convert a value to a naive Python datetime, or None."""
-    if val is None:
-        return None
-    if isinstance(val, pd.Timestamp):
-        if pd.isnull(val):
-            return None
-        dt = val.to_pydatetime()
-    else:
-        try:
-            dt = dateparse(str(val))
-        except Exception:
-            return None
-    return dt.replace(tzinfo=None) if dt.tzinfo is not None else dt
+# Payload keys needed from each audit table; everything else in the nova rows
+# is dropped during decoding.
+INSTANCE_FIELDS = ['uuid', 'memory_mb', 'root_gb', 'vcpus',
+                   'user_id', 'project_id', 'hostname', 'host', 'node']
+ACTION_FIELDS = ['id', 'instance_uuid', 'created_at']
+EVENT_FIELDS = ['action_id', 'event', 'start_time', 'finish_time', 'result', 'host']
 
+# An action (and each of its events) is audited when it is inserted, i.e. no
+# earlier than its created_at, so audit rows older than --start can be skipped
+# in the scan.  The margin covers clock skew between nova and the database.
+AUDIT_CLOCK_SKEW = datetime.timedelta(days=1)
 
-def get_instance_events_from_parquet(data_dir, start=None, end=None, instance_type=None):
-    """Read instance action events from openstack_audit parquet files and yield trace dicts.
+# The three audit tables are independent until the join, so they are loaded
+# side by side.  Threads are enough: the parquet scan and Arrow's JSON decoder
+# release the GIL, and the decoded frames don't have to be pickled back.
+LOAD_WORKERS = 3
 
-    Replicates the SQL JOIN:
-        instances AS i
-        JOIN instance_actions AS ia ON i.uuid = ia.instance_uuid
-        JOIN instance_actions_events AS iae ON ia.id = iae.action_id
-    WHERE i.user_id != 'admin' AND i.project_id != 'admin'
-    AND (optional) ia.created_at >= start AND ia.created_at <= end
-    AND iae.finish_time IS NOT NULL
 
-    Parameters
-    ----------
-    data_dir : str
-        Directory containing the three openstack_audit nova parquet files.
-    start : datetime or None
-        Optional lower bound on ia.created_at (action start time).
-    end : datetime or None
-        Optional upper bound on ia.created_at (action start time).
-    instance_type : str or None
-        Optional type of instance (e.g. 'baremetal') to determine host selection.
+def _parse_audit_parquet(path, columns=None, **filters):
+    """Read an audit parquet file, parse JSON payloads, and return a DataFrame.
 
-    Yields
-    ------
-    dict
-        One dict per event row with renamed keys matching TRACE_EVENT_KEY_RENAME_MAP.
+    Each audit row's 'data' column is a JSON-encoded dict of the original DB
+    row.  The whole column is decoded at once by audit.read_audit_parquet,
+    keeping only the payload keys listed in *columns*.  *filters* are passed
+    through and evaluated in the parquet scan (see audit.audit_filter).
     """
-    instances_path = os.path.join(
-        data_dir, 'openstack_audit.audit_nova_instances.parquet')
-    actions_path = os.path.join(
-        data_dir, 'openstack_audit.audit_nova_instance_actions.parquet')
-    events_path = os.path.join(
-        data_dir, 'openstack_audit.audit_nova_instance_actions_events.parquet')
-
-    LOG.info('Reading audit_nova_instances from %s', instances_path)
-    df_instances = _parse_audit_parquet(instances_path)
-
-    LOG.info('Reading audit_nova_instance_actions from %s', actions_path)
-    df_actions = _parse_audit_parquet(actions_path)
+    return audit.read_audit_parquet(path, columns=columns, **filters)
 
-    LOG.info('Reading audit_nova_instance_actions_events from %s', events_path)
-    df_events = _parse_audit_parquet(events_path)
 
+def _load_instances(path):
+    """Non-admin instances, one INSERT row per uuid."""
+    LOG.info('Reading audit_nova_instances from %s', path)
     # Each audit table may have INSERT and DELETE rows.  For instances we only
     # want the INSERT (creation) record to get the instance metadata.
-    # For actions and events there are only INSERTs in practice, but filter
-    # defensively so we don't double-count if DELETEs ever appear.
-    if 'audit_event_type' in df_instances.columns:
-        df_instances = df_instances[df_instances['audit_event_type'] == 'INSERT']
-    if 'audit_event_type' in df_actions.columns:
-        df_actions = df_actions[df_actions['audit_event_type'] == 'INSERT']
-    if 'audit_event_type' in df_events.columns:
-        df_events = df_events[df_events['audit_event_type'] == 'INSERT']
-
-    # Drop audit metadata columns before merging
-    drop_cols = ['audit_event_type', 'audit_changed_at']
-    df_instances = df_instances.drop(columns=[c for c in drop_cols if c in df_instances.columns])
-    df_actions   = df_actions.drop(columns=[c for c in drop_cols if c in df_actions.columns])
-    df_events    = df_events.drop(columns=[c for c in drop_cols if c in df_events.columns])
+    df_instances = _parse_audit_parquet(path, INSTANCE_FIELDS, event_types=['INSERT'])
+    df_instances = df_instances.drop(columns=[c for c in audit.AUDIT_COLUMNS if c in df_instances.columns])
 
     # Filter out admin instances (mirrors SQL WHERE clause)
     df_instances = df_instances[
@@ -118,17 +70,21 @@ def get_instance_events_from_parquet(data_dir, start=None, end=None, instance_ty
         (df_instances['project_id'] != 'admin')
     ]
 
-    # Keep only columns we need to reduce memory usage
-    instance_cols = ['uuid', 'memory_mb', 'root_gb', 'vcpus',
-                     'user_id', 'project_id', 'hostname', 'host', 'node']
-    df_instances = df_instances[[c for c in instance_cols if c in df_instances.columns]]
-
     # Deduplicate instances by uuid — keep the first INSERT per uuid
-    df_instances = df_instances.drop_duplicates(subset=['uuid'], keep='first')
+    return df_instances.drop_duplicates(subset=['uuid'], keep='first')
+
+
+def _load_actions(path, start=None, end=None, changed_after=None):
+    """Actions created within [start, end], one row per id."""
+    LOG.info('Reading audit_nova_instance_actions from %s', path)
+    # For actions and events there are only INSERTs in practice, but filter
+    # defensively so we don't double-count if DELETEs ever appear.
+    df_actions = _parse_audit_parquet(path, ACTION_FIELDS, event_types=['INSERT'],
+                                      changed_after=changed_after)
 
     # Apply optional time filters on action created_at
     if 'created_at' in df_actions.columns:
-        df_actions['created_at'] = pd.to_datetime(df_actions['created_at'], errors='coerce', utc=False)
+        df_actions['created_at'] = pd.to_datetime(df_actions['created_at'], errors='coerce', utc=False, format='ISO8601')
         if start is not None:
             start_naive = start.replace(tzinfo=None) if start.tzinfo else start
             df_actions = df_actions[df_actions['created_at'] >= start_naive]
@@ -139,82 +95,278 @@ def get_instance_events_from_parquet(data_dir, start=None, end=None, instance_ty
     action_cols = ['id', 'instance_uuid']
     df_actions = df_actions[[c for c in action_cols if c in df_actions.columns]]
     # Deduplicate actions by id
-    df_actions = df_actions.drop_duplicates(subset=['id'], keep='first')
+    return df_actions.drop_duplicates(subset=['id'], keep='first')
 
-    event_cols = ['action_id', 'event', 'start_time', 'finish_time', 'result', 'host']
-    df_events = df_events[[c for c in event_cols if c in df_events.columns]]
 
-    # JOIN: instances <-> instance_actions on uuid = instance_uuid
-    df = pd.merge(
-        df_instances, df_actions,
-        left_on='uuid', right_on='instance_uuid',
-        how='inner',
-        suffixes=('', '_action'),
-    )
+def _load_events(path, changed_after=None, **filters):
+    """All events, audit columns dropped."""
+    LOG.info('Reading audit_nova_instance_actions_events from %s', path)
+    df_events = _parse_audit_parquet(path, EVENT_FIELDS, event_types=['INSERT'],
+                                     changed_after=changed_after, **filters)
+    return df_events.drop(columns=[c for c in audit.AUDIT_COLUMNS if c in df_events.columns])
+
+
+def _timed(func, path, *args, **kwargs):
+    """Call func(path, ...) and log how long loading *path* took."""
+    started = time.perf_counter()
+    df = func(path, *args, **kwargs)
+    LOG.info('Loaded %d rows from %s in %.2fs', len(df), os.path.basename(path), time.perf_counter() - started)
+    return df
+
 
+def _join_events(df_instance_actions, df_events):
+    """Join all events onto the instance/action table at once."""
+    if 'action_id' not in df_events.columns:
+        # no events in the audit time range, not even a column to join on
+        LOG.info('Total rows after join: 0')
+        return
     # JOIN: result <-> instance_actions_events on id = action_id
     df = pd.merge(
-        df, df_events,
+        df_instance_actions, df_events,
         left_on='id', right_on='action_id',
         how='inner',
         suffixes=('', '_event'),
     )
-
     LOG.info('Total rows after join: %d', len(df))
+    yield df
 
-    n_records = 0
-    n_skipped = 0
-    for _, row in df.iterrows():
-        finish_time_raw = row.get('finish_time')
-        # Replicate the SQL extractor's skip of rows with no finish_time
-        if finish_time_raw is None or (isinstance(finish_time_raw, float) and pd.isnull(finish_time_raw)):
-            LOG.debug('Invalid event (no finish_time): %s', row.get('uuid'))
-            n_skipped += 1
-            continue
-        try:
-            finish_time = _to_dt(finish_time_raw)
-        except Exception:
-            n_skipped += 1
-            continue
-        if finish_time is None:
-            n_skipped += 1
+
+def _stream_join_events(df_instance_actions, path, changed_after=None, batch_size=audit.BATCH_SIZE, **filters):
+    """Stream events in record batches through a hash index on action id.
+
+    Only the instance/action table and one batch of events are held in
+    memory at a time.  Rows come out in events-file order rather than in
+    instance/action order.
+    """
+    LOG.info('Streaming audit_nova_instance_actions_events from %s', path)
+    index = df_instance_actions.set_index('id')
+    n_joined = 0
+    for df_events in audit.iter_audit_parquet(path, EVENT_FIELDS, batch_size=batch_size,
+                                              event_types=['INSERT'], changed_after=changed_after, **filters):
+        if 'action_id' not in df_events.columns:
             continue
+        positions = index.index.get_indexer(df_events['action_id'])
+        matched = positions >= 0
+        df_events = df_events[matched].drop(columns=audit.AUDIT_COLUMNS)
+        # Same column names as the pd.merge in _join_events
+        df_events = df_events.rename(columns={'host': 'host_event'}).reset_index(drop=True)
+        df = pd.concat([index.iloc[positions[matched]].reset_index(drop=True), df_events], axis=1)
+        n_joined += len(df)
+        LOG.debug('Joined %d of %d events in batch', len(df), len(matched))
+        yield df
+    LOG.info('Total rows after join: %d', n_joined)
+
+
+def _to_pydatetime_column(values):
+    """datetime64 Series -> object Series of naive datetimes, None for NaT.
+
+    Built from a list: a Series of datetimes is inferred back to datetime64
+    (with NaT) by pandas >= 3, even from an object array.
+    """
+    return pd.Series([None if pd.isna(value) else value.to_pydatetime() for value in values],
+                     index=values.index, dtype=object)
+
+
+def _non_empty(df, column):
+    """*column* of *df* with null and empty values as NaN (all NaN if absent)."""
+    if column not in df.columns:
+        return pd.Series(float('nan'), index=df.index, dtype=object)
+    values = df[column]
+    return values.where(values.notna() & (values != ''))
+
+
+def _trace_frame(df, instance_type):
+    """Build the trace columns for a joined frame, working a column at a time.
+
+    Rows without a parseable finish_time are dropped, mirroring the SQL
+    extractor.  Returns a frame with one column per trace field (START_TIME
+    and FINISH_TIME as naive datetime64) and the number of rows dropped.
+    """
+    finish_time = audit.naive_datetimes(df['finish_time']) if 'finish_time' in df.columns \
+        else pd.Series(pd.NaT, index=df.index, dtype='datetime64[us]')
+    valid = finish_time.notna()
+    n_skipped = int((~valid).sum())
+    if n_skipped:
+        LOG.debug('Invalid events (no finish_time): %d', n_skipped)
+    df = df[valid]
+    finish_time = finish_time[valid]
+
+    start_time = audit.naive_datetimes(df['start_time']) if 'start_time' in df.columns \
+        else pd.Series(pd.NaT, index=df.index, dtype='datetime64[us]')
+
+    # Baremetal instances report the ironic node; otherwise prefer the host
+    # the event ran on over the host recorded on the instance.
+    host = _non_empty(df, 'host_event')
+    host = host.where(host.notna(), _non_empty(df, 'host'))
+    if instance_type == 'baremetal':
+        node = _non_empty(df, 'node')
+        host = node.where(node.notna(), host)
+    n_missing_host = int(host.isna().sum())
+    if n_missing_host:
+        LOG.debug('Missing host for %d events', n_missing_host)
+
+    def column(name):
+        if name not in df.columns:
+            return pd.Series(None, index=df.index, dtype=object)
+        return df[name]
+
+    def text_column(name):
+        values = column(name).astype(object)
+        return values.where(values.notna(), None)
+
+    traces = pd.DataFrame({
+        'INSTANCE_UUID':        text_column('uuid'),
+        'EVENT':                text_column('event'),
+        'START_TIME':           start_time,
+        'FINISH_TIME':          finish_time,
+        'RESULT':               text_column('result'),
+        'INSTANCE_NAME':        text_column('hostname'),
+        'USER_ID':              text_column('user_id'),
+        'PROJECT_ID':           text_column('project_id'),
+        'HOST_NAME (PHYSICAL)': host.astype(object).where(host.notna(), None),
+        # Extra instance fields preserved by the original SQL extractor
+        'memory_mb':            column('memory_mb'),
+        'root_gb':              column('root_gb'),
+        'vcpus':                column('vcpus'),
+    })
+    return traces, n_skipped
+
+
+def _frame_to_traces(traces):
+    """Trace frame -> list of trace dicts with Python datetimes (or None)."""
+    traces = traces.assign(START_TIME=_to_pydatetime_column(traces['START_TIME']),
+                           FINISH_TIME=_to_pydatetime_column(traces['FINISH_TIME']))
+    return traces.to_dict('records')
+
+
+def _frame_to_record_batch(traces):
+    """Trace frame -> Arrow RecordBatch.
+
+    Float columns keep NaN as NaN rather than null, so the columnar path
+    formats missing numbers exactly like the dict path does.
+    """
+    arrays = [pa.array(traces[c], from_pandas=not pd.api.types.is_float_dtype(traces[c]))
+              for c in traces.columns]
+    return pa.RecordBatch.from_arrays(arrays, names=list(traces.columns))
+
+
+def _iter_trace_frames(data_dir, start=None, end=None, instance_type=None,
+                       streaming=False, batch_size=audit.BATCH_SIZE,
+                       changed_since=None, changed_before=None):
+    """Yield trace frames (see _trace_frame); the shared body of
+    get_instance_events_from_parquet and get_instance_event_batches_from_parquet."""
+    instances_path = os.path.join(data_dir, INSTANCES_FILE)
+    actions_path = os.path.join(data_dir, ACTIONS_FILE)
+    events_path = os.path.join(data_dir, EVENTS_FILE)
+
+    # The INSERT filters, and the lower bound from --start, are pushed into
+    # the parquet scan; the exact created_at window is applied after decoding.
+    changed_after = start - AUDIT_CLOCK_SKEW if start is not None else None
+    # Incremental runs only take events audited in (changed_since,
+    # changed_before]; instances and actions are always read in full, as new
+    # events may belong to old actions.
+    event_filters = {'changed_since': changed_since, 'changed_before': changed_before}
+
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+        instances = pool.submit(_timed, _load_instances, instances_path)
+        actions = pool.submit(_timed, _load_actions, actions_path, start, end, changed_after)
+        # The streaming join reads events batch by batch after the join
+        # table is built, so only preload them for the in-memory join.
+        events = None if streaming else pool.submit(_timed, _load_events, events_path, changed_after, **event_filters)
+        df_instances = instances.result()
+        df_actions = actions.result()
+        df_events = events.result() if events is not None else None
+
+    # JOIN: instances <-> instance_actions on uuid = instance_uuid
+    df_instance_actions = pd.merge(
+        df_instances, df_actions,
+        left_on='uuid', right_on='instance_uuid',
+        how='inner',
+        suffixes=('', '_action'),
+    )
 
-        host_event = row.get('host_event')
-        host_instance = row.get('host')
-        if pd.isnull(host_event):
-            host_event = None
-        if pd.isnull(host_instance):
-            host_instance = None
-
-        if instance_type == 'baremetal':
-            node_instance = row.get('node')
-            if pd.isnull(node_instance):
-                node_instance = None
-            final_host = node_instance or host_event or host_instance
-        else:
-            final_host = host_event or host_instance
-
-        # print(f"final_host: {final_host}, host_event: {host_event}, host_instance: {host_instance}, node_instance: {node_instance}")
-        if not final_host:
-            LOG.debug('Missing host for event: %s', row.to_dict())
-
-        trace = {
-            'INSTANCE_UUID':        row.get('uuid'),
-            'EVENT':                row.get('event'),
-            'START_TIME':           _to_dt(row.get('start_time')),
-            'FINISH_TIME':          finish_time,
-            'RESULT':               row.get('result'),
-            'INSTANCE_NAME':        row.get('hostname'),
-            'USER_ID':              row.get('user_id'),
-            'PROJECT_ID':           row.get('project_id'),
-            'HOST_NAME (PHYSICAL)': final_host,
-            # Extra instance fields preserved by the original SQL extractor
-            'memory_mb':            row.get('memory_mb'),
-            'root_gb':              row.get('root_gb'),
-            'vcpus':                row.get('vcpus'),
-        }
-        n_records += 1
-        yield trace
+    if streaming:
+        frames = _stream_join_events(df_instance_actions, events_path, changed_after, batch_size, **event_filters)
+    else:
+        frames = _join_events(df_instance_actions, df_events)
+
+    n_records = 0
+    n_skipped = 0
+    for df in frames:
+        traces, skipped = _trace_frame(df, instance_type)
+        n_records += len(traces)
+        n_skipped += skipped
+        yield traces
 
     LOG.info('Yielded %d records (%d skipped, no finish_time)', n_records, n_skipped)
+
+
+def get_instance_events_from_parquet(data_dir, start=None, end=None, instance_type=None,
+                                     streaming=False, batch_size=audit.BATCH_SIZE,
+                                     changed_since=None, changed_before=None):
+    """Read instance action events from openstack_audit parquet files and yield trace dicts.
+
+    Replicates the SQL JOIN:
+        instances AS i
+        JOIN instance_actions AS ia ON i.uuid = ia.instance_uuid
+        JOIN instance_actions_events AS iae ON ia.id = iae.action_id
+    WHERE i.user_id != 'admin' AND i.project_id != 'admin'
+    AND (optional) ia.created_at >= start AND ia.created_at <= end
+    AND iae.finish_time IS NOT NULL
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory containing the three openstack_audit nova parquet files.
+    start : datetime or None
+        Optional lower bound on ia.created_at (action start time).
+    end : datetime or None
+        Optional upper bound on ia.created_at (action start time).
+    instance_type : str or None
+        Optional type of instance (e.g. 'baremetal') to determine host selection.
+    streaming : bool
+        If True, stream the events file in record batches of *batch_size*
+        rows through the join instead of loading it whole.  Peak memory then
+        scales with the number of instances and actions, not events; traces
+        are yielded in events-file order.
+    changed_since : datetime or None
+        Only take events whose audit row was changed after this time, e.g.
+        the high-water mark of a previous run.
+    changed_before : datetime or None
+        Only take events whose audit row was changed at or before this time.
+
+    Yields
+    ------
+    dict
+        One dict per event row with renamed keys matching TRACE_EVENT_KEY_RENAME_MAP.
+    """
+    for traces in _iter_trace_frames(data_dir, start, end, instance_type, streaming, batch_size,
+                                     changed_since, changed_before):
+        yield from _frame_to_traces(traces)
+
+
+def get_instance_event_batches_from_parquet(data_dir, start=None, end=None, instance_type=None,
+                                            streaming=False, batch_size=audit.BATCH_SIZE,
+                                            changed_since=None, changed_before=None):
+    """Columnar counterpart of get_instance_events_from_parquet.
+
+    Takes the same arguments, but yields Arrow RecordBatches with one column
+    per trace field instead of one dict per event.  START_TIME and
+    FINISH_TIME are naive timestamps.
+    """
+    for traces in _iter_trace_frames(data_dir, start, end, instance_type, streaming, batch_size,
+                                     changed_since, changed_before):
+        yield _frame_to_record_batch(traces)
+
+
+def latest_event_change(data_dir):
+    """High-water mark for incremental runs: the latest audit_changed_at of
+    the event INSERT rows in *data_dir*, or None if there are none."""
+    return audit.max_changed_at(os.path.join(data_dir, EVENTS_FILE), event_types=['INSERT'])
+
+
+def event_time_range(data_dir):
+    """Earliest and latest audit_changed_at of the event INSERT rows in
+    *data_dir*, or (None, None); raises ValueError if the events can't be
+    filtered by audit_changed_at."""
+    return audit.changed_at_range(os.path.join(data_dir, EVENTS_FILE), event_types=['INSERT'])
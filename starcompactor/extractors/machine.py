@@ -2,18 +2,23 @@
 import bz2
 import configparser
 import datetime
+import decimal
 import gzip
+import hashlib
+import io
 import logging
 import os
 import re
 import shutil
+import sqlite3
 import subprocess
 import tempfile
-import json
+import warnings
 import pandas as pd
 from dateutil.parser import parse as dateparse
 
-from . import mysql
+from . import audit, backup_cache, mysql, sqldump
+from .event_table import MachineEventTable
 
 LOG = logging.getLogger(__name__)
 
@@ -29,45 +34,339 @@ BAREMETAL_PROPERTIES = config.get('baremetal', 'properties').split(',')
 BACKUP_FILE_REDUCABLE_PREFIX_LEN = int(config.get('backup', 'backup_file_reducable_prefix_len')) if config.get('backup', 'backup_file_reducable_prefix_len') else 0
 BACKUP_FILE_REDUCABLE_SUFFIX_LEN = int(config.get('backup', 'backup_file_reducable_suffix_len')) if config.get('backup', 'backup_file_reducable_suffix_len') else 0
 
-def open_by_suffix(filename):
+# Payload keys needed from each vm audit table
+NOVA_SERVICE_FIELDS = ['host', 'binary', 'disabled']
+NOVA_COMPUTE_NODE_FIELDS = ['hypervisor_hostname', 'host', 'created_at', 'deleted_at', 'vcpus', 'memory_mb', 'local_gb']
+
+# Payload keys needed from each baremetal audit table
+IRONIC_NODE_FIELDS = ['uuid', 'maintenance']
+BLAZAR_HOST_FIELDS = ['id', 'hypervisor_hostname', 'created_at']
+BLAZAR_HOST_CAPABILITY_FIELDS = ['computehost_id', 'property_id', 'capability_value']
+BLAZAR_PROPERTY_FIELDS = ['id', 'property_name']
+
+# Block-parallel bzip2 decompressors, used for .bz2 backups if one is on the
+# PATH.  (bzip2 blocks are not byte aligned, so they can't be cheaply split
+# for decompressing in-process.)
+PARALLEL_BZ2_COMMANDS = [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c']]
+
+def parallel_bz2_command():
+    """The first of PARALLEL_BZ2_COMMANDS that is installed, or None."""
+    for command in PARALLEL_BZ2_COMMANDS:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+class DecompressorPipe(object):
+    """Binary file-like reader of the output of an external decompressor.
+
+    Closing it before the end kills the decompressor; reading to the end and
+    then closing raises IOError if the decompressor failed, as BZ2File would
+    on a corrupt file.  Its stderr goes to a temporary file rather than a
+    pipe, which could fill up and block it while its output is read.
+    """
+    def __init__(self, command, filename):
+        self.command = command
+        self.filename = filename
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, stderr=self.stderr)
+        self.eof = False
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and size != 0:
+            self.eof = True
+        return data
+
+    def readline(self, size=-1):
+        line = self.process.stdout.readline(size)
+        if not line and size != 0:
+            self.eof = True
+        return line
+
+    def __iter__(self):
+        for line in self.process.stdout:
+            yield line
+        self.eof = True
+
+    def close(self):
+        if not self.eof and self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        error = self.stderr.read().decode('utf-8', 'replace').strip()
+        self.stderr.close()
+        if self.eof and returncode != 0:
+            raise IOError('{} failed on {} (exit code {}): {}'.format(
+                ' '.join(self.command), self.filename, returncode, error))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+def open_by_suffix(filename, parallel=True):
     if filename.endswith('.gz'):
         return gzip.open(filename, 'r')
     elif filename.endswith('.bz2'):
+        command = parallel_bz2_command() if parallel else None
+        if command is not None:
+            return DecompressorPipe(command, filename)
         return bz2.BZ2File(filename, 'r')
     else:
-        return open(filename, 'r')
+        return open(filename, 'rb')
+
+BACKUP_CACHE_DIR = config.get('cache', 'backup_cache_dir', fallback='')
+BACKUP_CACHE = backup_cache.BackupCache(BACKUP_CACHE_DIR) if BACKUP_CACHE_DIR else None
+
+BACKUP_BACKENDS = ['python', 'sqlite', 'mysql']
+# how the mysql backend cuts tables out of a backup
+BACKUP_SPLITTERS = ['python', 'sed']
 
-def get_machine_event(process_no, backup_file, mysql_args, instance_type):
+def backup_settings(instance_type, backend='python'):
+    """The settings besides the backup itself that its extracted events
+    depend on, including the backend that extracts them."""
+    if instance_type == 'vm':
+        return {'instance_type': instance_type, 'backend': backend, 'nova_databases': NOVA_DATABASES,
+                'rack_extractor': RACK_EXTRACTOR}
+    return {'instance_type': instance_type, 'backend': backend, 'properties': BAREMETAL_PROPERTIES}
+
+def get_machine_event(process_no, backup_file, mysql_args, instance_type, backend='python', splitter='python'):
     LOG.debug("Process {}: parsing file {}".format(str(process_no), backup_file))
     
-    tmp_path = tempfile.mkdtemp()
+    if BACKUP_CACHE is not None:
+        return BACKUP_CACHE.lookup(
+            backup_file, backup_settings(instance_type, backend),
+            lambda: _get_machine_event(backup_file, mysql_args, instance_type, backend, splitter))
+    return _get_machine_event(backup_file, mysql_args, instance_type, backend, splitter)
+
+def backup_tables(instance_type):
+    """The (database, table) sections of a backup the events come from."""
+    if instance_type == 'vm':
+        return [(database, table) for database in NOVA_DATABASES for table in ['compute_nodes', 'services']]
+    if instance_type == 'baremetal':
+        return [('ironic', 'nodes'), ('blazar', 'computehosts'),
+                ('blazar', 'computehost_extra_capabilities'), ('blazar', 'extra_capabilities')]
+    raise ValueError('unknown instance type {}'.format(instance_type))
+
+# (instance type, backend) -> (sections digest, machine events, hosts) of the
+# last backup this process extracted; callers get copies, so that changing
+# one result can't change the next
+_previous_backup = {}
+
+def _get_machine_event(backup_file, mysql_args, instance_type, backend, splitter):
+    if backend not in BACKUP_BACKENDS:
+        raise ValueError('unknown backup backend {}'.format(backend))
+
     filename_len = len(os.path.basename(backup_file))
     tmp_sql_file_name = 'tmp_{}.sql'.format(os.path.basename(backup_file)[0:(filename_len - BACKUP_FILE_REDUCABLE_SUFFIX_LEN)][BACKUP_FILE_REDUCABLE_PREFIX_LEN:]
                                             .replace('.', '_')
                                             .replace('-', '_'))
     
-    try:
-        with open_by_suffix(backup_file) as f_in:
-            with open(os.path.join(tmp_path, tmp_sql_file_name), 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-    except:
-        LOG.exception("Failed to read {}".format(backup_file))
-        shutil.rmtree(tmp_path) 
+    tables = backup_tables(instance_type)
+    sections = read_sections(backup_file, tables, tmp_sql_file_name, splitter if backend == 'mysql' else 'python')
+    if sections is None:
         return {}
     
-    if instance_type == 'vm':
-        machine_events, hosts = get_machine_event_vm(mysql_args, tmp_path, tmp_sql_file_name)
-    elif instance_type == 'baremetal':
-        machine_events, hosts = get_machine_event_baremetal(mysql_args, tmp_path, tmp_sql_file_name)
+    # consecutive daily backups mostly have the same tables; the pool hands
+    # each worker runs of consecutive backups, so compare with the last one
+    digest = sections_digest(sections)
+    previous = _previous_backup.get((instance_type, backend))
+    if previous is not None and previous[0] == digest:
+        LOG.debug('tables of {} are unchanged since the previous backup, reusing its events'.format(backup_file))
+        _, machine_events, hosts = previous
+        machine_events, hosts = machine_events.copy(), set(hosts)
     else:
-        raise ValueError('unknown instance type {}'.format(instance_type))
-    
-    shutil.rmtree(tmp_path) 
+        if backend == 'python':
+            machine_events, hosts = get_machine_event_from_sections(sections, tables, instance_type, backup_file)
+        elif backend == 'sqlite':
+            machine_events, hosts = get_machine_event_sqlite(sections, tables, instance_type, backup_file)
+        elif instance_type == 'vm':
+            machine_events, hosts = get_machine_event_vm(mysql_args, sections, tmp_sql_file_name)
+        else:
+            machine_events, hosts = get_machine_event_baremetal(mysql_args, sections, tmp_sql_file_name)
+        if machine_events is None:
+            return {}
+        _previous_backup[(instance_type, backend)] = (digest, machine_events.copy(), set(hosts))
     
     return {'machine_events': machine_events, 'hosts': hosts, 'file_time': datetime.datetime.fromtimestamp(os.path.getmtime(backup_file))}
 
-def get_machine_event_baremetal(mysql_args, tmp_path, tmp_sql_file_name):
-    machine_events = {} # key is tuple (event_time, host_name, event)
+class _SectionBuffer(object):
+    """split_tables sink keeping a section in memory."""
+    def __init__(self, sections, key):
+        self.sections = sections
+        self.key = key
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        self.sections[self.key] = b''.join(self.chunks)
+
+def _extract_tables_sed(tmp_path, tmp_sql_file_name, tables):
+    table_files = {}
+    for database in sorted(set(database for database, _ in tables)):
+        tmp_database_sql_file_name = '{}_{}'.format(database, tmp_sql_file_name)
+        process_extract_database = subprocess.Popen("sed -n -e '/^USE `{}`/,/^USE/p' {} > {}".format(database, os.path.join(tmp_path, tmp_sql_file_name), os.path.join(tmp_path, tmp_database_sql_file_name)), shell=True)
+        process_extract_database.wait()
+        for table in [table for db, table in tables if db == database]:
+            tmp_table_sql_file_name = '{}_{}_{}'.format(database, table, tmp_sql_file_name)
+            process_extract_table = subprocess.Popen("sed -n -e '/DROP TABLE.*`{}`/,/UNLOCK TABLES/p' {} > {}".format(table, os.path.join(tmp_path, tmp_database_sql_file_name), os.path.join(tmp_path, tmp_table_sql_file_name)), shell=True)
+            process_extract_table.wait()
+            table_files[(database, table)] = os.path.join(tmp_path, tmp_table_sql_file_name)
+    return table_files
+
+def _read_sections_sed(backup_file, tables, tmp_sql_file_name):
+    tmp_path = tempfile.mkdtemp()
+    try:
+        try:
+            with open_by_suffix(backup_file) as f_in:
+                with open(os.path.join(tmp_path, tmp_sql_file_name), 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        except:
+            LOG.exception("Failed to read {}".format(backup_file))
+            return None
+        sections = {}
+        for key, table_file in _extract_tables_sed(tmp_path, tmp_sql_file_name, tables).items():
+            with open(table_file, 'rb') as f:
+                section = f.read()
+            if section:
+                sections[key] = section
+        return sections
+    finally:
+        shutil.rmtree(tmp_path)
+
+def read_sections(backup_file, tables, tmp_sql_file_name, splitter='python'):
+    """The DROP TABLE ... UNLOCK TABLES section of each (database, table) of
+    *tables* in *backup_file*, as bytes, or None if the backup could not be
+    read.  Tables missing from the backup are left out.
+
+    The python splitter reads the decompression stream once, keeping only
+    the (small) wanted sections; the sed splitter needs a decompressed copy
+    of the backup on disk and scans it once per database and table.
+    """
+    if splitter == 'sed':
+        return _read_sections_sed(backup_file, tables, tmp_sql_file_name)
+    if splitter != 'python':
+        raise ValueError('unknown backup splitter {}'.format(splitter))
+    sections = {}
+    try:
+        with open_by_suffix(backup_file) as f:
+            sqldump.split_tables(f, tables, lambda key: _SectionBuffer(sections, key))
+    except:
+        LOG.exception("Failed to read {}".format(backup_file))
+        return None
+    return sections
+
+def sections_digest(sections):
+    h = hashlib.sha256()
+    for (database, table), section in sorted(sections.items()):
+        h.update('{}.{}\n{}\n'.format(database, table, len(section)).encode('utf-8'))
+        h.update(section)
+    return h.hexdigest()
+
+def _mysql_command(mysql_args, database_name):
+    return 'mysql --user={} --password={} --host {} --port {} --init-command="SET SESSION FOREIGN_KEY_CHECKS=0;" --one-database {}'.format(mysql_args['user'], mysql_args['passwd'], mysql_args['host'], mysql_args['port'], database_name)
+
+def _load_sections(mysql_args, sections, database_names):
+    """Pipe each section into the scratch database of its database."""
+    for (database, table), section in sections.items():
+        process = subprocess.Popen(_mysql_command(mysql_args, database_names[database]), shell=True, stdin=subprocess.PIPE)
+        process.communicate(section)
+
+# The join queries of the backup tables, run by the mysql and sqlite backends.
+# Older blazar schemas keep capability_name in computehost_extra_capabilities;
+# newer ones refer to extra_capabilities through capability_id.  Ties are
+# ordered by id, the order rows are dumped in, since later rows of a node
+# override earlier ones.
+BAREMETAL_EVENTS_SQL_OLD = '''
+                           SELECT c.created_at AS create_date, e.created_at, e.updated_at, i.updated_at, i.uuid AS node_id, i.maintenance, e.capability_name, e.capability_value
+                           FROM {ironic_database_name}.nodes AS i
+                           JOIN {blazar_database_name}.computehosts AS c ON i.uuid = c.hypervisor_hostname
+                           JOIN {blazar_database_name}.computehost_extra_capabilities AS e ON e.computehost_id = c.id
+                           WHERE capability_name IN ({properties})
+                           ORDER BY node_id, c.id, i.id, e.id
+                           '''
+BAREMETAL_EVENTS_SQL_NEW = '''
+                           SELECT c.created_at AS create_date, ce.created_at, ce.updated_at, i.updated_at, i.uuid AS node_id, i.maintenance, e.capability_name, ce.capability_value
+                           FROM {ironic_database_name}.nodes AS i
+                           JOIN {blazar_database_name}.computehosts AS c ON i.uuid = c.hypervisor_hostname
+                           JOIN {blazar_database_name}.computehost_extra_capabilities AS ce ON ce.computehost_id = c.id
+                           JOIN {blazar_database_name}.extra_capabilities AS e ON e.id = ce.capability_id
+                           WHERE capability_name IN ({properties})
+                           ORDER BY node_id, c.id, i.id, ce.id
+                           '''
+VM_EVENTS_SQL = '''
+                SELECT cn.created_at AS created_at, cn.updated_at AS node_updated_at, 
+                cn.deleted_at AS deleted_at, s.updated_at AS service_updated_at,
+                s.disabled AS disabled, `binary`, hypervisor_hostname, vcpus, memory_mb, local_gb
+                FROM {database_name}.compute_nodes AS cn
+                LEFT JOIN {database_name}.services AS s
+                ON cn.host = s.host
+                ORDER BY cn.id, s.id
+                '''
+
+def _baremetal_events_sql(template, ironic_database_name, blazar_database_name):
+    return template.format(ironic_database_name=ironic_database_name,
+                           blazar_database_name=blazar_database_name,
+                           properties=','.join("'{}'".format(p) for p in BAREMETAL_PROPERTIES))
+
+def _add_baremetal_events(machine_events, rows):
+    """Add the events of the baremetal join rows (create_date, property
+    created_at, property updated_at, node updated_at, node_id, maintenance,
+    capability_name, capability_value), ordered by node_id."""
+    prev_node = None
+    prev_create_time = None
+    property_update_times = []
+    property_collections = {}
+    # a node's maintenance events are complete once its last row is read
+    node_maintenance_events = {}
+    for row in rows:
+        create_time = row[0]
+        property_create_time = row[1]
+        property_update_time = row[2]
+        node_update_time = row[3]
+        node_id = row[4]
+        is_maint = row[5] == 1
+        property_name = row[6]
+        property_value = row[7]
+            
+        if prev_node and prev_node != node_id:
+            machine_events.update(node_maintenance_events)
+            node_maintenance_events = {}
+            # create event
+            machine_events[(prev_create_time, prev_node, 'CREATE')] = property_collections
+            # update event
+            machine_events[(max(property_update_times), prev_node, 'UPDATE')] = property_collections
+                
+            property_update_times = []
+            property_collections = {}
+            
+        prev_node = node_id
+        prev_create_time = create_time
+        property_collections[property_name] = property_value
+        property_update_times.append(property_create_time)
+        if property_update_time: property_update_times.append(property_update_time)
+            
+        # disable event (maintenance)
+        if is_maint:
+            maint_key = (node_update_time, node_id, 'DISABLE')
+        # enable event (not maintenance)
+        else:
+            maint_key = (node_update_time, node_id, 'ENABLE')
+        if maint_key not in node_maintenance_events:
+            node_maintenance_events[maint_key] = {}
+        node_maintenance_events[maint_key][property_name] = property_value
+    machine_events.update(node_maintenance_events)
+    # create event
+    machine_events[(prev_create_time, prev_node, 'CREATE')] = property_collections
+    # update event
+    machine_events[(max(property_update_times), prev_node, 'UPDATE')] = property_collections
+
+def get_machine_event_baremetal(mysql_args, sections, tmp_sql_file_name):
+    machine_events = MachineEventTable() # key is tuple (event_time, host_name, event)
     hosts = set()
     db = mysql.MySqlShim(**mysql_args)
     
@@ -79,60 +378,10 @@ def get_machine_event_baremetal(mysql_args, tmp_path, tmp_sql_file_name):
     db.cursor.execute('DROP DATABASE IF EXISTS {}'.format(blazar_tmp_database_name))
     db.cursor.execute('CREATE DATABASE {}'.format(blazar_tmp_database_name)) 
         
-    tmp_ironic_database_sql_file_name = 'ironic_{}'.format(tmp_sql_file_name)
-    tmp_blazar_database_sql_file_name = 'blazar_{}'.format(tmp_sql_file_name)
-    
-    process_extract_ironic_database = subprocess.Popen("sed -n -e '/^USE `ironic`/,/^USE/p' {} > {}".format(os.path.join(tmp_path, tmp_sql_file_name), os.path.join(tmp_path, tmp_ironic_database_sql_file_name)), shell=True)
-    process_extract_ironic_database.wait()
-    process_extract_ironic_database = subprocess.Popen("sed -n -e '/^USE `blazar`/,/^USE/p' {} > {}".format(os.path.join(tmp_path, tmp_sql_file_name), os.path.join(tmp_path, tmp_blazar_database_sql_file_name)), shell=True)
-    process_extract_ironic_database.wait()
-        
-    tmp_ironic_node_table_sql_file_name = 'ironic_nodes_{}'.format(tmp_sql_file_name)
-    process_extract_node_table = subprocess.Popen("sed -n -e '/DROP TABLE.*`nodes`/,/UNLOCK TABLES/p' {} > {}".format(os.path.join(tmp_path, tmp_ironic_database_sql_file_name), os.path.join(tmp_path, tmp_ironic_node_table_sql_file_name)), shell=True)
-    process_extract_node_table.wait()
-    process_ironic = subprocess.Popen('mysql --user={} --password={} --host {} --port {} --init-command="SET SESSION FOREIGN_KEY_CHECKS=0;" --one-database {} < {}'.format(mysql_args['user'], mysql_args['passwd'], mysql_args['host'], mysql_args['port'], ironic_tmp_database_name, os.path.join(tmp_path, tmp_ironic_node_table_sql_file_name)), shell=True)
-    process_ironic.wait()
-    
-    tmp_blazar_computehosts_table_sql_file_name = 'blazar_computehosts_{}'.format(tmp_sql_file_name)
-    process_extract_computehosts_table = subprocess.Popen("sed -n -e '/DROP TABLE.*`computehosts`/,/UNLOCK TABLES/p' {} > {}".format(os.path.join(tmp_path, tmp_blazar_database_sql_file_name), os.path.join(tmp_path, tmp_blazar_computehosts_table_sql_file_name)), shell=True)
-    process_extract_computehosts_table.wait()
-    process_blazar = subprocess.Popen('mysql --user={} --password={} --host {} --port {} --init-command="SET SESSION FOREIGN_KEY_CHECKS=0;" --one-database {} < {}'.format(mysql_args['user'], mysql_args['passwd'], mysql_args['host'], mysql_args['port'], blazar_tmp_database_name, os.path.join(tmp_path, tmp_blazar_computehosts_table_sql_file_name)), shell=True)
-    process_blazar.wait()
-    
-    tmp_blazar_computehost_extra_capabilities_table_sql_file_name = 'blazar_computehost_extra_capabilities_{}'.format(tmp_sql_file_name)
-    process_extract_computehost_extra_capabilities_table = subprocess.Popen("sed -n -e '/DROP TABLE.*`computehost_extra_capabilities`/,/UNLOCK TABLES/p' {} > {}".format(os.path.join(tmp_path, tmp_blazar_database_sql_file_name), os.path.join(tmp_path, tmp_blazar_computehost_extra_capabilities_table_sql_file_name)), shell=True)
-    process_extract_computehost_extra_capabilities_table.wait()
-    process_blazar = subprocess.Popen('mysql --user={} --password={} --host {} --port {} --init-command="SET SESSION FOREIGN_KEY_CHECKS=0;" --one-database {} < {}'.format(mysql_args['user'], mysql_args['passwd'], mysql_args['host'], mysql_args['port'], blazar_tmp_database_name, os.path.join(tmp_path, tmp_blazar_computehost_extra_capabilities_table_sql_file_name)), shell=True)
-    process_blazar.wait()
+    _load_sections(mysql_args, sections, {'ironic': ironic_tmp_database_name, 'blazar': blazar_tmp_database_name})
     
-    tmp_blazar_extra_capabilities_table_sql_file_name = 'blazar_extra_capabilities_{}'.format(tmp_sql_file_name)
-    process_extract_extra_capabilities_table = subprocess.Popen("sed -n -e '/DROP TABLE.*`extra_capabilities`/,/UNLOCK TABLES/p' {} > {}".format(os.path.join(tmp_path, tmp_blazar_database_sql_file_name), os.path.join(tmp_path, tmp_blazar_extra_capabilities_table_sql_file_name)), shell=True)
-    process_extract_extra_capabilities_table.wait()
-    process_blazar = subprocess.Popen('mysql --user={} --password={} --host {} --port {} --init-command="SET SESSION FOREIGN_KEY_CHECKS=0;" --one-database {} < {}'.format(mysql_args['user'], mysql_args['passwd'], mysql_args['host'], mysql_args['port'], blazar_tmp_database_name, os.path.join(tmp_path, tmp_blazar_extra_capabilities_table_sql_file_name)), shell=True)
-    process_blazar.wait()
-    
-    extract_data_sql_old = '''
-                           SELECT c.created_at AS create_date, e.created_at, e.updated_at, i.updated_at, i.uuid AS node_id, i.maintenance, e.capability_name, e.capability_value
-                           FROM {ironic_database_name}.nodes AS i
-                           JOIN {blazar_database_name}.computehosts AS c ON i.uuid = c.hypervisor_hostname
-                           JOIN {blazar_database_name}.computehost_extra_capabilities AS e ON e.computehost_id = c.id
-                           WHERE capability_name IN ({properties})
-                           ORDER BY node_id
-                           '''.format(ironic_database_name=ironic_tmp_database_name, 
-                                      blazar_database_name=blazar_tmp_database_name, 
-                                      properties=','.join("'{}'".format(p) for p in BAREMETAL_PROPERTIES))
-                           
-    extract_data_sql_new = '''
-                           SELECT c.created_at AS create_date, ce.created_at, ce.updated_at, i.updated_at, i.uuid AS node_id, i.maintenance, e.capability_name, ce.capability_value
-                           FROM {ironic_database_name}.nodes AS i
-                           JOIN {blazar_database_name}.computehosts AS c ON i.uuid = c.hypervisor_hostname
-                           JOIN {blazar_database_name}.computehost_extra_capabilities AS ce ON ce.computehost_id = c.id
-                           JOIN {blazar_database_name}.extra_capabilities AS e ON e.id = ce.capability_id
-                           WHERE capability_name IN ({properties})
-                           ORDER BY node_id
-                           '''.format(ironic_database_name=ironic_tmp_database_name, 
-                                      blazar_database_name=blazar_tmp_database_name, 
-                                      properties=','.join("'{}'".format(p) for p in BAREMETAL_PROPERTIES))
+    extract_data_sql_old = _baremetal_events_sql(BAREMETAL_EVENTS_SQL_OLD, ironic_tmp_database_name, blazar_tmp_database_name)
+    extract_data_sql_new = _baremetal_events_sql(BAREMETAL_EVENTS_SQL_NEW, ironic_tmp_database_name, blazar_tmp_database_name)
     
                        
     try:
@@ -140,48 +389,7 @@ def get_machine_event_baremetal(mysql_args, tmp_path, tmp_sql_file_name):
             db.cursor.execute(extract_data_sql_old)
         except:
             db.cursor.execute(extract_data_sql_new)
-        prev_node = None
-        prev_create_time = None
-        property_update_times = []
-        property_collections = {}
-        for row in db.cursor:
-            create_time = row[0]
-            property_create_time = row[1]
-            property_update_time = row[2]
-            node_update_time = row[3]
-            node_id = row[4]
-            is_maint = row[5] == 1
-            property_name = row[6]
-            property_value = row[7]
-            
-            if prev_node and prev_node != node_id:
-                # create event
-                machine_events[(prev_create_time, prev_node, 'CREATE')] = property_collections
-                # update event
-                machine_events[(max(property_update_times), prev_node, 'UPDATE')] = property_collections
-                
-                property_update_times = []
-                property_collections = {}
-            
-            prev_node = node_id
-            prev_create_time = create_time
-            property_collections[property_name] = property_value
-            property_update_times.append(property_create_time)
-            if property_update_time: property_update_times.append(property_update_time)
-            
-            # disable event (maintenance)
-            if is_maint:
-                maint_key = (node_update_time, node_id, 'DISABLE')
-            # enable event (not maintenance)
-            else:
-                maint_key = (node_update_time, node_id, 'ENABLE')
-            if maint_key not in machine_events:
-                machine_events[maint_key] = {}
-            machine_events[maint_key][property_name] = property_value
-        # create event
-        machine_events[(prev_create_time, prev_node, 'CREATE')] = property_collections
-        # update event
-        machine_events[(max(property_update_times), prev_node, 'UPDATE')] = property_collections
+        _add_baremetal_events(machine_events, db.cursor)
     except:
         LOG.exception("Failed to extract data from OpenStack databases")
                 
@@ -191,76 +399,71 @@ def get_machine_event_baremetal(mysql_args, tmp_path, tmp_sql_file_name):
     
     return machine_events, hosts
     
-def get_machine_event_vm(mysql_args, tmp_path, tmp_sql_file_name):
-    machine_events = {} # key is tuple (event_time, host_name, event)
+def _add_vm_events(machine_events, hosts, rows):
+    """Add the events of the vm join rows (created_at, node_updated_at,
+    deleted_at, service_updated_at, disabled, binary, hypervisor_hostname,
+    vcpus, memory_mb, local_gb) and collect their hosts."""
+    for row in rows:
+        create_time = row[0]
+        node_update_time = row[1]
+        delete_time = row[2]
+        service_update_time = row[3]
+        disabled = row[4] == 1
+        binary = row[5]
+        hostname = row[6]
+        vcpus = row[7]
+        memory = row[8]
+        disk = row[9]
+                
+        if not binary or binary != NOVA_COMPUTE_HOST_BINARY:
+            continue
+        rack = 'UNKNOWN'
+        if RACK_EXTRACTOR['hypervisor_hostname_regex'] and RACK_EXTRACTOR['rack_extract_group']:
+            m = re.search(RACK_EXTRACTOR['hypervisor_hostname_regex'], row[6])
+            if m:
+                rack = m.group(RACK_EXTRACTOR['rack_extract_group'])
+        content = {'rack': rack,
+                   'vcpu_capability': vcpus,
+                   'memory_capability_mb': memory,
+                   'disk_capability_gb': disk}
+                    
+        # create event
+        machine_events[(create_time, hostname, 'CREATE')] = content
+        # update event
+        machine_events[(node_update_time, hostname, 'UPDATE')] = content
+        # delete event
+        if delete_time:
+            machine_events[(delete_time, hostname, 'DELETE')] = {}
+        # disable event
+        if disabled:
+            machine_events[(service_update_time, hostname, 'DISABLE')] = content
+        # enable event
+        else:
+            machine_events[(service_update_time, hostname, 'ENABLE')] = content
+        hosts.add(hostname)
+
+def get_machine_event_vm(mysql_args, sections, tmp_sql_file_name):
+    machine_events = MachineEventTable() # key is tuple (event_time, host_name, event)
     hosts = set()
     db = mysql.MySqlShim(**mysql_args)
     
+    nova_tmp_database_names = {}
     for database in NOVA_DATABASES:
         nova_tmp_database_name = 'kvm_{}_backup_{}'.format(database, os.path.basename(tmp_sql_file_name).split('.')[0])
                 
         db.cursor.execute('DROP DATABASE IF EXISTS {}'.format(nova_tmp_database_name))
         db.cursor.execute('CREATE DATABASE {}'.format(nova_tmp_database_name)) 
+        nova_tmp_database_names[database] = nova_tmp_database_name
+    
+    _load_sections(mysql_args, sections, nova_tmp_database_names)
+    
+    for database in NOVA_DATABASES:
+        nova_tmp_database_name = nova_tmp_database_names[database]
         
-        tmp_database_sql_file_name = '{}_{}'.format(database, tmp_sql_file_name)
-        process_extract_database = subprocess.Popen("sed -n -e '/^USE `{}`/,/^USE/p' {} > {}".format(database, os.path.join(tmp_path, tmp_sql_file_name), os.path.join(tmp_path, tmp_database_sql_file_name)), shell=True)
-        process_extract_database.wait()
-        
-        for table in ['compute_nodes', 'services']: 
-            tmp_table_sql_file_name = '{}_{}'.format(table, tmp_sql_file_name)
-            process_extract_table = subprocess.Popen("sed -n -e '/DROP TABLE.*`{}`/,/UNLOCK TABLES/p' {} > {}".format(table, os.path.join(tmp_path, tmp_database_sql_file_name), os.path.join(tmp_path, tmp_table_sql_file_name)), shell=True)
-            process_extract_table.wait()
-            process_nova = subprocess.Popen('mysql --user={} --password={} --host {} --port {} --init-command="SET SESSION FOREIGN_KEY_CHECKS=0;" --one-database {} < {}'.format(mysql_args['user'], mysql_args['passwd'], mysql_args['host'], mysql_args['port'], nova_tmp_database_name, os.path.join(tmp_path, tmp_table_sql_file_name)), shell=True)
-            process_nova.wait()
-        
-        extract_data_sql = '''
-                           SELECT cn.created_at AS created_at, cn.updated_at AS node_updated_at, 
-                           cn.deleted_at AS deleted_at, s.updated_at AS service_updated_at,
-                           s.disabled AS disabled, `binary`, hypervisor_hostname, vcpus, memory_mb, local_gb
-                           FROM {database_name}.compute_nodes AS cn
-                           LEFT JOIN {database_name}.services AS s
-                           ON cn.host = s.host
-                           '''.format(database_name = nova_tmp_database_name)
+        extract_data_sql = VM_EVENTS_SQL.format(database_name=nova_tmp_database_name)
         try:
             db.cursor.execute(extract_data_sql)
-            for row in db.cursor:
-                create_time = row[0]
-                node_update_time = row[1]
-                delete_time = row[2]
-                service_update_time = row[3]
-                disabled = row[4] == 1
-                binary = row[5]
-                hostname = row[6]
-                vcpus = row[7]
-                memory = row[8]
-                disk = row[9]
-                
-                if not binary or binary != NOVA_COMPUTE_HOST_BINARY:
-                    continue
-                rack = 'UNKNOWN'
-                if RACK_EXTRACTOR['hypervisor_hostname_regex'] and RACK_EXTRACTOR['rack_extract_group']:
-                    m = re.search(RACK_EXTRACTOR['hypervisor_hostname_regex'], row[6])
-                    if m:
-                        rack = m.group(RACK_EXTRACTOR['rack_extract_group'])
-                content = {'rack': rack,
-                           'vcpu_capability': vcpus,
-                           'memory_capability_mb': memory,
-                           'disk_capability_gb': disk}
-                    
-                # create event
-                machine_events[(create_time, hostname, 'CREATE')] = content
-                # update event
-                machine_events[(node_update_time, hostname, 'UPDATE')] = content
-                # delete event
-                if delete_time:
-                    machine_events[(delete_time, hostname, 'DELETE')] = {}
-                # disable event
-                if disabled:
-                    machine_events[(service_update_time, hostname, 'DISABLE')] = content
-                # enable event
-                else:
-                    machine_events[(service_update_time, hostname, 'ENABLE')] = content
-                hosts.add(hostname)
+            _add_vm_events(machine_events, hosts, db.cursor)
         except:
             LOG.exception("Failed to extract data from {}".format(nova_tmp_database_name))
                 
@@ -269,64 +472,225 @@ def get_machine_event_vm(mysql_args, tmp_path, tmp_sql_file_name):
     
     return machine_events, hosts
 
-def get_machine_events_from_parquet_vm(data_dir):
-    machine_events = {} # key is tuple (event_time, host_name, event)
+def _vm_dump_rows(compute_nodes, services):
+    """In-memory counterpart of the vm join query: compute_nodes LEFT JOIN
+    services ON host."""
+    services_by_host = {}
+    for service in services:
+        if service['host'] is not None:
+            services_by_host.setdefault(service['host'], []).append(service)
+    for node in compute_nodes:
+        for service in services_by_host.get(node['host']) or [{}]:
+            yield (node['created_at'], node['updated_at'], node['deleted_at'], service.get('updated_at'),
+                   service.get('disabled'), service.get('binary'), node['hypervisor_hostname'],
+                   node['vcpus'], node['memory_mb'], node['local_gb'])
+
+def _baremetal_dump_rows(nodes, computehosts, computehost_extra_capabilities, extra_capabilities=None):
+    """In-memory counterpart of the baremetal join query, ordered by node_id.
+
+    Older blazar schemas keep capability_name in computehost_extra_capabilities;
+    newer ones refer to extra_capabilities through capability_id.
+    """
+    nodes_by_uuid = {}
+    for node in nodes:
+        nodes_by_uuid.setdefault(node['uuid'], []).append(node)
+    capabilities_by_host = {}
+    for capability in computehost_extra_capabilities:
+        capabilities_by_host.setdefault(capability['computehost_id'], []).append(capability)
+    capability_names = None
+    if computehost_extra_capabilities and 'capability_name' not in computehost_extra_capabilities[0]:
+        if extra_capabilities is None:
+            raise ValueError('computehost_extra_capabilities has no capability_name and there is no extra_capabilities table')
+        capability_names = {e['id']: e['capability_name'] for e in extra_capabilities}
+    properties = set(BAREMETAL_PROPERTIES)
+
+    rows = []
+    for host in computehosts:
+        for node in nodes_by_uuid.get(host['hypervisor_hostname'], []):
+            for capability in capabilities_by_host.get(host['id'], []):
+                if capability_names is None:
+                    name = capability['capability_name']
+                else:
+                    name = capability_names.get(capability['capability_id'])
+                if name not in properties:
+                    continue
+                rows.append((host['created_at'], capability['created_at'], capability['updated_at'], node['updated_at'],
+                             node['uuid'], node['maintenance'], name, capability['capability_value']))
+    rows.sort(key=lambda row: row[4])
+    return rows
+
+def _parse_sections(sections, tables, backup_file, columns=None):
+    """The rows of *tables* parsed from their sections (see
+    sqldump.read_tables), or None if they can't be parsed."""
+    lines = []
+    for database, table in tables:
+        if (database, table) in sections:
+            lines.append('USE `{}`;\n'.format(database).encode('utf-8'))
+            lines.extend(io.BytesIO(sections[(database, table)]))
+    try:
+        return sqldump.read_tables(lines, tables, columns)
+    except:
+        LOG.exception("Failed to parse the tables of {}".format(backup_file))
+        return None
+
+def get_machine_event_from_sections(sections, tables, instance_type, backup_file):
+    """The mysql backend's join queries done in memory, on the tables parsed
+    from their sections.  Returns (None, None) if they can't be parsed."""
+    tables = _parse_sections(sections, tables, backup_file)
+    if tables is None:
+        return None, None
+
+    machine_events = MachineEventTable() # key is tuple (event_time, host_name, event)
     hosts = set()
-    
+    if instance_type == 'vm':
+        for database in NOVA_DATABASES:
+            try:
+                _add_vm_events(machine_events, hosts, _vm_dump_rows(
+                    tables[(database, 'compute_nodes')], tables[(database, 'services')]))
+            except:
+                LOG.exception("Failed to extract data from {} in {}".format(database, backup_file))
+    else:
+        try:
+            _add_baremetal_events(machine_events, _baremetal_dump_rows(
+                tables[('ironic', 'nodes')], tables[('blazar', 'computehosts')],
+                tables[('blazar', 'computehost_extra_capabilities')], tables.get(('blazar', 'extra_capabilities'))))
+        except:
+            LOG.exception("Failed to extract data from OpenStack databases in {}".format(backup_file))
+
+    return machine_events, hosts
+
+def _sqlite_value(value):
+    """*value* as stored in the sqlite backend's tables: times, dates and
+    decimals as text, which sqlite3 would otherwise need process-wide
+    adapters for."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+def _sqlite_rows(cursor):
+    """Rows of a join query run by the sqlite backend, with the four times
+    every join query selects first parsed back from text."""
+    for row in cursor:
+        yield tuple(datetime.datetime.fromisoformat(value) if isinstance(value, str) else value
+                    for value in row[:4]) + row[4:]
+
+def _sqlite_database(tables, columns):
+    """In-memory SQLite database with the parsed tables, each in an attached
+    database named like its MySQL database so the join queries run as is."""
+    db = sqlite3.connect(':memory:')
+    for database in sorted({database for database, _ in columns}):
+        db.execute('ATTACH DATABASE ? AS "{}"'.format(database), (':memory:',))
+    for (database, table), table_columns in columns.items():
+        names = [name for name, _ in table_columns]
+        db.execute('CREATE TABLE "{}"."{}" ({})'.format(
+            database, table, ', '.join('"{}" {}'.format(name, column_type) for name, column_type in table_columns)))
+        db.executemany('INSERT INTO "{}"."{}" VALUES ({})'.format(database, table, ', '.join('?' * len(names))),
+                       ([_sqlite_value(row.get(name)) for name in names] for row in tables.get((database, table), [])))
+    return db
+
+def get_machine_event_sqlite(sections, tables, instance_type, backup_file):
+    """The mysql backend's join queries run in an in-memory SQLite database
+    instead of a MySQL server, on the tables parsed from their sections.
+    Returns (None, None) if they can't be parsed."""
+    columns = {}
+    tables = _parse_sections(sections, tables, backup_file, columns)
+    if tables is None:
+        return None, None
+
+    machine_events = MachineEventTable() # key is tuple (event_time, host_name, event)
+    hosts = set()
+    db = _sqlite_database(tables, columns)
+    try:
+        if instance_type == 'vm':
+            for database in NOVA_DATABASES:
+                try:
+                    _add_vm_events(machine_events, hosts, _sqlite_rows(db.execute(VM_EVENTS_SQL.format(database_name=database))))
+                except:
+                    LOG.exception("Failed to extract data from {} in {}".format(database, backup_file))
+        else:
+            try:
+                try:
+                    rows = db.execute(_baremetal_events_sql(BAREMETAL_EVENTS_SQL_OLD, 'ironic', 'blazar'))
+                except sqlite3.OperationalError:
+                    rows = db.execute(_baremetal_events_sql(BAREMETAL_EVENTS_SQL_NEW, 'ironic', 'blazar'))
+                _add_baremetal_events(machine_events, _sqlite_rows(rows))
+            except:
+                LOG.exception("Failed to extract data from OpenStack databases in {}".format(backup_file))
+    finally:
+        db.close()
+
+    return machine_events, hosts
+
+def _payload_column(df, name):
+    """Payload column *name* of *df*, all None if no payload had the key."""
+    if name in df.columns:
+        return df[name]
+    return pd.Series(None, index=df.index, dtype=object)
+
+
+def _racks(hostnames):
+    """Rack of each hypervisor host name, extracted with one regex pass;
+    'UNKNOWN' where the name doesn't match or no regex is configured."""
+    if not (RACK_EXTRACTOR['hypervisor_hostname_regex'] and RACK_EXTRACTOR['rack_extract_group']):
+        return pd.Series('UNKNOWN', index=hostnames.index, dtype=object)
+    hostnames = hostnames.astype(str)
+    with warnings.catch_warnings():
+        # str.contains warns about the capture groups, which are what we want
+        warnings.simplefilter('ignore', UserWarning)
+        # re.search semantics: the match may start anywhere in the name
+        matched = hostnames.str.contains(RACK_EXTRACTOR['hypervisor_hostname_regex'], regex=True)
+    groups = hostnames.str.extract(RACK_EXTRACTOR['hypervisor_hostname_regex'], expand=True)
+    rack = groups[groups.columns[RACK_EXTRACTOR['rack_extract_group'] - 1]].astype(object)
+    # a matched name whose rack group took no part in the match has rack None
+    return rack.where(rack.notna(), None).where(matched, 'UNKNOWN')
+
+
+def get_machine_events_from_parquet_vm(data_dir):
+    machine_events = MachineEventTable() # key is tuple (event_time, host_name, event)
+
     # 1. Load services audit
     services_path = os.path.join(data_dir, 'openstack_audit.audit_nova_services.parquet')
-    df_services = pd.read_parquet(services_path)
-    s_rows = []
-    for _, row in df_services.iterrows():
-        payload = json.loads(row['data'])
-        if payload.get('binary') == NOVA_COMPUTE_HOST_BINARY:
-            audit_ts = row['audit_changed_at']
-            audit_time = audit_ts.to_pydatetime() if isinstance(audit_ts, pd.Timestamp) else dateparse(str(audit_ts))
-            audit_time = audit_time.replace(tzinfo=None)
-            s_rows.append({
-                'host': payload.get('host'),
-                'service_updated_at': audit_time, 
-                'disabled': payload.get('disabled') == 1,
-            })
-    df_s = pd.DataFrame(s_rows)
+    services = _read_and_load_parquet(services_path, NOVA_SERVICE_FIELDS)
+    services = services[_payload_column(services, 'binary') == NOVA_COMPUTE_HOST_BINARY]
+    df_s = pd.DataFrame({
+        'host': _payload_column(services, 'host'),
+        'service_updated_at': services['audit_changed_at'],
+        'disabled': _payload_column(services, 'disabled') == 1,
+    })
     if not df_s.empty:
         df_s.sort_values('service_updated_at', inplace=True)
-            
+
     # 2. Load compute nodes audit
     cn_path = os.path.join(data_dir, 'openstack_audit.audit_nova_compute_nodes.parquet')
-    df_cn = pd.read_parquet(cn_path)
-    cn_rows = []
-    for _, row in df_cn.iterrows():
-        payload = json.loads(row['data'])
-        audit_ts = row['audit_changed_at']
-        audit_time = audit_ts.to_pydatetime() if isinstance(audit_ts, pd.Timestamp) else dateparse(str(audit_ts))
-        audit_time = audit_time.replace(tzinfo=None)
-        
-        host = payload.get('hypervisor_hostname') or payload.get('host')
-        
-        created_at_payload = payload.get('created_at')
-        created_at = dateparse(created_at_payload).replace(tzinfo=None) if created_at_payload else audit_time
-        
-        deleted_at_payload = payload.get('deleted_at')
-        if deleted_at_payload:
-            deleted_at = dateparse(deleted_at_payload).replace(tzinfo=None)
-        else:
-            deleted_at = audit_time if row['audit_event_type'] == 'DELETE' else None
-                
-        cn_rows.append({
-            'node_updated_at': audit_time,
-            'created_at': created_at,
-            'deleted_at': deleted_at,
-            'host': host,
-            'vcpus': payload.get('vcpus'),
-            'memory_mb': payload.get('memory_mb'),
-            'local_gb': payload.get('local_gb'),
-        })
-        
-    df_cn_parsed = pd.DataFrame(cn_rows)
+    cn = _read_and_load_parquet(cn_path, NOVA_COMPUTE_NODE_FIELDS)
+    audit_time = cn['audit_changed_at']
+
+    hypervisor_hostname = _payload_column(cn, 'hypervisor_hostname')
+    host = hypervisor_hostname.where(hypervisor_hostname.notna() & (hypervisor_hostname != ''),
+                                     _payload_column(cn, 'host'))
+
+    # created_at/deleted_at from the payload when set, else from the audit row
+    created_at = audit.naive_datetimes(_payload_column(cn, 'created_at'))
+    created_at = created_at.where(created_at.notna(), audit_time)
+    deleted_at = audit.naive_datetimes(_payload_column(cn, 'deleted_at'))
+    deleted_at = deleted_at.where(deleted_at.notna(), audit_time.where(cn['audit_event_type'] == 'DELETE'))
+
+    df_cn_parsed = pd.DataFrame({
+        'node_updated_at': audit_time,
+        'created_at': created_at,
+        'deleted_at': deleted_at,
+        'host': host,
+        'vcpus': _payload_column(cn, 'vcpus'),
+        'memory_mb': _payload_column(cn, 'memory_mb'),
+        'local_gb': _payload_column(cn, 'local_gb'),
+    })
     if not df_cn_parsed.empty:
         df_cn_parsed.sort_values('node_updated_at', inplace=True)
-        
+
     # Pandas equivalent of a LEFT JOIN on host over time
     if not df_cn_parsed.empty and not df_s.empty:
         df_joined = pd.merge_asof(
@@ -337,49 +701,37 @@ def get_machine_events_from_parquet_vm(data_dir):
     else:
         df_joined = df_cn_parsed
         df_joined['disabled'] = False
-        df_joined['service_updated_at'] = None
-        
-    for _, row in df_joined.iterrows():
-        create_time = row.get('created_at')
-        node_update_time = row.get('node_updated_at')
-        delete_time = row.get('deleted_at')
-        service_update_time = row.get('service_updated_at')
-        disabled = row.get('disabled')
-        hostname = row.get('host')
-        vcpus = row.get('vcpus')
-        memory = row.get('memory_mb')
-        disk = row.get('local_gb')
-        
-        if not hostname:
-            continue
-            
-        rack = 'UNKNOWN'
-        if RACK_EXTRACTOR['hypervisor_hostname_regex'] and RACK_EXTRACTOR['rack_extract_group']:
-            m = re.search(RACK_EXTRACTOR['hypervisor_hostname_regex'], hostname)
-            if m:
-                rack = m.group(RACK_EXTRACTOR['rack_extract_group'])
-                
-        content = {
-            'rack': rack,
-            'vcpu_capability': vcpus,
-            'memory_capability_mb': memory,
-            'disk_capability_gb': disk
-        }
-            
-        # Identical to original extraction loop
-        machine_events[(create_time, hostname, 'CREATE')] = content
-        machine_events[(node_update_time, hostname, 'UPDATE')] = content
-        if pd.notnull(delete_time):
-            machine_events[(delete_time, hostname, 'DELETE')] = {}
-        if disabled:
-            if pd.notnull(service_update_time):
-                machine_events[(service_update_time, hostname, 'DISABLE')] = content
-        else:
-            if pd.notnull(service_update_time):
-                machine_events[(service_update_time, hostname, 'ENABLE')] = content
-                
-        hosts.add(hostname)
-        
+        df_joined['service_updated_at'] = pd.NaT
+
+    hostname = df_joined['host']
+    df_joined = df_joined[hostname.notna() & (hostname != '')].reset_index(drop=True)
+    hosts = set(df_joined['host'])
+
+    contents = [{'rack': rack, 'vcpu_capability': vcpus, 'memory_capability_mb': memory, 'disk_capability_gb': disk}
+                for rack, vcpus, memory, disk in zip(_racks(df_joined['host']).tolist(), df_joined['vcpus'].tolist(),
+                                                     df_joined['memory_mb'].tolist(), df_joined['local_gb'].tolist())]
+
+    # One frame of candidate events: per compute node row a CREATE, an
+    # UPDATE, a DELETE if it was deleted and an ENABLE or DISABLE if its
+    # service is known.  Sorting by (row, kind) reproduces the order a
+    # row-by-row loop would insert them in.
+    row = pd.RangeIndex(len(df_joined))
+    service_known = df_joined['service_updated_at'].notna()
+    events = pd.concat([
+        pd.DataFrame({'row': row, 'kind': 0, 'time': df_joined['created_at'], 'event': 'CREATE'}),
+        pd.DataFrame({'row': row, 'kind': 1, 'time': df_joined['node_updated_at'], 'event': 'UPDATE'}),
+        pd.DataFrame({'row': row, 'kind': 2, 'time': df_joined['deleted_at'], 'event': 'DELETE'})[
+            df_joined['deleted_at'].notna()],
+        pd.DataFrame({'row': row, 'kind': 3, 'time': df_joined['service_updated_at'],
+                      'event': (df_joined['disabled'] == True).map({True: 'DISABLE', False: 'ENABLE'})})[service_known],
+    ]).sort_values(['row', 'kind'], kind='stable')
+
+    hostnames = df_joined['host'].tolist()
+    for r, kind, time, event in zip(events['row'].tolist(), events['kind'].tolist(),
+                                    events['time'].tolist(), events['event'].tolist()):
+        # later rows overwrite the content of an existing key but keep its position
+        machine_events[(time, hostnames[r], event)] = {} if kind == 2 else contents[r]
+
     return machine_events, hosts
 
 
@@ -390,44 +742,47 @@ def _parse_audit_timestamp(ts):
     return dateparse(str(ts)).replace(tzinfo=None)
 
 
-def _read_and_load_parquet(path):
-    """Read a parquet audit file and return a DataFrame with payload fields plus
-    audit_changed_at and audit_event_type preserved from the parquet row."""
-    df = pd.read_parquet(path)
-    rows = []
-    for _, row in df.iterrows():
-        payload = json.loads(row['data'])
-        payload['audit_changed_at'] = _parse_audit_timestamp(row['audit_changed_at'])
-        payload['audit_event_type'] = row['audit_event_type']
-        rows.append(payload)
-    return pd.DataFrame(rows)
-
+def _read_and_load_parquet(path, columns=None):
+    """Read a parquet audit file and return a DataFrame with payload fields
+    (only *columns*, if given) plus audit_changed_at and audit_event_type
+    preserved from the parquet row."""
+    df = audit.read_audit_parquet(path, columns=columns)
+    if pd.api.types.is_datetime64_any_dtype(df['audit_changed_at']):
+        if df['audit_changed_at'].dt.tz is not None:
+            df['audit_changed_at'] = df['audit_changed_at'].dt.tz_localize(None)
+    else:
+        df['audit_changed_at'] = df['audit_changed_at'].map(_parse_audit_timestamp)
+    return df
 
-def get_machine_events_from_parquet_baremetal(data_dir):
-    machine_events = {}  # key is tuple (event_time, node_id, event)
-    hosts = set()
 
+def _load_baremetal_audit(data_dir):
+    """Join the ironic node and blazar host/capability audit tables into one
+    row per (node audit row, capability audit row)."""
     nodes_path = os.path.join(data_dir, 'openstack_audit.audit_ironic_nodes.parquet')
     blazar_hosts_path = os.path.join(data_dir, 'openstack_audit.audit_blazar_computehosts.parquet')
     blazar_host_capabilities_path = os.path.join(data_dir, 'openstack_audit.audit_blazar_computehost_extra_capabilities.parquet')
     blazar_capabilities_path = os.path.join(data_dir, 'openstack_audit.audit_blazar_resource_properties.parquet')
 
-    nodes = _read_and_load_parquet(nodes_path)
-    blazar_hosts = _read_and_load_parquet(blazar_hosts_path)
-    blazar_host_capabilities = _read_and_load_parquet(blazar_host_capabilities_path)
-    blazar_capabilities = _read_and_load_parquet(blazar_capabilities_path)
+    nodes = _read_and_load_parquet(nodes_path, IRONIC_NODE_FIELDS)
+    blazar_hosts = _read_and_load_parquet(blazar_hosts_path, BLAZAR_HOST_FIELDS)
+    blazar_host_capabilities = _read_and_load_parquet(blazar_host_capabilities_path, BLAZAR_HOST_CAPABILITY_FIELDS)
+    blazar_capabilities = _read_and_load_parquet(blazar_capabilities_path, BLAZAR_PROPERTY_FIELDS)
+
+    # Name the blazar host columns up front; they no longer collide with
+    # ironic node columns now that only the needed payload keys are read.
+    blazar_hosts = blazar_hosts.rename(columns={'id': 'id_blazar_host', 'created_at': 'created_at_blazar_host'})
 
     # Filter capabilities to only the properties we care about (mirrors the SQL WHERE clause)
     blazar_capabilities = blazar_capabilities[blazar_capabilities['property_name'].isin(BAREMETAL_PROPERTIES)]
 
     # Join nodes -> blazar_hosts on uuid = hypervisor_hostname
-    # Suffixes avoid collisions on shared column names (created_at, updated_at, etc.)
+    # Suffixes avoid collisions on the shared audit columns
     df = pd.merge(nodes, blazar_hosts,
                   left_on='uuid', right_on='hypervisor_hostname',
                   suffixes=('_node', '_blazar_host'))
 
     # Join -> blazar_host_capabilities on computehost_id = blazar_hosts.id
-    # blazar_hosts.id came through as id_blazar_host after the previous merge
+    # blazar_hosts.id was renamed to id_blazar_host above
     df = pd.merge(df, blazar_host_capabilities,
                   left_on='id_blazar_host', right_on='computehost_id',
                   suffixes=('', '_blazar_cap'))
@@ -446,55 +801,66 @@ def get_machine_events_from_parquet_baremetal(data_dir):
     #                                                   used as the UPDATE event time)
     #   capability_name  -> property_name              (from resource_properties)
     #   capability_value -> capability_value            (from computehost_extra_capabilities)
+    return df
 
-    # Group by node so we can collect all properties and derive per-node event times,
-    # mirroring the SQL version's node-by-node loop.
-    for node_id, group in df.groupby('uuid'):
-        # CREATE time: created_at from blazar computehosts (equivalent to SQL create_date)
-        create_date_raw = group['created_at_blazar_host'].iloc[0]
-        if pd.isnull(create_date_raw):
-            create_date = None
-        elif isinstance(create_date_raw, str):
-            create_date = dateparse(create_date_raw).replace(tzinfo=None)
-        else:
-            create_date = create_date_raw
-
-        # UPDATE time: max audit_changed_at across all capability rows for this node
-        # (audit_changed_at is already a naive datetime, set by _read_and_load_parquet)
-        # After merges the capability audit timestamp is in audit_changed_at_cap
-        cap_audit_times = group['audit_changed_at_cap'].dropna()
-        update_time = cap_audit_times.max() if not cap_audit_times.empty else create_date
-
-        # Collect property dict for CREATE / UPDATE events
-        property_collections = {
-            row['property_name']: row['capability_value']
-            for _, row in group.iterrows()
-            if row['property_name'] in BAREMETAL_PROPERTIES
-        }
-
-        # Emit CREATE event
-        if create_date is not None:
-            machine_events[(create_date, node_id, 'CREATE')] = property_collections
-
-        # Emit UPDATE event
-        if update_time is not None:
-            machine_events[(update_time, node_id, 'UPDATE')] = property_collections
-
-        # Emit DISABLE / ENABLE events, one per distinct (node_updated_at, maintenance) pair.
-        # Each ironic audit row can have its own maintenance state at its own timestamp,
-        # so we deduplicate by (audit_changed_at_node, maintenance) to avoid overwriting
-        # events that were already written with the same key.
-        for _, row in group.drop_duplicates(subset=['audit_changed_at_node', 'maintenance']).iterrows():
-            node_update_time = row['audit_changed_at_node']
-            is_maint = row['maintenance'] == 1
-
-            event_type = 'DISABLE' if is_maint else 'ENABLE'
-            maint_key = (node_update_time, node_id, event_type)
-
-            # Mirror SQL version: only write the first occurrence of a given key
-            if maint_key not in machine_events:
-                machine_events[maint_key] = {}
-            # Accumulate properties onto the event (SQL version builds the dict incrementally)
-            machine_events[maint_key][row['property_name']] = row['capability_value']
+
+def get_machine_events_from_parquet_baremetal(data_dir):
+    machine_events = MachineEventTable()  # key is tuple (event_time, node_id, event)
+    hosts = set()
+
+    df = _load_baremetal_audit(data_dir)
+
+    # Everything the old node-by-node loop derived per node is computed with
+    # grouped aggregations instead, and the events are emitted in one pass.
+    df = df[df['uuid'].notna()]
+    node_ids = sorted(df['uuid'].unique())
+
+    # CREATE time: created_at from blazar computehosts (equivalent to SQL
+    # create_date) of the node's first row
+    first_rows = df.drop_duplicates(subset=['uuid'], keep='first').set_index('uuid')
+    create_dates = audit.naive_datetimes(first_rows['created_at_blazar_host'])
+
+    # UPDATE time: max audit_changed_at across all capability rows for this
+    # node, or the CREATE time if there are none.  After the merges the
+    # capability audit timestamp is in audit_changed_at_cap.
+    update_times = df.groupby('uuid')['audit_changed_at_cap'].max()
+    update_times = update_times.where(update_times.notna(), create_dates.reindex(update_times.index))
+
+    # Property dict for CREATE / UPDATE events: the last value of each
+    # property, in the order the properties first appear for the node
+    properties = df[df['property_name'].isin(BAREMETAL_PROPERTIES)]
+    first_seen = properties.drop_duplicates(subset=['uuid', 'property_name'], keep='first')
+    last_values = properties.drop_duplicates(subset=['uuid', 'property_name'], keep='last') \
+        .set_index(['uuid', 'property_name'])['capability_value']
+    last_values = last_values.reindex(pd.MultiIndex.from_frame(first_seen[['uuid', 'property_name']]))
+    property_collections = {node_id: {} for node_id in node_ids}
+    for (node_id, property_name), value in zip(last_values.index.tolist(), last_values.tolist()):
+        property_collections[node_id][property_name] = value
+
+    # DISABLE / ENABLE events, one per distinct (node_updated_at, maintenance)
+    # pair of a node.  Each ironic audit row can have its own maintenance
+    # state at its own timestamp.  The first row of each pair contributes its
+    # property, like the SQL version building the dict incrementally.
+    maintenance = df.drop_duplicates(subset=['uuid', 'audit_changed_at_node', 'maintenance']) \
+        .sort_values('uuid', kind='stable')
+    maintenance_rows = {}
+    for row in zip(maintenance['uuid'].tolist(), maintenance['audit_changed_at_node'].tolist(),
+                   (maintenance['maintenance'] == 1).tolist(), maintenance['property_name'].tolist(),
+                   maintenance['capability_value'].tolist()):
+        maintenance_rows.setdefault(row[0], []).append(row[1:])
+
+    for node_id in node_ids:
+        create_date = create_dates[node_id]
+        update_time = update_times[node_id]
+        if pd.notnull(create_date):
+            machine_events[(create_date, node_id, 'CREATE')] = property_collections[node_id]
+        if pd.notnull(update_time):
+            machine_events[(update_time, node_id, 'UPDATE')] = property_collections[node_id]
+        node_maintenance_events = {}
+        for node_update_time, is_maint, property_name, capability_value in maintenance_rows.get(node_id, []):
+            maint_key = (node_update_time, node_id, 'DISABLE' if is_maint else 'ENABLE')
+            # Mirror SQL version: only create the event on the first occurrence of a given key
+            node_maintenance_events.setdefault(maint_key, {})[property_name] = capability_value
+        machine_events.update(node_maintenance_events)
 
     return machine_events, hosts
\ No newline at end of file
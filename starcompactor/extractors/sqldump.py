@@ -0,0 +1,265 @@
+# coding: utf-8
+"""Streaming reader for mysqldump files.
+
+The daily backups are plain mysqldump output: for each database a
+``USE `db`;`` line, and for each table a CREATE TABLE statement followed by
+extended ``INSERT INTO `table` VALUES (...),(...);`` lines.  read_tables
+reads such a stream once, line by line, and parses only the INSERT lines of
+the requested tables, so the rest of the dump is never decoded, copied or
+loaded anywhere.
+
+Values are converted the way MySQLdb returns them for the column type given
+in the CREATE TABLE statement: DATETIME/TIMESTAMP as datetime (None for the
+zero date), DATE as date, DECIMAL as Decimal, integer and float columns as
+numbers, binary strings as bytes and everything else as str.
+"""
+import datetime
+import decimal
+import logging
+import re
+
+LOG = logging.getLogger(__name__)
+
+_USE = re.compile(rb'^USE `([^`]+)`;')
+_CREATE_TABLE = re.compile(rb'^CREATE TABLE `([^`]+)`')
+_COLUMN = re.compile(rb'^\s+`([^`]+)` (\w+)')
+_INSERT = re.compile(r'^INSERT INTO `([^`]+)`(?: \(([^)]*)\))? VALUES ')
+_UNLOCK_TABLES = b'UNLOCK TABLES'
+
+_VALUE = re.compile(r"""\s*(?:
+    '((?:[^'\\]|\\.)*)'             # 1: string
+  | _binary\s*'((?:[^'\\]|\\.)*)'   # 2: binary string
+  | (NULL)                          # 3
+  | 0x([0-9A-Fa-f]*)                # 4: hex literal
+  | b'([01]*)'                      # 5: bit literal
+  | ([^,()\s]+)                     # 6: number
+)\s*""", re.VERBOSE | re.DOTALL)
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+# MySQL keeps the backslash of \% and \_ (they only escape LIKE patterns),
+# and drops it from every other sequence
+_ESCAPES.update({'%': '\\%', '_': '\\_'})
+
+# the encoding of the dump; undecodable bytes (in binary columns) survive
+# the round trip through str thanks to surrogateescape
+ENCODING = 'utf-8'
+
+_INT_TYPES = {'tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'year'}
+_FLOAT_TYPES = {'float', 'double', 'real'}
+_DECIMAL_TYPES = {'decimal', 'numeric'}
+_DATETIME_TYPES = {'datetime', 'timestamp'}
+_BINARY_TYPES = {'binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob'}
+
+
+def _unescape(s):
+    return _ESCAPE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)), s)
+
+
+def _number(token):
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def _datetime(value):
+    if value.startswith('0000-00-00'):
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+
+def _date(value):
+    if value.startswith('0000-00-00'):
+        return None
+    return datetime.date.fromisoformat(value)
+
+
+def _converter(column_type):
+    """Conversion of a quoted value of a column of *column_type*."""
+    if column_type in _DATETIME_TYPES:
+        return _datetime
+    if column_type == 'date':
+        return _date
+    if column_type in _INT_TYPES:
+        return int
+    if column_type in _FLOAT_TYPES:
+        return float
+    if column_type in _DECIMAL_TYPES:
+        return decimal.Decimal
+    if column_type in _BINARY_TYPES:
+        return lambda value: value.encode(ENCODING, 'surrogateescape')
+    return None
+
+
+def _value(m, convert):
+    string = m.group(1)
+    if string is not None:
+        string = _unescape(string)
+        return convert(string) if convert is not None else string
+    if m.group(3) is not None:
+        return None
+    if m.group(6) is not None:
+        token = m.group(6)
+        if convert is decimal.Decimal:
+            return decimal.Decimal(token)
+        return float(token) if convert is float else _number(token)
+    if m.group(2) is not None:
+        return _unescape(m.group(2)).encode(ENCODING, 'surrogateescape')
+    if m.group(4) is not None:
+        return bytes.fromhex(m.group(4))
+    return int(m.group(5), 2) if m.group(5) else 0
+
+
+def parse_values(values, converters):
+    """Rows of the ``(...),(...);`` part of an INSERT statement, as lists."""
+    rows = []
+    pos = 0
+    end = len(values)
+    while True:
+        while pos < end and values[pos].isspace():
+            pos += 1
+        if pos >= end or values[pos] != '(':
+            raise ValueError('expected ( at offset {} of INSERT values'.format(pos))
+        pos += 1
+        row = []
+        while True:
+            m = _VALUE.match(values, pos)
+            if m is None:
+                raise ValueError('bad value at offset {} of INSERT values'.format(pos))
+            row.append(_value(m, converters[len(row)] if len(row) < len(converters) else None))
+            pos = m.end()
+            c = values[pos:pos + 1]
+            pos += 1
+            if c == ')':
+                break
+            if c != ',':
+                raise ValueError('expected , or ) at offset {} of INSERT values'.format(pos - 1))
+        rows.append(row)
+        while pos < end and values[pos].isspace():
+            pos += 1
+        c = values[pos:pos + 1]
+        pos += 1
+        if c in (';', ''):
+            return rows
+        if c != ',':
+            raise ValueError('expected , or ; at offset {} of INSERT values'.format(pos - 1))
+
+
+def read_tables(f, tables, columns=None):
+    """Rows of the given tables of the dump in binary stream *f*.
+
+    *tables* is an iterable of (database, table) names.  Returns a dict from
+    each of them found in the dump to its rows, as dicts from column name to
+    value, in dump order.  Reading stops as soon as every requested table
+    has been read completely.  If *columns* is a dict, the (name, type)
+    columns of the CREATE TABLE statement of each table are stored in it,
+    types lowercased and without their length.
+    """
+    wanted = set(tables)
+    found = {}
+    if columns is None:
+        columns = {}
+    database = None
+    create_table = None  # (database, table) whose CREATE TABLE is being read
+    reading = None       # (database, table) whose INSERTs are being read
+    for line in f:
+        if isinstance(line, str):
+            line = line.encode(ENCODING, 'surrogateescape')
+        if line.startswith(b'INSERT INTO '):
+            text = line.decode(ENCODING, 'surrogateescape')
+            m = _INSERT.match(text)
+            if m is None or (database, m.group(1)) not in wanted:
+                continue
+            key = reading = (database, m.group(1))
+            if m.group(2):
+                names = [name.strip().strip('`') for name in m.group(2).split(',')]
+                types = dict(columns.get(key, []))
+                table_columns = [(name, types.get(name)) for name in names]
+            else:
+                table_columns = columns.get(key)
+                if table_columns is None:
+                    raise ValueError('INSERT INTO `{}`.`{}` before its CREATE TABLE'.format(*key))
+            names = [name for name, _ in table_columns]
+            converters = [_converter(column_type) for _, column_type in table_columns]
+            rows = found.setdefault(key, [])
+            for row in parse_values(text[m.end():].rstrip('\r\n'), converters):
+                rows.append(dict(zip(names, row)))
+            continue
+
+        if create_table is not None:
+            m = _COLUMN.match(line)
+            if m:
+                columns[create_table].append((m.group(1).decode(ENCODING), m.group(2).decode(ENCODING).lower()))
+                continue
+            if not line.startswith(b'  '):
+                create_table = None
+
+        if reading is not None and (line.startswith(_UNLOCK_TABLES) or line.startswith(b'CREATE TABLE')
+                                    or line.startswith(b'USE ')):
+            LOG.debug('read {} rows of `{}`.`{}`'.format(len(found[reading]), *reading))
+            wanted.discard(reading)
+            reading = None
+            if not wanted:
+                break
+
+        m = _USE.match(line)
+        if m:
+            database = m.group(1).decode(ENCODING)
+            continue
+        m = _CREATE_TABLE.match(line)
+        if m:
+            key = (database, m.group(1).decode(ENCODING))
+            if key in wanted:
+                create_table = key
+                columns[key] = []
+                found.setdefault(key, [])
+    return found
+
+
+_DROP_TABLE = re.compile(rb'DROP TABLE.*`([^`]+)`')
+
+
+def split_tables(f, tables, open_sink):
+    """Copy the section of each of *tables* out of the dump in binary stream
+    *f*, in a single pass.
+
+    A section runs from the table's DROP TABLE line through the next line
+    containing UNLOCK TABLES, the same lines as ``sed -n -e '/^USE `db`/,/^USE/p'``
+    followed by ``sed -n -e '/DROP TABLE.*`table`/,/UNLOCK TABLES/p'`` select.
+    ``open_sink((database, table))`` is called at the start of each section
+    and must return a binary file-like object, which is closed at its end
+    (or when reading *f* fails).  With the mysql client's stdin as sink,
+    tables go from the decompressor into the database without touching disk.
+    Returns the (database, table) keys that were found.  Reading stops once
+    every requested table has been copied.
+    """
+    wanted = set(tables)
+    found = set()
+    database = None
+    sink = None
+    try:
+        for line in f:
+            if sink is not None:
+                sink.write(line)
+                if _UNLOCK_TABLES in line:
+                    sink.close()
+                    sink = None
+                    if found == wanted:
+                        break
+                continue
+            m = _USE.match(line)
+            if m:
+                database = m.group(1).decode(ENCODING)
+                continue
+            if line.startswith(b'DROP TABLE'):
+                m = _DROP_TABLE.search(line)
+                if m:
+                    key = (database, m.group(1).decode(ENCODING))
+                    if key in wanted:
+                        found.add(key)
+                        sink = open_sink(key)
+                        sink.write(line)
+    finally:
+        if sink is not None:
+            sink.close()
+    return found
@@ -50,6 +50,23 @@ def csv_row(event, trace_type, instance_type):
     return [str(event[k]) for k in _HEADER[trace_type]]
 
 
+def _csv_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def csv_rows(batch, trace_type, instance_type):
+    """Columnar counterpart of csv_row: format a whole RecordBatch of traces
+    one column at a time and return its rows."""
+    names = batch.schema.names
+    properties = [k for k in names if k in _CSV_PROPERTIES[trace_type][instance_type]]
+    columns = {k: [_csv_value(v) for v in batch.column(k).to_pylist()] for k in names}
+    columns['PROPERTIES'] = [dict(zip(properties, values)) for values in zip(*(columns[k] for k in properties))] \
+        if properties else [{}] * batch.num_rows
+    return zip(*([str(v) for v in columns[k]] for k in _HEADER[trace_type]))
+
+
 def write(filename, traces, trace_type, instance_type):
     with open(filename, 'w') as f:
         csvwriter = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
@@ -58,3 +75,12 @@ def write(filename, traces, trace_type, instance_type):
         for n, trace in enumerate(traces):
             line = csv_row(trace, trace_type, instance_type)
             csvwriter.writerow(line)
+
+
+def write_batches(filename, batches, trace_type, instance_type):
+    with open(filename, 'w') as f:
+        csvwriter = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csvwriter.writerow(_HEADER[trace_type])
+
+        for batch in batches:
+            csvwriter.writerows(csv_rows(batch, trace_type, instance_type))
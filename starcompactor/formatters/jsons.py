@@ -19,15 +19,28 @@ def datetime_serializer(obj):
     raise TypeError("don't know how to serialize object {}".format(repr(obj)))
 
 
+def json_line(event, trace_type, instance_type):
+    properties = {}
+    for k in list(event.keys()):
+        if k in _CSV_PROPERTIES[trace_type][instance_type]:
+            properties[k] = event[k]
+            del event[k]
+    event['PROPERTIES'] = properties
+    return json.dumps(event, default=datetime_serializer)
+
+
 def write(filename, events, trace_type, instance_type):
     with open(filename, 'w') as f:
         for event in events:
-            properties = {}
-            for k in list(event.keys()):
-                if k in _CSV_PROPERTIES[trace_type][instance_type]:
-                    properties[k] = event[k]
-                    del event[k]
-            event['PROPERTIES'] = properties
-            line = json.dumps(event, default=datetime_serializer)
+            line = json_line(event, trace_type, instance_type)
             LOG.info(line)
             f.write(line + '\n')
+
+
+def write_batches(filename, batches, trace_type, instance_type):
+    with open(filename, 'w') as f:
+        for batch in batches:
+            for event in batch.to_pylist():
+                line = json_line(event, trace_type, instance_type)
+                LOG.info(line)
+                f.write(line + '\n')
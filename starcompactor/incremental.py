@@ -0,0 +1,199 @@
+# coding: utf-8
+"""State for incremental instance dumps.
+
+An incremental run only extracts events whose audit rows are newer than the
+high-water mark recorded by the previous run, and adds their traces to the
+existing output instead of rewriting it.  The state file is a JSON object with
+one entry per parquet data directory (i.e. per site)::
+
+    {"/data/chi_tacc": {"audit_changed_at": "2024-05-01T03:12:44.120000+00:00",
+                        "output_file": "/out/chi_tacc_instance_events.csv",
+                        "options": {...},
+                        "size": 1048576, "lines": 5123,
+                        "last_start_time": "2024-05-01T03:10:02"}}
+
+*options* records everything that changes what a trace line looks like
+(instance type, output format, masking method, a fingerprint of the salt and
+the --start/--end window).  When the output is reopened its size and line
+count must still match the entry, so a file that was edited, truncated or
+regenerated by a full run in the meantime is never appended to.
+"""
+import csv
+import datetime
+import hashlib
+import heapq
+import json
+import logging
+import os
+import shutil
+
+from .util import atomic_write
+
+LOG = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+def options(instance_type, jsons, masking_method, salt, start=None, end=None):
+    salt_fingerprint = hashlib.sha256(salt.encode('utf-8')).hexdigest()[:16] if salt is not None else None
+    return {
+        'version': STATE_VERSION,
+        'instance_type': instance_type,
+        'format': 'jsons' if jsons else 'csv',
+        'masking_method': masking_method,
+        'salt': salt_fingerprint,
+        'start': start.isoformat() if start is not None else None,
+        'end': end.isoformat() if end is not None else None,
+    }
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, key, entry):
+    state = load_state(path)
+    state[key] = entry
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+    atomic_write(path, write)
+
+
+def count_lines(filename):
+    n = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            n += chunk.count(b'\n')
+    return n
+
+
+def check_output(filename, entry, opts):
+    """Raise ValueError unless *filename* is the output *entry* describes
+    and was written with the same *opts*."""
+    if entry.get('options') != opts:
+        raise ValueError('{} was written with different options ({} vs {}); run a full dump instead'.format(
+            filename, entry.get('options'), opts))
+    if os.path.abspath(filename) != entry['output_file']:
+        raise ValueError('state is for {}, not {}'.format(entry['output_file'], filename))
+    size = os.path.getsize(filename)
+    if size != entry['size']:
+        raise ValueError('{} is {} bytes, expected {} from the last run'.format(filename, size, entry['size']))
+    lines = count_lines(filename)
+    if lines != entry['lines']:
+        raise ValueError('{} has {} lines, expected {} from the last run'.format(filename, lines, entry['lines']))
+
+
+def _start_time(value):
+    """START_TIME of a written trace; missing or unparseable ones (None,
+    NaT, ...) sort first, as the dump sorts traces without one."""
+    if not isinstance(value, str):
+        return datetime.datetime.min
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.datetime.min
+
+
+class _CsvRecords(object):
+    """(START_TIME, record) pairs of a CSV trace file, header skipped."""
+    def __init__(self, f):
+        self.reader = csv.reader(f, delimiter=',', quotechar='"')
+        header = next(self.reader, None)
+        self.column = header.index('START_TIME') if header else None
+
+    def __iter__(self):
+        for row in self.reader:
+            yield _start_time(row[self.column]), row
+
+
+class _JsonRecords(object):
+    """(START_TIME, line) pairs of a JSON-per-line trace file."""
+    def __init__(self, f):
+        self.f = f
+
+    def __iter__(self):
+        for line in self.f:
+            yield _start_time(json.loads(line).get('START_TIME')), line
+
+
+def _records(f, fmt):
+    return _CsvRecords(f) if fmt == 'csv' else _JsonRecords(f)
+
+
+def _last_start_time(records):
+    last = None
+    for start_time, _ in records:
+        last = start_time if last is None else max(last, start_time)
+    return last
+
+
+def merge_output(filename, new_filename, entry, fmt):
+    """Add the traces in *new_filename* (a complete trace file, sorted by
+    START_TIME, header included for CSV) to *filename*.
+
+    If they all start no earlier than the last trace of *filename* they are
+    appended as is; otherwise both files are merged by START_TIME into a new
+    output, existing traces first on ties.  Returns the START_TIME of the
+    last trace.  If it fails, *filename* is left as it was, so it still
+    matches the state of the previous run.
+    """
+    previous = _start_time(entry['last_start_time'])
+    with open(new_filename, newline='') as f:
+        start_times = [start_time for start_time, _ in _records(f, fmt)]
+    if not start_times:
+        return previous
+    last = max(previous, start_times[-1])
+
+    if start_times[0] >= previous:
+        LOG.info('appending new traces to %s', filename)
+        size = os.path.getsize(filename)
+        try:
+            with open(new_filename, newline='') as src, open(filename, 'a', newline='') as dst:
+                if fmt == 'csv':
+                    src.readline()
+                shutil.copyfileobj(src, dst)
+        except BaseException:
+            with open(filename, 'r+b') as f:
+                f.truncate(size)
+            raise
+        return last
+
+    LOG.info('new traces start before the end of %s, merging', filename)
+
+    def write(tmp_path):
+        with open(filename, newline='') as old, open(new_filename, newline='') as new, \
+                open(tmp_path, 'w', newline='') as out:
+            if fmt == 'csv':
+                out.write(old.readline())
+                old.seek(0)
+                writer = csv.writer(out, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            merged = heapq.merge(_records(old, fmt), _records(new, fmt), key=lambda r: r[0])
+            for _, record in merged:
+                if fmt == 'csv':
+                    writer.writerow(record)
+                else:
+                    out.write(record)
+        shutil.copymode(filename, tmp_path)
+    atomic_write(filename, write)
+    return last
+
+
+def output_entry(filename, audit_changed_at, opts, last_start_time):
+    return {
+        'audit_changed_at': audit_changed_at.isoformat() if audit_changed_at is not None else None,
+        'output_file': os.path.abspath(filename),
+        'options': opts,
+        'size': os.path.getsize(filename),
+        'lines': count_lines(filename),
+        'last_start_time': last_start_time.isoformat() if last_start_time is not None else None,
+    }
+
+
+def scan_last_start_time(filename, fmt):
+    with open(filename, newline='') as f:
+        return _last_start_time(_records(f, fmt))
@@ -1,16 +1,26 @@
 # coding: utf-8
 import argparse
+import contextlib
 import datetime
 import functools
+import heapq
 import logging
+import multiprocessing
+import os
 import sys
+import tempfile
+import time
+import traceback
 
 import configparser
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from dateutil.parser import parse as dateparse
 
-from . import transforms as trans
-from .extractors import mysql, instance as instance_extractor
+from . import incremental, transforms as trans
+from .extractors import audit, mysql, instance as instance_extractor
 from .formatters import csv_formatter, jsons
 from .util import pipeline
 
@@ -24,6 +34,18 @@ def datetime_serializer(obj):
     raise TypeError("don't know how to serialize object {}".format(repr(obj)))
 
 
+def sort_batches(batches):
+    """Concatenate trace RecordBatches and sort them by START_TIME, missing
+    times first and ties in their original order (like the dict path)."""
+    if not batches:
+        return []
+    table = pa.concat_tables([pa.Table.from_batches([b]) for b in batches], promote_options='permissive')
+    start_time = table.column('START_TIME')
+    keys = pa.table({'has_start': pc.is_valid(start_time), 'start': start_time})
+    order = pc.sort_indices(keys, sort_keys=[('has_start', 'ascending'), ('start', 'ascending')])
+    return table.take(order).to_batches()
+
+
 def main(argv):
     config = configparser.ConfigParser()
     config.read('starcompactor.config')
@@ -48,6 +70,22 @@ def main(argv):
         help='Use parquet files in data/ instead of connecting to MySQL')
     parser.add_argument('--parquet-data-dir', type=str, default=None,
         help='Directory containing parquet files (nova.instances, nova.instance_actions, nova.instance_actions_events)')
+    parser.add_argument('--streaming-join', action='store_true',
+        help='With --use-parquet, stream the events file through the join in record batches to bound memory')
+    parser.add_argument('--batch-size', type=int, default=audit.BATCH_SIZE,
+        help='Rows per record batch for --streaming-join (defaulting to "%(default)s")')
+    parser.add_argument('--columnar', action='store_true',
+        help='With --use-parquet, pass traces through masking, derivation and output as Arrow record batches instead of dicts')
+    parser.add_argument('--shard-by', type=str, default=None, choices=['month'],
+        help='With --use-parquet, split the --start/--end range (or the whole history) into calendar-month windows extracted in parallel')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+        help='Number of worker processes for --shard-by (defaulting to "%(default)s")')
+    parser.add_argument('--shard-retries', type=int, default=1,
+        help='Times a failed --shard-by window is retried (defaulting to "%(default)s")')
+    parser.add_argument('--incremental', action='store_true',
+        help='With --use-parquet, only extract events audited since the last run and add them to the existing output')
+    parser.add_argument('--state-file', type=str, default=None,
+        help='State file of --incremental runs (defaults to the output file with a ".state.json" suffix)')
     parser.add_argument('--jsons', action='store_true',
         help='Format output as one JSON per line (defaults to CSV-style)')
     parser.add_argument('--verbose', action='store_const', const=logging.INFO, dest="loglevel",
@@ -58,6 +96,10 @@ def main(argv):
 
     args = parser.parse_args(argv[1:])
     mysqlargs.extract(args)
+    if args.incremental and not args.use_parquet:
+        parser.error('--incremental requires --use-parquet')
+    if args.incremental and args.hashed_masking_method != 'none' and args.hashed_masking_salt is None:
+        parser.error('--incremental requires --hashed-masking-salt, or appended traces would be masked differently')
 
     if args.loglevel is None:
         args.loglevel = logging.WARNING
@@ -76,14 +118,224 @@ def main(argv):
     masker_config['salt'] = args.hashed_masking_salt
     mask = trans.Masker(**masker_config)
 
-    if args.use_parquet:
-        data_dir = args.parquet_data_dir
-        t = instance_extractor.get_instance_events_from_parquet(data_dir, start=start, end=end, instance_type=args.instance_type)
+    output_file = args.output_file
+    changed_since = None
+    changed_before = None
+    if args.incremental:
+        fmt = 'jsons' if args.jsons else 'csv'
+        state_file = args.state_file or args.output_file + '.state.json'
+        state_key = os.path.abspath(args.parquet_data_dir)
+        opts = incremental.options(args.instance_type, args.jsons, args.hashed_masking_method,
+                                   args.hashed_masking_salt, start, end)
+        entry = incremental.load_state(state_file).get(state_key)
+        if entry is not None and not os.path.exists(args.output_file):
+            LOG.warning('{} is gone, running a full dump'.format(args.output_file))
+            entry = None
+        if entry is not None:
+            try:
+                incremental.check_output(args.output_file, entry, opts)
+            except ValueError as e:
+                LOG.error('cannot add to {}: {}'.format(args.output_file, e))
+                return 1
+            changed_since = dateparse(entry['audit_changed_at']) if entry['audit_changed_at'] else None
+
+        changed_before = instance_extractor.latest_event_change(args.parquet_data_dir)
+        if entry is not None and (changed_before is None or
+                                  (changed_since is not None and changed_before <= changed_since)):
+            LOG.info('no events audited since {}, {} is up to date'.format(changed_since, args.output_file))
+            return
+        LOG.info('extracting events audited in ({}, {}]'.format(changed_since, changed_before))
+        if entry is not None:
+            # new traces go to a scratch file first and are merged in below
+            fd, output_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(args.output_file)),
+                                               suffix='.new')
+            os.close(fd)
+
+    try:
+        _dump(args, config, mysqlargs, output_file, start, end, epoch, mask, changed_since, changed_before)
+        if args.incremental:
+            # the state only moves on once the output holds the new traces
+            if entry is None:
+                last_start_time = incremental.scan_last_start_time(args.output_file, fmt)
+            else:
+                last_start_time = incremental.merge_output(args.output_file, output_file, entry, fmt)
+            incremental.save_state(state_file, state_key,
+                                   incremental.output_entry(args.output_file, changed_before, opts, last_start_time))
+    finally:
+        if output_file != args.output_file and os.path.exists(output_file):
+            os.remove(output_file)
+
+
+def _start_time_key(trace):
+    return trace['START_TIME'] if trace['START_TIME'] else datetime.datetime.min
+
+
+def parquet_traces(data_dir, instance_type, start, end, mask, epoch, columnar=False,
+                   streaming=False, batch_size=audit.BATCH_SIZE, changed_since=None, changed_before=None):
+    """Extract, mask and derive the parquet traces of one [start, end] range.
+
+    Returns trace dicts sorted by START_TIME, or sorted RecordBatches if
+    *columnar*.
+    """
+    extract_args = dict(start=start, end=end, instance_type=instance_type, streaming=streaming,
+                        batch_size=batch_size, changed_since=changed_since, changed_before=changed_before)
+    if columnar:
+        t = instance_extractor.get_instance_event_batches_from_parquet(data_dir, **extract_args)
         t = pipeline(t,
-                    functools.partial(trans.mask_fields, trace_type=TRACE_TYPE, masker=mask),
-                    functools.partial(trans.extra_times, epoch=epoch),
+                    functools.partial(trans.mask_columns, trace_type=TRACE_TYPE, masker=mask),
+                    functools.partial(trans.extra_times_columns, epoch=epoch),
                     )
-        traces = sorted(list(t), key=lambda i: i['START_TIME'] if i['START_TIME'] else datetime.datetime.min)
+        return sort_batches(list(t))
+
+    t = instance_extractor.get_instance_events_from_parquet(data_dir, **extract_args)
+    t = pipeline(t,
+                functools.partial(trans.mask_fields, trace_type=TRACE_TYPE, masker=mask),
+                functools.partial(trans.extra_times, epoch=epoch),
+                )
+    return sorted(list(t), key=_start_time_key)
+
+
+def _naive(dt):
+    if isinstance(dt, pd.Timestamp):
+        dt = dt.to_pydatetime()
+    return dt.replace(tzinfo=None) if dt is not None and dt.tzinfo is not None else dt
+
+
+def month_windows(start, end, first=None, last=None):
+    """Split [start, end] into calendar-month windows.
+
+    Returns (window_start, window_end) pairs, both inclusive, that tile the
+    range: each window ends one microsecond before the next one starts.  A
+    missing *start* or *end* leaves the first or last window open, in which
+    case *first* and *last* (e.g. the range of the data) place the month
+    boundaries in between.
+    """
+    start, end = _naive(start), _naive(end)
+    lo = start if start is not None else _naive(first)
+    hi = end if end is not None else _naive(last)
+    boundaries = []
+    if lo is not None and hi is not None:
+        month = datetime.datetime(lo.year, lo.month, 1)
+        while True:
+            month = datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+            if month > hi:
+                break
+            boundaries.append(month)
+    edges = [start] + boundaries
+    ends = [b - datetime.timedelta(microseconds=1) for b in boundaries] + [end]
+    return list(zip(edges, ends))
+
+
+def _utc(dt):
+    ts = pd.Timestamp(dt)
+    return ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+
+
+def _tighter(pick, a, b):
+    """pick (max or min) of two audit time bounds, either of which may be
+    None; naive ones are taken as UTC, like the audit columns."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return pick(a, b, key=_utc)
+
+
+def _extract_window(window, kwargs):
+    try:
+        started = time.perf_counter()
+        traces = parquet_traces(**kwargs)
+        LOG.info('window {} - {}: {} traces in {:.1f}s'.format(
+            window[0], window[1],
+            sum(b.num_rows for b in traces) if kwargs['columnar'] else len(traces),
+            time.perf_counter() - started))
+        return traces
+    except Exception as e:
+        traceback.print_exc()
+        raise e
+
+
+def sharded_parquet_traces(windows, workers, retries, **kwargs):
+    """parquet_traces over each of *windows* in a process pool, merged.
+
+    The windows split the events by audit_changed_at, so each event is read
+    by one window only; they have to tile all time, as month_windows(None,
+    None, ...) does.  Every window joins its events with all the actions in
+    [start, end], so actions are selected exactly as in an unsharded run,
+    including those whose created_at can't be parsed.
+
+    A window that fails is retried up to *retries* times on its own; the
+    windows that succeeded are kept.  The traces are those of parquet_traces
+    over the whole range, sorted by START_TIME the same way, but traces with
+    equal (or no) START_TIME come window by window instead of in join order.
+    """
+    jobs = []
+    for window_start, window_end in windows:
+        since = window_start - datetime.timedelta(microseconds=1) if window_start is not None else None
+        jobs.append(dict(kwargs,
+                         changed_since=_tighter(max, kwargs.get('changed_since'), since),
+                         changed_before=_tighter(min, kwargs.get('changed_before'), window_end)))
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    for attempt in range(retries + 1):
+        if attempt:
+            LOG.warning('retrying {} failed window(s), attempt {} of {}'.format(len(pending), attempt, retries))
+        with contextlib.closing(multiprocessing.Pool(processes=min(workers, len(pending)))) as pool:
+            async_results = [(i, pool.apply_async(_extract_window, (windows[i], jobs[i]))) for i in pending]
+            failed = []
+            for i, result in async_results:
+                try:
+                    results[i] = result.get()
+                except Exception as e:
+                    LOG.warning('window {} - {} failed: {}'.format(windows[i][0], windows[i][1], e))
+                    failed.append(i)
+        pending = failed
+        if not pending:
+            break
+    if pending:
+        raise RuntimeError('windows failed after {} retries: {}'.format(
+            retries, ', '.join('{} - {}'.format(*windows[i]) for i in pending)))
+
+    # Events are audited when they start, not in START_TIME order, so the
+    # sorted shards overlap and have to be merged.
+    if kwargs.get('columnar'):
+        return sort_batches([batch for batches in results for batch in batches])
+    return list(heapq.merge(*results, key=_start_time_key))
+
+
+def _dump(args, config, mysqlargs, output_file, start, end, epoch, mask, changed_since=None, changed_before=None):
+    if args.use_parquet:
+        data_dir = args.parquet_data_dir
+        kwargs = dict(data_dir=data_dir, instance_type=args.instance_type, mask=mask, epoch=epoch,
+                      columnar=args.columnar, streaming=args.streaming_join, batch_size=args.batch_size,
+                      changed_since=changed_since, changed_before=changed_before)
+        windows = None
+        if args.shard_by == 'month':
+            try:
+                first, last = instance_extractor.event_time_range(data_dir)
+            except ValueError as e:
+                LOG.warning('cannot shard by month, extracting in one window: {}'.format(e))
+            else:
+                # Events audited before these are skipped by every window
+                for bound in (start - instance_extractor.AUDIT_CLOCK_SKEW if start is not None else None,
+                              changed_since):
+                    if first is not None:
+                        first = _tighter(max, first, bound)
+                windows = month_windows(None, None, first, last)
+        if windows is not None:
+            LOG.info('extracting {} monthly windows with {} workers'.format(len(windows), args.workers))
+            traces = sharded_parquet_traces(windows, args.workers, args.shard_retries, start=start, end=end, **kwargs)
+        else:
+            traces = parquet_traces(start=start, end=end, **kwargs)
+
+        if args.columnar:
+            if args.jsons:
+                LOG.debug('writing JSONs to {}'.format(output_file))
+                jsons.write_batches(output_file, traces, TRACE_TYPE, args.instance_type)
+            else:
+                LOG.debug('writing CSV to {}'.format(output_file))
+                csv_formatter.write_batches(output_file, traces, TRACE_TYPE, args.instance_type)
+            return
     else:
         db = mysqlargs.connect()
         databases = config.get('default', 'nova_databases').split(',')
@@ -106,11 +358,11 @@ def main(argv):
         traces = sorted(traces, key=lambda i: i['START_TIME'])
 
     if args.jsons:
-        LOG.debug('writing JSONs to {}'.format(args.output_file))
-        jsons.write(args.output_file, traces, TRACE_TYPE, args.instance_type)
+        LOG.debug('writing JSONs to {}'.format(output_file))
+        jsons.write(output_file, traces, TRACE_TYPE, args.instance_type)
     else:
-        LOG.debug('writing CSV to {}'.format(args.output_file))
-        csv_formatter.write(args.output_file, traces, TRACE_TYPE, args.instance_type)
+        LOG.debug('writing CSV to {}'.format(output_file))
+        csv_formatter.write(output_file, traces, TRACE_TYPE, args.instance_type)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -1,28 +1,87 @@
 # coding: utf-8
 import argparse
+import array
 import configparser
 import contextlib
+import heapq
 import logging
 import math
 import multiprocessing
 import os
-import re
 import sys
 import traceback
+import zlib
 
+import numpy as np
+import pandas as pd
 from dateutil.parser import parse as dateparse
-from os import listdir
-from os.path import isfile, join
+from os.path import join
 
 from . import transforms as trans
-from .extractors import machine, mysql
+from .extractors import backup_manifest, machine, mysql
+from .extractors.event_table import EVENT_CODES, MachineEventTable
 from .formatters import csv_formatter, jsons
 
 TRACE_TYPE = 'machine'
 
 LOG = logging.getLogger(__name__)
 
-def refine_machine_events(machine_events):
+def refine_machine_events(machine_events, created_hosts=()):
+    """Drop invalid events from a MachineEventTable, in place.  Hosts in
+    *created_hosts* were created before their first event.
+
+    Vectorized equivalent of refine_machine_events_sequential.  Dropping an
+    event never changes the state the sequential walk carries forward, and
+    with that the rules reduce to comparisons with the previous row of three
+    per-host subsequences:
+
+    * nothing before a host's first CREATE is kept, unless the host is in
+      created_hosts;
+    * CREATE/DELETE events are kept where they differ from the previous
+      CREATE/DELETE event (initially DELETE, or CREATE for created_hosts),
+      as the walk only keeps events that toggle is_created;
+    * ENABLE/DISABLE events likewise toggle is_enabled (initially DISABLE);
+    * an UPDATE is kept where its properties differ from the previous
+      event among the kept non-UPDATE events and all UPDATEs.  (The "same
+      event type and properties" rule only ever removes UPDATEs that the
+      others don't already remove.)
+    """
+    df = machine_events.frame()
+    if df.empty:
+        return machine_events
+    host = df['host']
+    event = df['event']
+    create, delete = EVENT_CODES['CREATE'], EVENT_CODES['DELETE']
+    enable, disable = EVENT_CODES['ENABLE'], EVENT_CODES['DISABLE']
+    update = EVENT_CODES['UPDATE']
+    carried = np.array([name in created_hosts for name in machine_events.hosts], dtype=bool)
+    created = pd.Series(carried[np.frombuffer(machine_events.host_codes, dtype=np.int32)[df['row'].to_numpy()]],
+                        index=df.index)
+
+    started = ((event == create) | created).astype(np.int8).groupby(host).cummax().astype(bool)
+
+    def toggles(kinds, initial):
+        candidates = started & event.isin(kinds)
+        previous = event[candidates].groupby(host[candidates]).shift(1).fillna(initial)
+        return candidates & (event != previous.reindex(event.index))
+
+    keep = (toggles([create, delete], pd.Series(np.where(created, create, delete), index=df.index)) |
+            toggles([enable, disable], disable))
+
+    sequence = keep | (started & (event == update))
+    properties = df['properties'][sequence]
+    previous = properties.groupby(host[sequence]).shift(1)
+    keep |= (sequence & (event == update) & (df['properties'] != previous.reindex(df.index)))
+
+    machine_events.drop_rows(df['row'][~keep].tolist())
+    return machine_events
+
+
+def refine_machine_events_sequential(machine_events, created_hosts=()):
+    """Reference implementation of refine_machine_events: walks every event
+    in (host, time, event) order, deleting the invalid ones.  Hosts in
+    *created_hosts* start out created.  Works on any dict-like store of
+    machine events."""
     # sort machine event keys (event_time, host, event_type) by host and event_time
     sorted_key = sorted(machine_events.keys(), key=lambda x: (x[1], x[0], x[2]))
     current_host = None
@@ -40,6 +99,10 @@ def refine_machine_events(machine_events):
             prev_properties = None
             is_created = False
             is_enabled = False
+            if host in created_hosts:
+                # the host's CREATE is before these events
+                prev_event = 'CREATE'
+                is_created = True
         if not prev_event:
             # first event of a host must be CREATE
             if event_type != 'CREATE':
@@ -76,28 +139,247 @@ def refine_machine_events(machine_events):
     
     return machine_events
 
-def mask_and_derive(machine_events, masker, epoch, rack_property_name):
+def rack_codebook(racks, path=None):
+    """A RackCodebook for *racks*, extending the one saved at *path* if
+    given (and saving the result there)."""
+    if path is None:
+        return trans.RackCodebook(racks)
+    codebook = trans.RackCodebook.load(path)
+    known = len(codebook)
+    new_racks = codebook.add(racks)
+    LOG.info('rack codebook {}: {} known racks, {} new'.format(path, known, len(new_racks)))
+    if new_racks or not os.path.exists(path):
+        codebook.save(path)
+    return codebook
+
+def mask_and_derive(machine_events, masker, epoch, rack_property_name, codebook=None):
+    """Masked traces of the events, in order.  Racks are encoded with
+    *codebook*, by default one built from the racks of these events."""
     traces = []
-    for key in machine_events.keys():
-        trace = machine_events[key].copy()
+    if rack_property_name and codebook is None:
+        codebook = trans.RackCodebook(machine_events.property_values(rack_property_name))
+    for key, properties in machine_events.items():
+        trace = properties
         trace['EVENT_TIME'] = key[0]
         trace['HOST_NAME (PHYSICAL)'] = key[1]
         trace['EVENT'] = key[2]
         trace = trans.mask_fields(trace, TRACE_TYPE, masker)
         trace = trans.machine_event_times(trace, epoch)
         if rack_property_name:
-            trace = trans.ordered_mask(trace, rack_property_name, sorted(set([machine_events[k][rack_property_name] for k in machine_events.keys() if rack_property_name in machine_events[k]]))) 
+            trace = codebook.mask(trace, rack_property_name)
         traces.append(trace) 
     
     return traces
 
+def host_shard(host, shards):
+    """Shard of *host*; stable across processes and runs, unlike hash()."""
+    return zlib.crc32(str(host).encode('utf-8')) % shards
+
+
+def shard_machine_events(machine_events, shards):
+    """Partition a MachineEventTable by host into *shards* tables.
+
+    Returns (rows, table) pairs, where rows lists the row indices of
+    machine_events the shard's table holds, in order.
+    """
+    host_shards = [host_shard(host, shards) for host in machine_events.hosts]
+    shard_rows = [[] for _ in range(shards)]
+    for row in machine_events.rows():
+        shard_rows[host_shards[machine_events.host_codes[row]]].append(row)
+    return [(rows, machine_events.take(rows)) for rows in shard_rows if rows]
+
+
+def refine_machine_events_with_packed_args(args):
+    try:
+        return refine_machine_events(**args)
+    except Exception as e:
+        traceback.print_exc()
+        raise e
+
+
+def mask_and_derive_with_packed_args(args):
+    try:
+        return mask_and_derive(**args)
+    except Exception as e:
+        traceback.print_exc()
+        raise e
+
+
+def sharded_refine_mask_and_derive(machine_events, shards, workers, masker, epoch, rack_property_name,
+                                   rack_codebook_file=None, created_hosts=()):
+    """refine_machine_events and mask_and_derive over host shards of
+    machine_events in a process pool.
+
+    Both steps only look at one host at a time, except for rack numbering,
+    which needs the racks of all refined events; so the shards are refined
+    first, the rack codebook is built from all of them, and then each shard
+    is masked.  Traces come back in the order mask_and_derive would give for
+    the whole table.
+    """
+    sharded = shard_machine_events(machine_events, shards)
+    LOG.info('refining {} events in {} host shards with {} workers'.format(len(machine_events), len(sharded), workers))
+    with contextlib.closing(multiprocessing.Pool(processes=max(1, min(workers, len(sharded))))) as pool:
+        refined = pool.map(refine_machine_events_with_packed_args, [
+            {'machine_events': table, 'created_hosts': created_hosts} for _, table in sharded])
+        codebook = None
+        if rack_property_name:
+            racks = set().union(*(table.property_values(rack_property_name) for table in refined))
+            codebook = rack_codebook(racks, rack_codebook_file)
+        shard_traces = pool.map(mask_and_derive_with_packed_args, [
+            {'machine_events': table, 'masker': masker, 'epoch': epoch,
+             'rack_property_name': rack_property_name, 'codebook': codebook}
+            for table in refined])
+
+    # merge back into the row order of the unsharded table
+    numbered = [list(zip([rows[row] for row in table.rows()], traces))
+                for (rows, _), table, traces in zip(sharded, refined, shard_traces)]
+    return [trace for _, trace in heapq.merge(*numbered, key=lambda numbered_trace: numbered_trace[0])]
+
+
 def get_machine_event_with_packed_args(args):
     try:
         return machine.get_machine_event(**args)
     except Exception as e:
         traceback.print_exc()
         raise e
+
+def get_machine_events_with_packed_args(chunk):
+    """(index, result) of each (index, args) of a chunk of backups, which
+    are extracted in order so unchanged consecutive backups are reused."""
+    return [(index, get_machine_event_with_packed_args(args)) for index, args in chunk]
+
+def merge_backup_results(process_results, previous_hosts=None):
+    """Reference for BackupResultReducer: merge all backup results, in
+    backup order, at once."""
+    machine_events = MachineEventTable()
+    # create DELETE events
+    prev_hosts = previous_hosts
+    process_no = 0
+    for result in process_results:
+        if not result or 'hosts' not in result:
+            LOG.warn('missing result from process {}'.format(str(process_no)))
+            process_no = process_no + 1
+            continue
+        current_hosts = result['hosts']
+        if prev_hosts:
+            deleted_hosts = prev_hosts.difference(current_hosts)
+            for host in sorted(deleted_hosts, key=str):
+                machine_events[(result['file_time'], host, 'DELETE')] = {}
+        prev_hosts = current_hosts
+        process_no = process_no + 1
     
+    # we need to reverse the order for "CREATE" event
+    # so that we get the contents for create events from the earliest backup file.
+    # Example:
+    # In 2015-10-09 backup and for host x, "created_at" 2015-10-09 with 48 available VCPUs.
+    # In 2017-11-01 backup and for host x, "created_at" 2015-10-09 with 40 available VCPUs.
+    # For create event of host x, we choose the content from 2015-10-09 backup.
+    for result in reversed(process_results):
+        if result and 'machine_events' in result:
+            machine_events.update(result['machine_events'])
+    return machine_events
+
+class BackupResultReducer(object):
+    """Merges backup results as they arrive, in any order, into the same
+    table merge_backup_results builds from all of them.
+
+    Only the merged events and the host set of each backup are kept: an
+    event takes its properties from the earliest backup that has it (see
+    merge_backup_results), and its position from the latest one, where
+    merge_backup_results first inserts it.  DELETE events only need the host
+    sets, so they are made at the end.  *previous_hosts* are the hosts of
+    the backup before the first one, if it is left out of the run, and
+    *previous_created_hosts* those of them created as of that backup.
+    """
+    def __init__(self, n_backups, previous_hosts=None, previous_created_hosts=None):
+        self.previous_hosts = previous_hosts
+        self.previous_created_hosts = previous_created_hosts
+        self.hosts = [None] * n_backups
+        self.file_times = [None] * n_backups
+        self.events = MachineEventTable()
+        # per row of self.events: earliest and latest backup with the event,
+        # and its position in the latest one
+        self.first = array.array('i')
+        self.last = array.array('i')
+        self.position = array.array('q')
+
+    def add(self, index, result):
+        if not result or 'hosts' not in result:
+            LOG.warn('missing result from process {}'.format(str(index)))
+            return
+        self.hosts[index] = result['hosts']
+        self.file_times[index] = result['file_time']
+        for position, (key, properties) in enumerate(result['machine_events'].items()):
+            row = self.events.row(key)
+            if row is None:
+                self.events[key] = properties
+                self.first.append(index)
+                self.last.append(index)
+                self.position.append(position)
+                continue
+            if index < self.first[row]:
+                self.events[key] = properties
+                self.first[row] = index
+            if index > self.last[row]:
+                self.last[row] = index
+                self.position[row] = position
+
+    def result(self):
+        machine_events = MachineEventTable()
+        prev_hosts = self.previous_hosts
+        for hosts, file_time in zip(self.hosts, self.file_times):
+            if hosts is None:
+                continue
+            if prev_hosts:
+                for host in sorted(prev_hosts.difference(hosts), key=str):
+                    machine_events[(file_time, host, 'DELETE')] = {}
+            prev_hosts = hosts
+        
+        # latest backups first, as merge_backup_results updates in reverse
+        order = np.lexsort((np.frombuffer(self.position, dtype=np.int64),
+                            -np.frombuffer(self.last, dtype=np.int32)))
+        for row in order.tolist():
+            key = self.events.key(row)
+            machine_events[key] = self.events[key]
+        return machine_events
+
+    def created_hosts(self):
+        """Hosts of previous_created_hosts gone from the first backup.  Their
+        only event is the DELETE at that backup, so refine_machine_events
+        has to be told they were created before it."""
+        first = next((hosts for hosts in self.hosts if hosts is not None), None)
+        if not self.previous_created_hosts or first is None:
+            return set()
+        return self.previous_created_hosts.difference(first)
+
+def previous_backup_hosts(manifest, backup_dir, name, settings, extract_args):
+    """Hosts of backup *name*, the one before a --since window, and those
+    created as of it, for BackupResultReducer; None for either if they are
+    not known.  They come from *manifest*, unless the status of the backup
+    there is not done, in which case it is extracted again with
+    *extract_args* (see get_machine_event) and recorded first."""
+    instance_type = extract_args['instance_type']
+    status = manifest.status(name, instance_type, settings)
+    if status != 'done' or manifest.created_hosts(name, instance_type, settings) is None:
+        LOG.info('extracting {} for the hosts before the window (status: {})'.format(name, status or 'not extracted'))
+        try:
+            result = machine.get_machine_event(process_no=0, backup_file=join(backup_dir, name), **extract_args)
+        except Exception as e:
+            LOG.warning('extracting {} failed: {}'.format(name, e))
+            result = None
+        if result and 'hosts' in result:
+            result['file_time'] = manifest.time(name)
+        manifest.record(name, instance_type, settings, result)
+    return manifest.hosts(name, instance_type, settings), manifest.created_hosts(name, instance_type, settings)
+
+def backup_chunks(backup_files, chunk_size):
+    """Runs of *chunk_size* consecutive backups, as lists of indexes, largest
+    run (in bytes) first so the long ones start early."""
+    chunks = [list(range(i, min(i + chunk_size, len(backup_files))))
+              for i in range(0, len(backup_files), chunk_size)]
+    sizes = [sum(os.path.getsize(backup_files[i]) for i in chunk) for chunk in chunks]
+    return [chunk for _, chunk in sorted(zip(sizes, chunks), key=lambda sized: -sized[0])]
+
 def main(argv):
     config = configparser.ConfigParser()
     config.read('starcompactor.config')
@@ -120,6 +402,20 @@ def main(argv):
         help='Use parquet audit files in data/ instead of daily mysql dumps')
     parser.add_argument('--parquet-data-dir', type=str, default=None,
         help='Directory containing parquet audit files)')
+    parser.add_argument('--host-shards', type=int, default=1,
+        help='Split machine events into this many shards by host and refine, mask and derive them in a process pool (defaulting to "%(default)s", i.e. no pool)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+        help='Number of worker processes for backups and --host-shards (defaulting to "%(default)s")')
+    parser.add_argument('--mysql-concurrency', type=int, default=4,
+        help='Maximum number of backups loaded into MySQL at once with --backup-backend mysql (defaulting to "%(default)s")')
+    parser.add_argument('--rack-codebook', type=str, default=None,
+        help='JSON file of rack codes to reuse and extend, so codes stay stable across reruns and sites (defaulting to numbering the sorted racks of this dump). The file holds unmasked rack names.')
+    parser.add_argument('--backup-backend', type=str, default='python', choices=machine.BACKUP_BACKENDS,
+        help='How tables are read from daily mysql dumps: "python" parses them from the compressed stream and joins them in memory, "sqlite" runs the join queries on them in an in-memory SQLite database, "mysql" loads them into scratch databases of a MySQL server (defaulting to "%(default)s")')
+    parser.add_argument('--since', type=str, default=None,
+        help='Only extract the backups taken on or after this date, with backup times and the hosts of the backup before it from the backup manifest (defaulting to all backups)')
+    parser.add_argument('--backup-splitter', type=str, default='python', choices=machine.BACKUP_SPLITTERS,
+        help='How --backup-backend mysql cuts tables out of a backup: "python" in a single pass, "sed" with one pass per database and table (defaulting to "%(default)s")')
     parser.add_argument('--jsons', action='store_true',
         help='Format output as one JSON per line (defaults to CSV-style)')
     parser.add_argument('--verbose', action='store_const', const=logging.INFO, dest="loglevel",
@@ -131,6 +427,8 @@ def main(argv):
 
     args = parser.parse_args(argv[1:])
     mysqlargs.extract(args)
+    if args.host_shards < 1:
+        parser.error('--host-shards must be at least 1')
 
     if args.loglevel is None:
         args.loglevel = logging.WARNING
@@ -151,68 +449,87 @@ def main(argv):
     if args.use_parquet and args.instance_type == 'vm':
         data_dir = args.parquet_data_dir
         machine_events, _ = machine.get_machine_events_from_parquet_vm(data_dir)
+        created_hosts = set()
     elif args.use_parquet and args.instance_type == 'baremetal':
         data_dir = args.parquet_data_dir
         machine_events, _ = machine.get_machine_events_from_parquet_baremetal(data_dir)
+        created_hosts = set()
     else:
         backup_dir = config.get('backup', 'backup_dir')
-        backup_files = [join(backup_dir, f) for f in listdir(backup_dir) if isfile(join(backup_dir, f)) and re.match(config.get('backup', 'backup_file_regex'), f)]
-        backup_files.sort(key=lambda x: os.path.getmtime(x))
+        manifest = backup_manifest.BackupManifest(config.get('backup', 'backup_manifest', fallback='') or None)
+        backup_names = manifest.scan(backup_dir, config.get('backup', 'backup_file_regex'))
+        manifest.save()
+        settings = machine.backup_settings(args.instance_type, args.backup_backend)
+        
+        extract_args = {'mysql_args': mysqlargs.connect_kwargs,
+                        'instance_type': args.instance_type,
+                        'backend': args.backup_backend,
+                        'splitter': args.backup_splitter}
+        
+        previous_hosts = previous_created_hosts = None
+        if args.since:
+            since = dateparse(args.since)
+            earlier = [name for name in backup_names if manifest.time(name) < since]
+            backup_names = backup_names[len(earlier):]
+            if earlier:
+                previous_hosts, previous_created_hosts = previous_backup_hosts(
+                    manifest, backup_dir, earlier[-1], settings, extract_args)
+                if previous_hosts is None:
+                    LOG.warning('{} could not be extracted; hosts gone from the first backup since {} get no DELETE event'.format(earlier[-1], since))
+        backup_files = [join(backup_dir, name) for name in backup_names]
+        backup_times = [manifest.time(name) for name in backup_names]
             
         machine_args = []
         process_no = 0
         for backup_file in backup_files:
-            arg = {'process_no': process_no,
-                   'backup_file': backup_file, 
-                   'mysql_args': mysqlargs.connect_kwargs, 
-                   'instance_type': args.instance_type}
+            arg = dict(extract_args, process_no=process_no, backup_file=backup_file)
             machine_args.append(arg)  
             process_no = process_no + 1
         
-        with contextlib.closing(multiprocessing.Pool(processes=int(math.ceil(process_no / int(config.get('multithread', 'number_of_files_per_process')))))) as pool:
-            process_results = pool.map(get_machine_event_with_packed_args, machine_args)
-        
-        machine_events = {}
-        # multiprocessing keeps the order
-        # create DELETE events
-        prev_hosts = None
-        process_no = 0
-        for result in process_results:
-            if not result or 'hosts' not in result:
-                LOG.warn('missing result from process {}'.format(str(process_no)))
-                process_no = process_no + 1
-                continue
-            current_hosts = result['hosts']
-            if prev_hosts:
-                deleted_hosts = prev_hosts.difference(current_hosts)
-                for host in deleted_hosts:
-                    machine_events[(result['file_time'], host, 'DELETE')] = {}
-            prev_hosts = current_hosts
-            process_no = process_no + 1
+        processes = min(args.workers, len(backup_files))
+        if args.backup_backend == 'mysql':
+            processes = min(processes, args.mysql_concurrency)
+        processes = max(1, processes)
+        # enough chunks to keep every worker busy until the end, but no
+        # longer than number_of_files_per_process
+        chunk_size = max(1, min(int(config.get('multithread', 'number_of_files_per_process')),
+                                int(math.ceil(len(backup_files) / (4.0 * processes)))))
+        chunks = [[(index, machine_args[index]) for index in chunk]
+                  for chunk in backup_chunks(backup_files, chunk_size)]
+        LOG.info('extracting {} backups in {} chunks with {} workers'.format(len(backup_files), len(chunks), processes))
         
-        # we need to reverse the order for "CREATE" event
-        # so that we get the contents for create events from the earliest backup file.
-        # Example:
-        # In 2015-10-09 backup and for host x, "created_at" 2015-10-09 with 48 available VCPUs.
-        # In 2017-11-01 backup and for host x, "created_at" 2015-10-09 with 40 available VCPUs.
-        # For create event of host x, we choose the content from 2015-10-09 backup.
-        process_results.reverse()
-        for result in process_results:
-            if result and 'machine_events' in result:
-                machine_events.update(result['machine_events'])
+        reducer = BackupResultReducer(len(backup_files), previous_hosts, previous_created_hosts)
+        with contextlib.closing(multiprocessing.Pool(processes=processes)) as pool:
+            for chunk_results in pool.imap_unordered(get_machine_events_with_packed_args, chunks):
+                for index, result in chunk_results:
+                    # the backup's own time, not its mtime
+                    if result and 'hosts' in result:
+                        result['file_time'] = backup_times[index]
+                    manifest.record(backup_names[index], args.instance_type, settings, result)
+                    reducer.add(index, result)
+        manifest.save()
+        machine_events = reducer.result()
+        created_hosts = reducer.created_hosts()
         
     # refine machine events
     # 1. consecutive events with different timestamps but the same event type and properties is not valid; pick the earliest timestamp
     # 2. the UPDATE event after any event must have different properties
-    # 3. the first event of a host must be CREATE
+    # 3. the first event of a host must be CREATE, unless it was created before the first backup (--since)
     # 4. valid open/close pairs (CREATE and DELETE; ENABLE and DISABLE)
-    refined_machine_events = refine_machine_events(machine_events)
-    
-    # mask and derive
+    # then mask and derive; with --host-shards both steps run per shard in a process pool
     rack_property_name = (
         config.get('baremetal', 'rack_property_name')
         if args.instance_type == 'baremetal' else 'rack')
-    traces = mask_and_derive(refined_machine_events, mask, epoch, rack_property_name)
+    if args.host_shards > 1:
+        traces = sharded_refine_mask_and_derive(
+            machine_events, args.host_shards, args.workers, mask, epoch, rack_property_name, args.rack_codebook,
+            created_hosts)
+    else:
+        refined_machine_events = refine_machine_events(machine_events, created_hosts)
+        codebook = None
+        if rack_property_name:
+            codebook = rack_codebook(refined_machine_events.property_values(rack_property_name), args.rack_codebook)
+        traces = mask_and_derive(refined_machine_events, mask, epoch, rack_property_name, codebook)
        
     if args.jsons:
         LOG.debug('writing JSONs to {}'.format(args.output_file))
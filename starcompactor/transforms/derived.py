@@ -1,9 +1,12 @@
 # coding: utf-8
 import logging
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
 LOG = logging.getLogger(__name__)
 
-__all__ = ['extra_times', 'machine_event_times']
+__all__ = ['extra_times', 'extra_times_columns', 'machine_event_times']
 
 def extra_times(trace, epoch):
     if trace['START_TIME']:
@@ -26,6 +29,24 @@ def extra_times(trace, epoch):
 
     return trace
 
+def _seconds(duration):
+    # integer microseconds / 1e6 rounds exactly like timedelta.total_seconds()
+    return pc.divide(pc.cast(pc.cast(duration, pa.duration('us'), safe=False), pa.int64()).cast(pa.float64()), 1e6)
+
+def extra_times_columns(batch, epoch):
+    '''
+    Columnar counterpart of ``extra_times`` for an Arrow RecordBatch with
+    naive START_TIME and FINISH_TIME timestamp columns.
+    '''
+    start_time = batch.column('START_TIME')
+    finish_time = batch.column('FINISH_TIME')
+    start_sec = _seconds(pc.subtract(start_time, pa.scalar(epoch, start_time.type)))
+    finish_sec = _seconds(pc.subtract(finish_time, pa.scalar(epoch, finish_time.type)))
+    duration = _seconds(pc.subtract(finish_time, start_time))
+    batch = batch.append_column('START_SEC', start_sec)
+    batch = batch.append_column('FINISH_SEC', finish_sec)
+    return batch.append_column('EVENT_DURATION', duration)
+
 def machine_event_times(trace, epoch):
     if trace['EVENT_TIME']:
         trace['EVENT_TIME_SEC'] = (trace['EVENT_TIME'] - epoch).total_seconds()
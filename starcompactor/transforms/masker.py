@@ -1,8 +1,17 @@
 # coding: utf-8
 import os
 import hashlib
+import json
+import logging
 
-__all__ = ['MASKED_FIELDS', 'MASKERS', 'Masker', 'mask_fields', 'ordered_mask']
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from ..util import atomic_write
+
+__all__ = ['MASKED_FIELDS', 'MASKERS', 'Masker', 'mask_fields', 'mask_columns', 'ordered_mask', 'RackCodebook']
+
+LOG = logging.getLogger(__name__)
 
 MASKED_FIELDS = {'instance': ['INSTANCE_UUID', 'USER_ID', 'PROJECT_ID', 'INSTANCE_NAME', 'HOST_NAME (PHYSICAL)'],
                  'machine': ['HOST_NAME (PHYSICAL)']}
@@ -55,6 +64,24 @@ def mask_fields(trace, trace_type, masker):
             trace[field] = ''
     return trace
 
+def mask_columns(batch, trace_type, masker):
+    '''
+    Columnar counterpart of ``mask_fields`` for an Arrow RecordBatch. Each
+    distinct value is masked once and the results are spread back over the
+    column; null and empty values become ``''``.
+    '''
+    for field in MASKED_FIELDS[trace_type]:
+        i = batch.schema.get_field_index(field)
+        column = batch.column(i)
+        if pa.types.is_null(column.type):
+            masked = pa.array([''] * len(column), pa.string())
+        else:
+            encoded = column.dictionary_encode()
+            dictionary = pa.array([masker(v) if v else '' for v in encoded.dictionary.to_pylist()], pa.string())
+            masked = pc.fill_null(pc.take(dictionary, encoded.indices), '')
+        batch = batch.set_column(i, field, masked)
+    return batch
+
 def ordered_mask(trace, field_name, ordered_list):
     field_value = trace.setdefault(field_name, None)
     if field_value:
@@ -65,3 +92,64 @@ def ordered_mask(trace, field_name, ordered_list):
         
     return trace
     
+
+
+class RackCodebook:
+    '''
+    Ordered masking of rack values, built once: the code of a rack is its
+    position in the sorted list of observed racks, looked up in a dict.
+
+    ``RackCodebook(racks).mask(trace, field_name)`` gives the same result as
+    ``ordered_mask(trace, field_name, sorted(racks))``.
+
+    A codebook can be saved and loaded again, so that a rerun (or another
+    site dumped with the same codebook file) keeps the codes it already
+    assigned. Racks not in a loaded codebook are added after the existing
+    ones, sorted among themselves. Note that the file holds the unmasked rack
+    names.
+    '''
+    def __init__(self, racks=()):
+        self.racks = []
+        self.codes = {}
+        self.add(racks)
+
+    def add(self, racks):
+        """Give codes to the racks not in the codebook yet.  None is left
+        out, as it can't be sorted with the others; '' is numbered like any
+        rack, as ordered_mask does, though mask() leaves it as it is."""
+        new_racks = sorted(set(rack for rack in racks if rack is not None and rack not in self.codes))
+        for rack in new_racks:
+            self.codes[rack] = len(self.racks)
+            self.racks.append(rack)
+        return new_racks
+
+    def __len__(self):
+        return len(self.racks)
+
+    def encode(self, rack):
+        """Code of *rack*, or None if it is not in the codebook."""
+        return self.codes.get(rack)
+
+    def mask(self, trace, field_name):
+        field_value = trace.setdefault(field_name, None)
+        if field_value:
+            trace[field_name] = self.encode(field_value)
+        return trace
+
+    @classmethod
+    def load(cls, path):
+        """The codebook saved at *path*, or an empty one if there is none."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            racks = json.load(f)['racks']
+        codebook = cls()
+        for rack in racks:
+            codebook.add([rack])
+        return codebook
+
+    def save(self, path):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump({'racks': self.racks}, f, indent=2)
+        atomic_write(path, write)
@@ -1,6 +1,24 @@
 # coding: utf-8
+import os
+import tempfile
+
+
 def pipeline(iterator, *callables):
     for item in iterator:
         for f in callables:
             item = f(item)
         yield item
+
+
+def atomic_write(path, write):
+    """Call write(tmp_path) and move the result to *path*, so concurrent
+    readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
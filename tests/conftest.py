@@ -0,0 +1,44 @@
+# coding: utf-8
+import datetime
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+# starcompactor reads starcompactor.config from the working directory at import
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EPOCH = datetime.datetime(2016, 1, 1)
+
+
+@pytest.fixture
+def audit_dir(tmp_path):
+    """Directory of openstack_audit parquet files, written by calling the
+    fixture with a table name and rows of (payload dict, audit_event_type,
+    audit_changed_at)."""
+    def write(table, rows):
+        rows = sorted(rows, key=lambda row: row[2])
+        pq.write_table(pa.table({
+            'data': [json.dumps(payload) for payload, _, _ in rows],
+            'audit_event_type': [event_type for _, event_type, _ in rows],
+            'audit_changed_at': pa.array([changed_at for _, _, changed_at in rows], pa.timestamp('us', tz='UTC')),
+        }), os.path.join(str(tmp_path), 'openstack_audit.{}.parquet'.format(table)), row_group_size=7)
+        return str(tmp_path)
+    return write
+
+
+def same_values(a, b):
+    """Equality that takes NaN as equal to NaN, in nested dicts, lists and
+    tuples.  Times must also have the same type, so a pandas Timestamp (or
+    NaT) never passes for a datetime (or None)."""
+    if isinstance(a, float) and isinstance(b, float) and a != a and b != b:
+        return True
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same_values(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same_values(x, y) for x, y in zip(a, b))
+    if isinstance(a, datetime.datetime) or isinstance(b, datetime.datetime):
+        return type(a) == type(b) and a == b
+    return a == b
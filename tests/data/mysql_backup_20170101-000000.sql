@@ -0,0 +1,210 @@
+-- MySQL dump 10.13  Distrib 5.7.22, for Linux (x86_64)
+--
+-- Host: localhost    Database: 
+-- ------------------------------------------------------
+-- Server version	5.7.22
+
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET NAMES utf8 */;
+/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;
+
+--
+-- Current Database: `nova`
+--
+
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `nova` /*!40100 DEFAULT CHARACTER SET utf8 */;
+
+USE `nova`;
+
+--
+-- Table structure for table `compute_nodes`
+--
+
+DROP TABLE IF EXISTS `compute_nodes`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `compute_nodes` (
+  `created_at` datetime DEFAULT NULL,
+  `updated_at` datetime DEFAULT NULL,
+  `deleted_at` datetime DEFAULT NULL,
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `vcpus` int(11) NOT NULL,
+  `memory_mb` int(11) NOT NULL,
+  `local_gb` int(11) NOT NULL,
+  `cpu_info` mediumtext NOT NULL,
+  `hypervisor_hostname` varchar(255) DEFAULT NULL,
+  `cpu_allocation_ratio` float DEFAULT NULL,
+  `disk_available_least` decimal(10,2) DEFAULT NULL,
+  `host` varchar(255) DEFAULT NULL,
+  `deleted` int(11) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_compute_nodes0host0hypervisor_hostname0deleted` (`host`,`hypervisor_hostname`,`deleted`)
+) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `compute_nodes`
+--
+
+LOCK TABLES `compute_nodes` WRITE;
+/*!40000 ALTER TABLE `compute_nodes` DISABLE KEYS */;
+INSERT INTO `compute_nodes` VALUES ('2016-01-02 03:04:05','2017-01-01 00:00:00',NULL,1,48,128000,200,'{\"vendor\": \"Intel\", \"model\": \"it\'s \\\\ (x86), y\"}','c01-01.chameleon.tacc.utexas.edu',16,1.50,'c01-01',0),('2016-01-03 00:00:00','0000-00-00 00:00:00','2016-12-31 23:59:59',2,24,64000,100,'line one\nline two\ttab\r\0end','c01-02.chameleon.tacc.utexas.edu',1.5,-3.25,'c01-02',2);
+INSERT INTO `compute_nodes` VALUES ('2016-01-04 00:00:00.250000',NULL,NULL,3,48,128000,200,'','c02-01.chameleon.tacc.utexas.edu',NULL,NULL,NULL,0);
+/*!40000 ALTER TABLE `compute_nodes` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `services`
+--
+
+DROP TABLE IF EXISTS `services`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `services` (
+  `created_at` datetime DEFAULT NULL,
+  `updated_at` datetime DEFAULT NULL,
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `host` varchar(255) DEFAULT NULL,
+  `binary` varchar(255) DEFAULT NULL,
+  `disabled` tinyint(1) DEFAULT NULL,
+  `disabled_reason` varchar(255) DEFAULT NULL,
+  `last_seen_up` datetime DEFAULT NULL,
+  `forced_down` tinyint(1) DEFAULT NULL,
+  `version` int(11) DEFAULT NULL,
+  `uuid` varchar(36) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `services`
+--
+
+LOCK TABLES `services` WRITE;
+/*!40000 ALTER TABLE `services` DISABLE KEYS */;
+INSERT INTO `services` (`created_at`, `updated_at`, `id`, `host`, `binary`, `disabled`, `disabled_reason`, `last_seen_up`, `forced_down`, `version`, `uuid`) VALUES ('2016-01-02 03:04:05','2017-01-01 00:00:00',1,'c01-01','nova-compute',0,NULL,'2017-01-01 00:00:00',0,22,'uuid-1'),('2016-01-03 00:00:00','2016-06-01 12:00:00',2,'c01-02','nova-compute',1,'it\'s \"broken\", (really)','0000-00-00 00:00:00',0,22,'uuid-2'),('2016-01-03 00:00:00',NULL,3,'ctl','nova-scheduler',0,'',NULL,0,22,NULL);
+/*!40000 ALTER TABLE `services` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `instances`
+--
+
+DROP TABLE IF EXISTS `instances`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `instances` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `uuid` varchar(36) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB AUTO_INCREMENT=2 DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+LOCK TABLES `instances` WRITE;
+INSERT INTO `instances` VALUES (1,'u1');
+UNLOCK TABLES;
+
+--
+-- Current Database: `blazar`
+--
+
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `blazar` /*!40100 DEFAULT CHARACTER SET utf8 */;
+
+USE `blazar`;
+
+--
+-- Table structure for table `computehost_extra_capabilities`
+--
+
+DROP TABLE IF EXISTS `computehost_extra_capabilities`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `computehost_extra_capabilities` (
+  `created_at` datetime DEFAULT NULL,
+  `updated_at` datetime DEFAULT NULL,
+  `id` varchar(36) NOT NULL,
+  `computehost_id` varchar(36) DEFAULT NULL,
+  `capability_name` varchar(64) NOT NULL,
+  `capability_value` mediumtext NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `computehost_id` (`computehost_id`),
+  CONSTRAINT `computehost_extra_capabilities_ibfk_1` FOREIGN KEY (`computehost_id`) REFERENCES `computehosts` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `computehost_extra_capabilities`
+--
+
+LOCK TABLES `computehost_extra_capabilities` WRITE;
+/*!40000 ALTER TABLE `computehost_extra_capabilities` DISABLE KEYS */;
+INSERT INTO `computehost_extra_capabilities` VALUES ('2016-01-02 03:04:05',NULL,'1','1','node_type','compute_haswell'),('2016-01-02 03:04:05','2016-03-01 00:00:00','2','1','placement.rack','1'),('2016-01-03 00:00:00',NULL,'3','2','node_type','storage');
+/*!40000 ALTER TABLE `computehost_extra_capabilities` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `computehosts`
+--
+
+DROP TABLE IF EXISTS `computehosts`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `computehosts` (
+  `created_at` datetime DEFAULT NULL,
+  `updated_at` datetime DEFAULT NULL,
+  `id` varchar(36) NOT NULL,
+  `hypervisor_hostname` varchar(255) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `computehosts`
+--
+
+LOCK TABLES `computehosts` WRITE;
+/*!40000 ALTER TABLE `computehosts` DISABLE KEYS */;
+INSERT INTO `computehosts` VALUES ('2016-01-02 03:04:05',NULL,'1','node-1'),('2016-01-03 00:00:00',NULL,'2','node-2');
+/*!40000 ALTER TABLE `computehosts` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Current Database: `ironic`
+--
+
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `ironic` /*!40100 DEFAULT CHARACTER SET utf8 */;
+
+USE `ironic`;
+
+--
+-- Table structure for table `nodes`
+--
+
+DROP TABLE IF EXISTS `nodes`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `nodes` (
+  `created_at` datetime DEFAULT NULL,
+  `updated_at` datetime DEFAULT NULL,
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `uuid` varchar(36) DEFAULT NULL,
+  `maintenance` tinyint(1) DEFAULT NULL,
+  `provisioned_on` date DEFAULT NULL,
+  `fingerprint` varbinary(16) DEFAULT NULL,
+  `image` blob,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB AUTO_INCREMENT=3 DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `nodes`
+--
+
+LOCK TABLES `nodes` WRITE;
+/*!40000 ALTER TABLE `nodes` DISABLE KEYS */;
+INSERT INTO `nodes` VALUES ('2016-01-02 03:04:05','2016-02-01 00:00:00',1,'node-1',0,'2016-01-02',_binary 'a\'b\\c\0',0x00FF10),('2016-01-03 00:00:00','2016-02-02 00:00:00',2,'node-2',1,'0000-00-00',_binary '',0x);
+/*!40000 ALTER TABLE `nodes` ENABLE KEYS */;
+UNLOCK TABLES;
+/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+
+-- Dump completed on 2017-01-01  0:00:01
@@ -0,0 +1,86 @@
+# coding: utf-8
+import datetime
+import os
+import shutil
+
+from starcompactor import machine_event_dump
+from starcompactor.extractors import backup_manifest, machine
+
+from conftest import EPOCH
+
+
+def _day(d):
+    return EPOCH + datetime.timedelta(days=d)
+
+
+def test_created_hosts():
+    events = {
+        (_day(0), 'live', 'CREATE'): {},
+        (_day(1), 'live', 'UPDATE'): {},
+        (_day(0), 'deleted', 'CREATE'): {},
+        (_day(2), 'deleted', 'DELETE'): {},
+        (_day(3), 'tie', 'DELETE'): {},
+        (_day(3), 'tie', 'CREATE'): {},
+        (_day(0), 'recreated', 'CREATE'): {},
+        (_day(1), 'recreated', 'DELETE'): {},
+        (_day(2), 'recreated', 'CREATE'): {},
+        (_day(9), 'later', 'CREATE'): {},
+        (None, 'unknown', 'CREATE'): {},
+        (_day(0), 'disabled', 'DISABLE'): {},
+    }
+
+    assert backup_manifest.created_hosts(events, _day(5)) == {'live', 'recreated'}
+    assert backup_manifest.created_hosts(events, _day(1)) == {'live', 'deleted'}
+
+
+def test_record_created_hosts(tmp_path):
+    name = 'mysql_backup_20160102-000000.sql'
+    (tmp_path / name).write_text('')
+    manifest = backup_manifest.BackupManifest()
+    assert manifest.scan(str(tmp_path), r'mysql_backup_(\d{8})-(\d{6}).sql') == [name]
+    settings = {'properties': ['rack']}
+
+    manifest.record(name, 'vm', settings, {
+        'hosts': {'h1', 'h2'}, 'file_time': manifest.time(name),
+        'machine_events': {(_day(0), 'h1', 'CREATE'): {}, (_day(0), 'h2', 'CREATE'): {},
+                           (_day(0), 'h2', 'DELETE'): {}}})
+
+    assert manifest.hosts(name, 'vm', settings) == {'h1', 'h2'}
+    assert manifest.created_hosts(name, 'vm', settings) == {'h1'}
+    assert manifest.created_hosts(name, 'vm', {'properties': []}) is None
+    assert manifest.created_hosts(name, 'baremetal', settings) is None
+
+
+def test_failed_previous_backup_is_extracted_again(tmp_path):
+    name = 'mysql_backup_20170101-000000.sql'
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', name), str(tmp_path / name))
+    manifest = backup_manifest.BackupManifest()
+    manifest.scan(str(tmp_path), r'mysql_backup_(\d{8})-(\d{6}).sql')
+    settings = machine.backup_settings('vm', 'python')
+    extract_args = {'mysql_args': None, 'instance_type': 'vm', 'backend': 'python', 'splitter': 'python'}
+
+    manifest.record(name, 'vm', settings, {})
+    assert manifest.status(name, 'vm', settings) == 'failed'
+    assert manifest.hosts(name, 'vm', settings) is None
+
+    hosts, created_hosts = machine_event_dump.previous_backup_hosts(manifest, str(tmp_path), name, settings,
+                                                                    extract_args)
+
+    assert manifest.status(name, 'vm', settings) == 'done'
+    assert hosts == {'c01-01.chameleon.tacc.utexas.edu', 'c01-02.chameleon.tacc.utexas.edu'}
+    assert created_hosts == manifest.created_hosts(name, 'vm', settings) and created_hosts <= hosts
+    assert manifest.status(name, 'vm', dict(settings, instance_type='other')) is None
+
+
+def test_done_previous_backup_comes_from_manifest(tmp_path, monkeypatch):
+    name = 'mysql_backup_20160102-000000.sql'
+    (tmp_path / name).write_text('')
+    manifest = backup_manifest.BackupManifest()
+    manifest.scan(str(tmp_path), r'mysql_backup_(\d{8})-(\d{6}).sql')
+    settings = {'properties': ['rack']}
+    manifest.record(name, 'baremetal', settings, {'hosts': {'h1'}, 'file_time': manifest.time(name),
+                                                  'machine_events': {(_day(0), 'h1', 'CREATE'): {}}})
+    monkeypatch.setattr(machine, 'get_machine_event', None)
+
+    assert machine_event_dump.previous_backup_hosts(
+        manifest, str(tmp_path), name, settings, {'instance_type': 'baremetal'}) == ({'h1'}, {'h1'})
@@ -0,0 +1,51 @@
+# coding: utf-8
+import datetime
+import shutil
+
+import pytest
+
+from starcompactor import incremental
+
+HEADER = 'INSTANCE_UUID,START_TIME\n'
+
+
+def _write(path, lines):
+    with open(str(path), 'w', newline='') as f:
+        f.write(''.join(lines))
+    return str(path)
+
+
+@pytest.mark.parametrize('value', [None, '', 'None', 'NaT', 'nan', 'garbage'])
+def test_start_time_missing_or_unparseable(value):
+    assert incremental._start_time(value) == datetime.datetime.min
+
+
+def test_start_time():
+    assert incremental._start_time('2017-01-02T03:04:05') == datetime.datetime(2017, 1, 2, 3, 4, 5)
+
+
+def test_merge_output_with_missing_start_times(tmp_path):
+    old = _write(tmp_path / 'out.csv', [HEADER, 'a,NaT\n', 'b,2017-01-02T00:00:00\n'])
+    new = _write(tmp_path / 'new.csv', [HEADER, 'c,None\n', 'd,2017-01-03T00:00:00\n'])
+    entry = {'last_start_time': '2017-01-02T00:00:00'}
+
+    assert incremental.merge_output(old, new, entry, 'csv') == datetime.datetime(2017, 1, 3)
+    with open(old) as f:
+        assert f.read() == HEADER + 'a,NaT\nc,None\nb,2017-01-02T00:00:00\nd,2017-01-03T00:00:00\n'
+
+
+def test_failed_append_leaves_output_unchanged(tmp_path, monkeypatch):
+    lines = [HEADER, 'a,2017-01-01T00:00:00\n']
+    old = _write(tmp_path / 'out.csv', lines)
+    new = _write(tmp_path / 'new.csv', [HEADER, 'b,2017-01-02T00:00:00\n'])
+
+    def copy_then_fail(src, dst):
+        dst.write(src.read(3))
+        dst.flush()
+        raise IOError('disk full')
+    monkeypatch.setattr(shutil, 'copyfileobj', copy_then_fail)
+
+    with pytest.raises(IOError):
+        incremental.merge_output(old, new, {'last_start_time': '2017-01-01T00:00:00'}, 'csv')
+    with open(old) as f:
+        assert f.read() == ''.join(lines)
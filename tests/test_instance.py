@@ -0,0 +1,133 @@
+# coding: utf-8
+import datetime
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from starcompactor.extractors import audit, instance
+
+from conftest import EPOCH, same_values
+
+
+def _rows_of(data_dir, filename):
+    df = pd.read_parquet(os.path.join(data_dir, filename))
+    df = df[df['audit_event_type'] == 'INSERT']
+    return pd.DataFrame([json.loads(data) for data in df['data']])
+
+
+def _rowwise_traces(data_dir, instance_type):
+    """The per-row join and conversion the column-wise traces replace."""
+    instances = _rows_of(data_dir, instance.INSTANCES_FILE)
+    instances = instances[(instances['user_id'] != 'admin') & (instances['project_id'] != 'admin')]
+    instances = instances.drop_duplicates(subset=['uuid'], keep='first')
+    actions = _rows_of(data_dir, instance.ACTIONS_FILE)[['id', 'instance_uuid']]
+    events = _rows_of(data_dir, instance.EVENTS_FILE)
+    df = pd.merge(instances, actions, left_on='uuid', right_on='instance_uuid', suffixes=('', '_action'))
+    df = pd.merge(df, events, left_on='id', right_on='action_id', suffixes=('', '_event'))
+
+    traces = []
+    for _, row in df.iterrows():
+        finish_time = audit.naive_datetime(row.get('finish_time'))
+        if finish_time is None:
+            continue
+        host_event = None if pd.isnull(row.get('host_event')) else row.get('host_event')
+        host = None if pd.isnull(row.get('host')) else row.get('host')
+        node = None if pd.isnull(row.get('node')) else row.get('node')
+        traces.append({
+            'INSTANCE_UUID':        row.get('uuid'),
+            'EVENT':                row.get('event'),
+            'START_TIME':           audit.naive_datetime(row.get('start_time')),
+            'FINISH_TIME':          finish_time,
+            'RESULT':               row.get('result'),
+            'INSTANCE_NAME':        row.get('hostname'),
+            'USER_ID':              row.get('user_id'),
+            'PROJECT_ID':           row.get('project_id'),
+            'HOST_NAME (PHYSICAL)': (node or host_event or host) if instance_type == 'baremetal' else (host_event or host),
+            'memory_mb':            row.get('memory_mb'),
+            'root_gb':              row.get('root_gb'),
+            'vcpus':                row.get('vcpus'),
+        })
+    return traces
+
+
+@pytest.fixture
+def null_times_dir(audit_dir):
+    """Instances whose events have NULL start and finish times."""
+    instances, actions, events = [], [], []
+    for i in range(12):
+        created = EPOCH + datetime.timedelta(days=i)
+        uuid = 'u{:03d}'.format(i)
+        instances.append(({'uuid': uuid, 'memory_mb': 1024 * (1 + i % 2), 'root_gb': 20, 'vcpus': 2,
+                           'user_id': 'admin' if i == 5 else 'amy', 'project_id': 'p1', 'hostname': 'vm-{}'.format(i),
+                           'host': None if i % 3 == 0 else 'h1', 'node': None if i % 2 else 'n1'}, 'INSERT', created))
+        actions.append(({'id': i + 1, 'instance_uuid': uuid, 'created_at': created.isoformat()}, 'INSERT', created))
+        for e in range(3):
+            start = created + datetime.timedelta(minutes=e)
+            events.append(({'action_id': i + 1, 'event': 'compute_build', 'result': 'Success',
+                            'start_time': None if (i + e) % 3 == 0 else start.isoformat(),
+                            'finish_time': None if (i + e) % 5 == 0 else (start + datetime.timedelta(seconds=30)).isoformat(),
+                            'host': None if e == 2 else 'eh1'}, 'INSERT', start))
+    audit_dir('audit_nova_instances', instances)
+    audit_dir('audit_nova_instance_actions', actions)
+    return audit_dir('audit_nova_instance_actions_events', events)
+
+
+@pytest.mark.parametrize('instance_type', ['vm', 'baremetal'])
+@pytest.mark.parametrize('streaming', [False, True])
+def test_traces_match_rowwise_with_null_times(null_times_dir, instance_type, streaming):
+    traces = list(instance.get_instance_events_from_parquet(null_times_dir, instance_type=instance_type,
+                                                            streaming=streaming, batch_size=5))
+    expected = _rowwise_traces(null_times_dir, instance_type)
+
+    assert any(trace['START_TIME'] is None for trace in expected)
+    for trace in traces:
+        assert trace['START_TIME'] is None or type(trace['START_TIME']) is datetime.datetime
+        assert type(trace['FINISH_TIME']) is datetime.datetime
+    key = lambda trace: (trace['INSTANCE_UUID'], trace['FINISH_TIME'], str(trace['START_TIME']))
+    assert same_values(sorted(traces, key=key), sorted(expected, key=key))
+
+
+@pytest.fixture
+def offset_times_dir(audit_dir):
+    """Events whose times come with UTC offsets, fractional seconds or
+    neither, mixed within the same column."""
+    formats = ['2021-01-01T00:00:00+05:00', '2021-01-01 00:00:00.250000', '2021-01-01T00:00:00',
+               '2021-01-01T00:00:00Z', '2021-01-01T00:00:00-08:00']
+    instances = [({'uuid': 'u1', 'memory_mb': 1024, 'root_gb': 20, 'vcpus': 2, 'user_id': 'amy',
+                   'project_id': 'p1', 'hostname': 'vm-1', 'host': 'h1', 'node': None}, 'INSERT', EPOCH)]
+    actions = [({'id': 1, 'instance_uuid': 'u1', 'created_at': EPOCH.isoformat()}, 'INSERT', EPOCH)]
+    events = []
+    for e, start_time in enumerate(formats * 3):
+        events.append(({'action_id': 1, 'event': 'event{}'.format(e), 'result': 'Success', 'host': 'eh1',
+                        'start_time': start_time, 'finish_time': formats[(e + 1) % len(formats)]},
+                       'INSERT', EPOCH + datetime.timedelta(minutes=e)))
+    audit_dir('audit_nova_instances', instances)
+    audit_dir('audit_nova_instance_actions', actions)
+    return audit_dir('audit_nova_instance_actions_events', events)
+
+
+@pytest.mark.parametrize('sample_rows', [1000, 2])
+@pytest.mark.parametrize('streaming', [False, True])
+def test_offset_times_are_dropped_not_converted(offset_times_dir, monkeypatch, sample_rows, streaming):
+    monkeypatch.setattr(audit, 'JSON_SAMPLE_ROWS', sample_rows)
+    traces = list(instance.get_instance_events_from_parquet(offset_times_dir, instance_type='vm',
+                                                            streaming=streaming, batch_size=4))
+    expected = _rowwise_traces(offset_times_dir, 'vm')
+
+    assert traces[0]['EVENT'] == 'event0'
+    assert traces[0]['START_TIME'] == datetime.datetime(2021, 1, 1)
+    key = lambda trace: trace['EVENT']
+    assert same_values(sorted(traces, key=key), sorted(expected, key=key))
+
+
+def test_decode_payloads_keeps_times_as_strings(monkeypatch):
+    monkeypatch.setattr(audit, 'JSON_SAMPLE_ROWS', 1)
+    data = pa.array([json.dumps({'id': 1}), json.dumps({'id': 2, 'created_at': '2021-01-01T00:00:00+05:00'})])
+    df = audit.decode_payloads(data)
+
+    assert df['id'].tolist() == [1, 2]
+    assert df['created_at'].tolist()[1] == '2021-01-01T00:00:00+05:00'
+    assert audit.naive_datetimes(df['created_at']).tolist()[1] == pd.Timestamp(2021, 1, 1)
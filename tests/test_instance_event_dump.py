@@ -0,0 +1,92 @@
+# coding: utf-8
+import datetime
+
+import pyarrow as pa
+import pytest
+
+from starcompactor import instance_event_dump
+from starcompactor import transforms as trans
+from starcompactor.formatters import csv_formatter, jsons
+
+from conftest import EPOCH, same_values
+
+
+@pytest.fixture
+def months_dir(audit_dir):
+    """Four months of actions, some with events starting after the month
+    ends, many without a start time, and a few whose created_at can't be
+    parsed; a few instances have no memory_mb."""
+    instances, actions, events = [], [], []
+    for i in range(40):
+        created = EPOCH + datetime.timedelta(days=3 * i)
+        uuid = 'u{:03d}'.format(i)
+        instances.append(({'uuid': uuid, 'memory_mb': None if i % 7 == 3 else 1024, 'root_gb': 20, 'vcpus': 2, 'user_id': 'amy',
+                           'project_id': 'p1', 'hostname': 'vm-{}'.format(i), 'host': 'h1', 'node': None}, 'INSERT', created))
+        created_at = created.isoformat() if i % 13 != 5 else 'garbage'
+        actions.append(({'id': i + 1, 'instance_uuid': uuid, 'created_at': created_at}, 'INSERT', created))
+        for e in range(3):
+            start = created + datetime.timedelta(days=2 * e)
+            events.append(({'action_id': i + 1, 'event': 'event{}'.format(e), 'result': 'Success', 'host': 'eh1',
+                            'start_time': None if (i + e) % 3 == 0 else start.isoformat(),
+                            'finish_time': (start + datetime.timedelta(seconds=30)).isoformat()}, 'INSERT', start))
+    audit_dir('audit_nova_instances', instances)
+    audit_dir('audit_nova_instance_actions', actions)
+    return audit_dir('audit_nova_instance_actions_events', events)
+
+
+def _rows(traces, columnar):
+    if columnar:
+        return [tuple(row.values()) for batch in traces for row in batch.to_pylist()]
+    return [tuple(trace.values()) for trace in traces]
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+@pytest.mark.parametrize('start, end', [(None, None), (EPOCH + datetime.timedelta(days=40), None),
+                                        (None, EPOCH + datetime.timedelta(days=70))])
+def test_sharded_traces_match_unsharded(months_dir, columnar, start, end):
+    kwargs = dict(data_dir=months_dir, instance_type='vm', epoch=EPOCH, columnar=columnar,
+                  mask=trans.Masker(**dict(trans.MASKERS['sha2-salted'], salt='s')), start=start, end=end)
+    first, last = instance_event_dump.instance_extractor.event_time_range(months_dir)
+    windows = instance_event_dump.month_windows(None, None, first, last)
+    assert len(windows) > 3
+
+    unsharded = _rows(instance_event_dump.parquet_traces(**kwargs), columnar)
+    sharded = _rows(instance_event_dump.sharded_parquet_traces(windows, 2, 0, **kwargs), columnar)
+
+    assert same_values(sorted(sharded, key=repr), sorted(unsharded, key=repr))
+    if start is None and end is None:
+        assert len(sharded) == 120  # with the actions whose created_at is garbage
+    start_time = 2  # START_TIME column
+    for rows in (sharded, unsharded):
+        start_times = [row[start_time] or datetime.datetime.min for row in rows]
+        assert start_times == sorted(start_times)
+
+
+def test_sharded_incremental_traces_match_unsharded(months_dir):
+    kwargs = dict(data_dir=months_dir, instance_type='vm', epoch=EPOCH, columnar=False,
+                  mask=trans.Masker(**dict(trans.MASKERS['sha2-salted'], salt='s')), start=None, end=None,
+                  changed_since=EPOCH + datetime.timedelta(days=50),
+                  changed_before=EPOCH + datetime.timedelta(days=90))
+    windows = instance_event_dump.month_windows(None, None, EPOCH, EPOCH + datetime.timedelta(days=150))
+
+    unsharded = _rows(instance_event_dump.parquet_traces(**kwargs), False)
+    sharded = _rows(instance_event_dump.sharded_parquet_traces(windows, 2, 0, **kwargs), False)
+
+    assert unsharded and same_values(sorted(sharded, key=repr), sorted(unsharded, key=repr))
+
+
+@pytest.mark.parametrize('instance_type', ['vm', 'baremetal'])
+@pytest.mark.parametrize('formatter', [csv_formatter, jsons])
+def test_write_batches_matches_write(months_dir, tmp_path, instance_type, formatter):
+    kwargs = dict(data_dir=months_dir, instance_type=instance_type, start=None, end=None, epoch=EPOCH,
+                  mask=trans.Masker(**dict(trans.MASKERS['sha2-salted'], salt='s')))
+    batches = pa.Table.from_batches(instance_event_dump.parquet_traces(columnar=True, **kwargs)).to_batches(16)
+    rows_file, batches_file = str(tmp_path / 'rows.out'), str(tmp_path / 'batches.out')
+    formatter.write(rows_file, instance_event_dump.parquet_traces(columnar=False, **kwargs),
+                    instance_event_dump.TRACE_TYPE, instance_type)
+    formatter.write_batches(batches_file, batches, instance_event_dump.TRACE_TYPE, instance_type)
+
+    with open(rows_file, 'rb') as rows, open(batches_file, 'rb') as batches:
+        expected = rows.read()
+        assert expected.count(b'\n') > 100
+        assert batches.read() == expected
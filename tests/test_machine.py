@@ -0,0 +1,355 @@
+# coding: utf-8
+import bz2
+import datetime
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+from dateutil.parser import parse as dateparse
+
+from starcompactor.extractors import backup_cache, machine
+
+from conftest import EPOCH, same_values
+
+
+def _machine_events_vm_rowwise(data_dir):
+    """Row-by-row reference for machine.get_machine_events_from_parquet_vm."""
+    machine_events = {} # key is tuple (event_time, host_name, event)
+    hosts = set()
+
+    # 1. Load services audit
+    df_services = pd.read_parquet(os.path.join(data_dir, 'openstack_audit.audit_nova_services.parquet'))
+    s_rows = []
+    for _, row in df_services.iterrows():
+        payload = json.loads(row['data'])
+        if payload.get('binary') == machine.NOVA_COMPUTE_HOST_BINARY:
+            s_rows.append({
+                'host': payload.get('host'),
+                'service_updated_at': row['audit_changed_at'].to_pydatetime().replace(tzinfo=None),
+                'disabled': payload.get('disabled') == 1,
+            })
+    df_s = pd.DataFrame(s_rows)
+    if not df_s.empty:
+        df_s.sort_values('service_updated_at', inplace=True)
+
+    # 2. Load compute nodes audit
+    df_cn = pd.read_parquet(os.path.join(data_dir, 'openstack_audit.audit_nova_compute_nodes.parquet'))
+    cn_rows = []
+    for _, row in df_cn.iterrows():
+        payload = json.loads(row['data'])
+        audit_time = row['audit_changed_at'].to_pydatetime().replace(tzinfo=None)
+        created_at_payload = payload.get('created_at')
+        created_at = dateparse(created_at_payload).replace(tzinfo=None) if created_at_payload else audit_time
+        deleted_at_payload = payload.get('deleted_at')
+        if deleted_at_payload:
+            deleted_at = dateparse(deleted_at_payload).replace(tzinfo=None)
+        else:
+            deleted_at = audit_time if row['audit_event_type'] == 'DELETE' else None
+        cn_rows.append({
+            'node_updated_at': audit_time,
+            'created_at': created_at,
+            'deleted_at': deleted_at,
+            'host': payload.get('hypervisor_hostname') or payload.get('host'),
+            'vcpus': payload.get('vcpus'),
+            'memory_mb': payload.get('memory_mb'),
+            'local_gb': payload.get('local_gb'),
+        })
+    df_cn_parsed = pd.DataFrame(cn_rows)
+    df_cn_parsed.sort_values('node_updated_at', inplace=True)
+
+    # Pandas equivalent of a LEFT JOIN on host over time
+    df_joined = pd.merge_asof(df_cn_parsed, df_s, left_on='node_updated_at', right_on='service_updated_at',
+                              by='host', direction='backward')
+
+    for _, row in df_joined.iterrows():
+        hostname = row.get('host')
+        if not hostname:
+            continue
+        rack = 'UNKNOWN'
+        m = re.search(machine.RACK_EXTRACTOR['hypervisor_hostname_regex'], hostname)
+        if m:
+            rack = m.group(machine.RACK_EXTRACTOR['rack_extract_group'])
+        content = {
+            'rack': rack,
+            'vcpu_capability': row.get('vcpus'),
+            'memory_capability_mb': row.get('memory_mb'),
+            'disk_capability_gb': row.get('local_gb'),
+        }
+        service_update_time = row.get('service_updated_at')
+        machine_events[(row.get('created_at'), hostname, 'CREATE')] = content
+        machine_events[(row.get('node_updated_at'), hostname, 'UPDATE')] = content
+        if pd.notnull(row.get('deleted_at')):
+            machine_events[(row.get('deleted_at'), hostname, 'DELETE')] = {}
+        if pd.notnull(service_update_time):
+            event = 'DISABLE' if row.get('disabled') else 'ENABLE'
+            machine_events[(service_update_time, hostname, event)] = content
+        hosts.add(hostname)
+
+    return machine_events, hosts
+
+
+def _machine_events_baremetal_rowwise(data_dir):
+    """Node-by-node reference for machine.get_machine_events_from_parquet_baremetal."""
+    machine_events = {}  # key is tuple (event_time, node_id, event)
+    df = machine._load_baremetal_audit(data_dir)
+
+    for node_id, group in df.groupby('uuid'):
+        # CREATE time: created_at from blazar computehosts
+        create_date_raw = group['created_at_blazar_host'].iloc[0]
+        if pd.isnull(create_date_raw):
+            create_date = None
+        elif isinstance(create_date_raw, str):
+            create_date = dateparse(create_date_raw).replace(tzinfo=None)
+        else:
+            create_date = create_date_raw
+
+        # UPDATE time: latest capability audit time of the node
+        cap_audit_times = group['audit_changed_at_cap'].dropna()
+        update_time = cap_audit_times.max() if not cap_audit_times.empty else create_date
+
+        property_collections = {
+            row['property_name']: row['capability_value']
+            for _, row in group.iterrows()
+            if row['property_name'] in machine.BAREMETAL_PROPERTIES
+        }
+        if create_date is not None:
+            machine_events[(create_date, node_id, 'CREATE')] = property_collections
+        if update_time is not None:
+            machine_events[(update_time, node_id, 'UPDATE')] = property_collections
+
+        # One DISABLE / ENABLE event per distinct (node audit time, maintenance)
+        for _, row in group.drop_duplicates(subset=['audit_changed_at_node', 'maintenance']).iterrows():
+            event_type = 'DISABLE' if row['maintenance'] == 1 else 'ENABLE'
+            maint_key = (row['audit_changed_at_node'], node_id, event_type)
+            if maint_key not in machine_events:
+                machine_events[maint_key] = {}
+            machine_events[maint_key][row['property_name']] = row['capability_value']
+
+    return machine_events, set()
+
+
+@pytest.fixture
+def vm_audit_dir(audit_dir):
+    """Compute nodes and services of 12 hosts over six updates, with NULL
+    capabilities, unnamed and unracked hosts, deletions and non-compute
+    services."""
+    services, compute_nodes = [], []
+    for h in range(12):
+        host = 'c{:02d}-{:02d}.chameleon.tacc.utexas.edu'.format(h % 4, h) if h % 6 else 'node{}'.format(h)
+        created = EPOCH + datetime.timedelta(days=3 * h)
+        for k in range(6):
+            t = created + datetime.timedelta(days=20 * k)
+            services.append(({'host': host, 'binary': 'nova-conductor' if (h + k) % 5 == 0 else 'nova-compute',
+                              'disabled': (h + k) % 2}, 'UPDATE', t + datetime.timedelta(hours=1)))
+            compute_nodes.append(({
+                'hypervisor_hostname': None if h % 5 == 0 else host, 'host': host,
+                'vcpus': None if (h + k) % 4 == 0 else 48, 'memory_mb': 128000, 'local_gb': 200,
+                'created_at': created.isoformat() if k % 2 else None,
+                'deleted_at': t.isoformat() if k == 5 and h % 3 == 0 else None,
+            }, 'DELETE' if k == 5 and h % 4 == 0 else 'UPDATE', t))
+    audit_dir('audit_nova_services', services)
+    return audit_dir('audit_nova_compute_nodes', compute_nodes)
+
+
+def _pydatetime_keys(machine_events):
+    """Events with the Timestamps that iterrows() gives as plain datetimes,
+    as MachineEventTable returns them."""
+    return [((t.to_pydatetime() if isinstance(t, pd.Timestamp) else t, host, event), properties)
+            for (t, host, event), properties in machine_events.items()]
+
+
+def test_vm_events_match_rowwise(vm_audit_dir):
+    machine_events, hosts = machine.get_machine_events_from_parquet_vm(vm_audit_dir)
+    expected, expected_hosts = _machine_events_vm_rowwise(vm_audit_dir)
+
+    assert any(properties.get('vcpu_capability') != properties.get('vcpu_capability')
+               for properties in expected.values())
+    assert hosts == expected_hosts
+    assert same_values(list(machine_events.items()), _pydatetime_keys(expected))
+
+
+@pytest.fixture
+def baremetal_audit_dir(audit_dir):
+    """Ironic nodes in and out of maintenance and their blazar hosts and
+    capabilities, with NULL values, an unused property, a node that is not
+    in blazar and a host without a created_at."""
+    names = machine.BAREMETAL_PROPERTIES[:4] + ['unused']
+    properties = [({'id': i + 1, 'property_name': name}, 'INSERT', EPOCH) for i, name in enumerate(names)]
+    nodes, hosts, capabilities = [], [], []
+    for n in range(8):
+        uuid = 'node-{:03d}'.format(n)
+        created = EPOCH + datetime.timedelta(days=n)
+        for k in range(4):
+            nodes.append(({'id': n + 1, 'uuid': uuid, 'maintenance': [0, 1, False, True][(n + k) % 4]},
+                          'UPDATE', created + datetime.timedelta(days=7 * (k // 2))))
+        if n == 7:
+            continue
+        hosts.append(({'id': n + 100, 'hypervisor_hostname': uuid,
+                       'created_at': None if n == 3 else created.isoformat()}, 'INSERT', created))
+        for j in range(len(names)):
+            for k in range(2):
+                capabilities.append(({'computehost_id': n + 100, 'property_id': j + 1,
+                                      'capability_value': None if (n + j + k) % 6 == 0 else 'v{}_{}'.format(j, k)},
+                                     'UPDATE', created + datetime.timedelta(days=11 * k + j)))
+    audit_dir('audit_ironic_nodes', nodes)
+    audit_dir('audit_blazar_computehosts', hosts)
+    audit_dir('audit_blazar_resource_properties', properties)
+    return audit_dir('audit_blazar_computehost_extra_capabilities', capabilities)
+
+
+def test_baremetal_events_match_rowwise(baremetal_audit_dir):
+    machine_events, _ = machine.get_machine_events_from_parquet_baremetal(baremetal_audit_dir)
+    expected, _ = _machine_events_baremetal_rowwise(baremetal_audit_dir)
+
+    assert {event for _, _, event in expected} == {'CREATE', 'UPDATE', 'ENABLE', 'DISABLE'}
+    assert same_values(list(machine_events.items()), _pydatetime_keys(expected))
+
+
+def _table_sql(database, table, columns, rows):
+    """DROP TABLE ... UNLOCK TABLES section of a mysqldump backup."""
+    def literal(value):
+        if value is None:
+            return 'NULL'
+        return str(value) if isinstance(value, int) else "'{}'".format(value)
+    return ''.join([
+        'USE `{}`;\n'.format(database),
+        'DROP TABLE IF EXISTS `{}`;\n'.format(table),
+        'CREATE TABLE `{}` (\n'.format(table),
+        ''.join('  `{}` {} DEFAULT NULL,\n'.format(name, column_type) for name, column_type in columns),
+        '  PRIMARY KEY (`id`)\n) ENGINE=InnoDB DEFAULT CHARSET=utf8;\n',
+        'LOCK TABLES `{}` WRITE;\n'.format(table),
+        'INSERT INTO `{}` VALUES {};\n'.format(table, ','.join(
+            '({})'.format(','.join(literal(value) for value in row)) for row in rows)),
+        'UNLOCK TABLES;\n',
+    ])
+
+
+@pytest.fixture
+def backup_file(tmp_path):
+    """Backup with the nova and (old schema) blazar/ironic tables, with
+    NULL times, decimals, dates and rows of a node and a host that tie."""
+    def time(day, hour=0):
+        return (EPOCH + datetime.timedelta(days=day, hours=hour)).strftime('%Y-%m-%d %H:%M:%S')
+    sql = []
+    for d, database in enumerate(machine.NOVA_DATABASES):
+        sql.append(_table_sql(database, 'compute_nodes', [
+            ('id', 'int(11)'), ('created_at', 'datetime'), ('updated_at', 'datetime'), ('deleted_at', 'datetime'),
+            ('host', 'varchar(255)'), ('hypervisor_hostname', 'varchar(255)'), ('vcpus', 'int(11)'),
+            ('memory_mb', 'int(11)'), ('local_gb', 'int(11)'), ('ratio', 'decimal(5,2)'), ('since', 'date'),
+        ], [(h + 1, time(h), time(h + 10, d), time(h + 20) if h % 3 == 0 else None, 'host{}'.format(h % 4),
+             'c{:02d}-{:02d}.chameleon.tacc.utexas.edu'.format(h % 2, h), 48, 1024, 200, '1.50', '2016-01-0{}'.format(h + 1))
+            for h in range(6)]))
+        sql.append(_table_sql(database, 'services', [
+            ('id', 'int(11)'), ('updated_at', 'datetime'), ('host', 'varchar(255)'), ('binary', 'varchar(255)'),
+            ('disabled', 'tinyint(1)'),
+        ], [(s + 1, None if s == 2 else time(s + 5), 'host{}'.format(s % 4), 'nova-compute', s % 2)
+            for s in range(5)]))
+    sql.append(_table_sql('ironic', 'nodes', [
+        ('id', 'int(11)'), ('uuid', 'varchar(36)'), ('updated_at', 'datetime'), ('maintenance', 'tinyint(1)'),
+    ], [(n + 1, 'node-{}'.format(n % 3), time(n, 1), n % 2) for n in range(4)]))
+    sql.append(_table_sql('blazar', 'computehosts', [
+        ('id', 'int(11)'), ('created_at', 'datetime'), ('hypervisor_hostname', 'varchar(255)'),
+    ], [(c + 1, time(c), 'node-{}'.format(c)) for c in range(3)]))
+    sql.append(_table_sql('blazar', 'computehost_extra_capabilities', [
+        ('id', 'int(11)'), ('computehost_id', 'int(11)'), ('capability_name', 'varchar(64)'),
+        ('capability_value', 'mediumtext'), ('created_at', 'datetime'), ('updated_at', 'datetime'),
+    ], [(e + 1, e % 3 + 1, machine.BAREMETAL_PROPERTIES[e % 2], 'v{}'.format(e), time(e), time(e + 2) if e % 2 else None)
+        for e in range(8)]))
+    path = tmp_path / 'mysql_backup_20160101-000000.sql'
+    path.write_text(''.join(sql))
+    return str(path)
+
+
+@pytest.mark.parametrize('instance_type', ['vm', 'baremetal'])
+def test_sqlite_backend_matches_python(backup_file, instance_type):
+    results = {}
+    for backend in ('python', 'sqlite'):
+        machine._previous_backup.clear()
+        results[backend] = machine._get_machine_event(backup_file, None, instance_type, backend, 'python')
+
+    assert len(results['python']['machine_events']) > 5
+    assert results['sqlite']['hosts'] == results['python']['hosts']
+    assert same_values(list(results['sqlite']['machine_events'].items()),
+                       list(results['python']['machine_events'].items()))
+
+
+def test_import_leaves_sqlite3_adapters_alone():
+    code = ('import sqlite3; adapters, converters = dict(sqlite3.adapters), dict(sqlite3.converters); '
+            'import starcompactor.extractors.machine; '
+            'assert sqlite3.adapters == adapters and sqlite3.converters == converters')
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_backup_cache_keys_on_backend(backup_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(machine, 'BACKUP_CACHE', backup_cache.BackupCache(str(tmp_path / 'cache')))
+    extracted = []
+    get_machine_event = machine._get_machine_event
+
+    def counting(backup_file, mysql_args, instance_type, backend, splitter):
+        extracted.append((instance_type, backend))
+        return get_machine_event(backup_file, mysql_args, instance_type, backend, splitter)
+    monkeypatch.setattr(machine, '_get_machine_event', counting)
+
+    results = [machine.get_machine_event(0, backup_file, None, instance_type, backend)
+               for instance_type, backend in [('vm', 'python'), ('vm', 'python'), ('vm', 'sqlite'), ('vm', 'sqlite'),
+                                              ('baremetal', 'python'), ('vm', 'python')]]
+
+    assert extracted == [('vm', 'python'), ('vm', 'sqlite'), ('baremetal', 'python')]
+    assert results[1]['hosts'] == results[0]['hosts'] == results[2]['hosts']
+    assert list(results[1]['machine_events'].items()) == list(results[0]['machine_events'].items())
+    assert machine.backup_settings('vm', 'python') != machine.backup_settings('vm', 'sqlite')
+
+
+def test_unchanged_backups_give_independent_results(backup_file, tmp_path):
+    machine._previous_backup.clear()
+    second_file = str(tmp_path / 'mysql_backup_20160102-000000.sql')
+    shutil.copy(backup_file, second_file)
+    first = machine._get_machine_event(backup_file, None, 'vm', 'python', 'python')
+    expected_events, expected_hosts = list(first['machine_events'].items()), set(first['hosts'])
+
+    # the caller refines and merges the results in place
+    first['machine_events'][(EPOCH, 'extra', 'CREATE')] = {}
+    del first['machine_events'][next(iter(first['machine_events']))]
+    first['hosts'].add('extra')
+    second = machine._get_machine_event(second_file, None, 'vm', 'python', 'python')
+    third = machine._get_machine_event(backup_file, None, 'vm', 'python', 'python')
+
+    assert second['machine_events'] is not third['machine_events'] and second['hosts'] is not third['hosts']
+    for result in (second, third):
+        assert list(result['machine_events'].items()) == expected_events
+        assert result['hosts'] == expected_hosts
+
+
+def test_decompressor_pipe_raises_on_corrupt_bz2(tmp_path):
+    path = str(tmp_path / 'backup.sql.bz2')
+    with open(path, 'wb') as f:
+        data = bz2.compress(b'INSERT INTO `services` VALUES (1);\n' * 20000)
+        f.write(data[:len(data) // 2] + bytes(256) + data[len(data) // 2:])
+
+    with pytest.raises(IOError, match='bzip2'):
+        with machine.DecompressorPipe(['bzip2', '-d', '-c'], path) as f:
+            for _ in f:
+                pass
+
+
+def test_decompressor_pipe_with_chatty_stderr(tmp_path):
+    # more on stderr than a pipe holds, before and after the output
+    script = ('import sys; sys.stderr.write("x" * 1000000); sys.stdout.write(open(sys.argv[1]).read()); '
+              'sys.stderr.write("failed"); sys.exit(3)')
+    path = str(tmp_path / 'backup.sql')
+    with open(path, 'w') as f:
+        f.write('line\n' * 1000)
+
+    pipe = machine.DecompressorPipe([sys.executable, '-c', script], path)
+    assert pipe.read() == b'line\n' * 1000 and pipe.read() == b''
+    with pytest.raises(IOError, match='exit code 3'):
+        pipe.close()
+
+    killed = machine.DecompressorPipe([sys.executable, '-c', script], path)
+    assert killed.readline() == b'line\n'
+    killed.close()
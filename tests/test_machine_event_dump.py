@@ -0,0 +1,97 @@
+# coding: utf-8
+import datetime
+import random
+
+import pytest
+
+from starcompactor import machine_event_dump
+from starcompactor import transforms as trans
+from starcompactor.extractors.event_table import EVENTS, MachineEventTable
+
+from conftest import EPOCH
+
+
+def _masker():
+    return trans.Masker(**dict(trans.MASKERS['sha2-salted'], salt='s'))
+
+
+def _mask_and_derive_ordered(machine_events, masker, epoch, rack_property_name):
+    """mask_and_derive with the racks numbered by ordered_mask."""
+    racks = sorted(set(properties[rack_property_name] for properties in machine_events.values()
+                       if rack_property_name in properties))
+    traces = []
+    for key, properties in machine_events.items():
+        trace = dict(properties, **{'EVENT_TIME': key[0], 'HOST_NAME (PHYSICAL)': key[1], 'EVENT': key[2]})
+        trace = trans.mask_fields(trace, machine_event_dump.TRACE_TYPE, masker)
+        trace = trans.machine_event_times(trace, epoch)
+        traces.append(trans.ordered_mask(trace, rack_property_name, racks))
+    return traces
+
+
+def test_rack_codes_match_ordered_mask():
+    events = {}
+    for h, rack in enumerate(['r2', '', 'r1', 'r3', '', 'r1']):
+        events[(EPOCH + datetime.timedelta(days=h), 'host{}'.format(h), 'CREATE')] = {'rack': rack, 'vcpu': 48}
+    events[(EPOCH, 'host9', 'DELETE')] = {}
+
+    traces = machine_event_dump.mask_and_derive(MachineEventTable(events), _masker(), EPOCH, 'rack')
+
+    assert traces == _mask_and_derive_ordered(events, _masker(), EPOCH, 'rack')
+    assert [trace.get('rack') for trace in traces] == [2, '', 1, 3, '', 1, None]
+
+
+def test_rack_codebook_keeps_empty_rack_code(tmp_path):
+    path = str(tmp_path / 'racks.json')
+    trans.RackCodebook(['r1', '', None]).save(path)
+    codebook = trans.RackCodebook.load(path)
+
+    assert codebook.racks == ['', 'r1']
+    assert codebook.add(['r0', None, '']) == ['r0']
+    assert codebook.encode('r1') == 1 and codebook.encode('r0') == 2
+
+
+def _interleaved_machine_events(seed, n_events=400, n_hosts=12):
+    """Random events of all hosts over the same few days, so that the rows of
+    every shard interleave with those of the others, many at equal times."""
+    rng = random.Random(seed)
+    property_sets = [{}, {'rack': 'r1', 'vcpu': 48}, {'vcpu': 48, 'rack': 'r1'}, {'rack': '', 'vcpu': 40},
+                     {'rack': 'r2', 'vcpu': 40}, {'rack': None}, {'vcpu': None}]
+    events = {}
+    for _ in range(n_events):
+        key = (EPOCH + datetime.timedelta(days=rng.randrange(20)), 'host{}'.format(rng.randrange(n_hosts)),
+               rng.choice(EVENTS))
+        events[key] = dict(rng.choice(property_sets))
+    created_hosts = {'host{}'.format(h) for h in range(n_hosts) if rng.random() < 0.3}
+    return events, created_hosts
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('shards, workers', [(1, 1), (2, 1), (3, 2), (5, 3), (16, 4)])
+def test_sharded_refine_mask_and_derive_matches_unsharded(seed, shards, workers):
+    events, created_hosts = _interleaved_machine_events(seed)
+    table = MachineEventTable(events)
+    refined = machine_event_dump.refine_machine_events(table, created_hosts)
+    expected = machine_event_dump.mask_and_derive(refined, _masker(), EPOCH, 'rack')
+
+    traces = machine_event_dump.sharded_refine_mask_and_derive(
+        MachineEventTable(events), shards, workers, _masker(), EPOCH, 'rack', created_hosts=created_hosts)
+
+    assert shards == 1 or len(machine_event_dump.shard_machine_events(table, shards)) > 1
+    assert traces == expected
+
+
+def test_sharded_refine_mask_and_derive_with_codebook_file(tmp_path):
+    path = str(tmp_path / 'racks.json')
+    trans.RackCodebook(['r0', 'r2']).save(path)
+    events, created_hosts = _interleaved_machine_events(0)
+    refined = machine_event_dump.refine_machine_events(MachineEventTable(events), created_hosts)
+    codebook = trans.RackCodebook(['r0', 'r2'])
+    codebook.add(['r1', '', None])
+    expected = machine_event_dump.mask_and_derive(refined, _masker(), EPOCH, 'rack', codebook=codebook)
+
+    traces = machine_event_dump.sharded_refine_mask_and_derive(
+        MachineEventTable(events), 3, 2, _masker(), EPOCH, 'rack', rack_codebook_file=path,
+        created_hosts=created_hosts)
+
+    assert traces == expected
+    assert trans.RackCodebook.load(path).racks == ['r0', 'r2', '', 'r1']
@@ -0,0 +1,142 @@
+# coding: utf-8
+import datetime
+import random
+
+import pytest
+
+from starcompactor import machine_event_dump
+from starcompactor.extractors.event_table import EVENTS, MachineEventTable
+
+from conftest import EPOCH
+
+PROPERTY_SETS = [{}, {'rack': 'r1', 'vcpu': 48}, {'vcpu': 48, 'rack': 'r1'}, {'rack': 'r1', 'vcpu': 40},
+                 {'rack': 'r2', 'vcpu': 40}, {'rack': 'r2', 'vcpu': None}]
+
+
+def _random_machine_events(rng, n_events, n_hosts):
+    """Random machine events over few days, so that hosts often have several
+    events at one time; equal property dicts come in different key order."""
+    events = {}
+    for _ in range(n_events):
+        key = (EPOCH + datetime.timedelta(days=rng.randrange(n_events // n_hosts + 1)),
+               'host{}'.format(rng.randrange(n_hosts)), rng.choice(EVENTS))
+        events[key] = dict(rng.choice(PROPERTY_SETS))
+    return events
+
+
+def _refined(events, created_hosts=()):
+    return list(machine_event_dump.refine_machine_events(MachineEventTable(events), created_hosts).items())
+
+
+def _refined_sequential(events, created_hosts=()):
+    return list(machine_event_dump.refine_machine_events_sequential(dict(events), created_hosts).items())
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_refine_matches_sequential(seed):
+    rng = random.Random(seed)
+    n_hosts = rng.randrange(1, 8)
+    events = _random_machine_events(rng, rng.randrange(1, 300), n_hosts)
+    created_hosts = {'host{}'.format(h) for h in range(n_hosts) if rng.random() < 0.3}
+
+    assert _refined(events) == _refined_sequential(events)
+    assert _refined(events, created_hosts) == _refined_sequential(events, created_hosts)
+
+
+def test_refine_empty():
+    assert _refined({}) == _refined_sequential({}) == []
+
+
+def test_refine_delete_without_create():
+    t = EPOCH + datetime.timedelta(days=1)
+    events = {
+        (EPOCH, 'h1', 'DELETE'): {},
+        (t, 'h1', 'UPDATE'): {'vcpu': 48},
+        (EPOCH, 'h2', 'CREATE'): {'vcpu': 48},
+        (t, 'h2', 'DELETE'): {},
+        (t + datetime.timedelta(days=1), 'h2', 'DELETE'): {},
+    }
+
+    assert _refined(events) == _refined_sequential(events) == [
+        ((EPOCH, 'h2', 'CREATE'), {'vcpu': 48}),
+        ((t, 'h2', 'DELETE'), {}),
+    ]
+
+
+def test_refine_repeated_timestamps():
+    events = {(EPOCH, host, event): {'vcpu': 48} for host in ('h2', 'h1') for event in reversed(EVENTS)}
+    events[(EPOCH, 'h1', 'UPDATE')] = {'vcpu': 40}
+
+    refined = _refined(events)
+    assert refined == _refined_sequential(events)
+    # in insertion order; h2's UPDATE repeats the properties of its ENABLE
+    assert [key for key, _ in refined] == [
+        (EPOCH, 'h2', 'ENABLE'), (EPOCH, 'h2', 'DELETE'), (EPOCH, 'h2', 'CREATE'),
+        (EPOCH, 'h1', 'UPDATE'), (EPOCH, 'h1', 'ENABLE'), (EPOCH, 'h1', 'DELETE'), (EPOCH, 'h1', 'CREATE'),
+    ]
+
+
+def test_boundary_delete_survives_refinement():
+    # the backup before the window had h1, h2 and the deleted h3; h1 and h3
+    # are gone from the first backup in the window, and so are their events
+    backups = [EPOCH + datetime.timedelta(days=d) for d in range(3)]
+    created = EPOCH - datetime.timedelta(days=30)
+    reducer = machine_event_dump.BackupResultReducer(len(backups), previous_hosts={'h1', 'h2', 'h3'},
+                                                     previous_created_hosts={'h1', 'h2'})
+    for index, file_time in enumerate(backups):
+        reducer.add(index, {'file_time': file_time, 'hosts': {'h2'},
+                            'machine_events': {(created, 'h2', 'CREATE'): {'vcpu': 48},
+                                               (file_time, 'h2', 'UPDATE'): {'vcpu': 40 + index}}})
+    machine_events = reducer.result()
+    created_hosts = reducer.created_hosts()
+
+    assert created_hosts == {'h1'}
+    refined = _refined(machine_events, created_hosts)
+    assert refined == _refined_sequential(machine_events, created_hosts)
+    assert ((backups[0], 'h1', 'DELETE'), {}) in refined
+    assert ((backups[0], 'h3', 'DELETE'), {}) not in refined
+    assert ((created, 'h2', 'CREATE'), {'vcpu': 48}) in refined
+    assert ((backups[0], 'h1', 'DELETE'), {}) not in _refined(machine_events)
+
+
+def _random_backup_results(rng, n_backups, n_hosts):
+    """Results of consecutive backups: hosts come and go, CREATE events
+    repeat across backups with properties that change, events come in
+    random order and some backups are missing."""
+    results = []
+    for b in range(n_backups):
+        file_time = EPOCH + datetime.timedelta(days=b)
+        hosts = {'host{}'.format(h) for h in range(n_hosts) if rng.random() < 0.7}
+        events = {}
+        for host in hosts:
+            created = EPOCH - datetime.timedelta(days=int(host[4:]))
+            events[(created, host, 'CREATE')] = dict(rng.choice(PROPERTY_SETS))
+            events[(file_time - datetime.timedelta(hours=rng.randrange(48)), host, rng.choice(EVENTS))] = \
+                dict(rng.choice(PROPERTY_SETS))
+        items = list(events.items())
+        rng.shuffle(items)
+        results.append(None if rng.random() < 0.1 else {'file_time': file_time, 'hosts': hosts,
+                                                         'machine_events': dict(items)})
+    return results
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_reducer_matches_merge_in_any_order(seed):
+    rng = random.Random(seed)
+    n_hosts = rng.randrange(1, 8)
+    results = _random_backup_results(rng, rng.randrange(1, 12), n_hosts)
+    previous_hosts = {'host{}'.format(h) for h in range(n_hosts + 2) if rng.random() < 0.5} or None
+    previous_created_hosts = {host for host in previous_hosts or () if rng.random() < 0.7} or None
+
+    reducer = machine_event_dump.BackupResultReducer(len(results), previous_hosts, previous_created_hosts)
+    arrival = list(range(len(results)))
+    rng.shuffle(arrival)
+    for index in arrival:
+        reducer.add(index, results[index])
+    expected = machine_event_dump.merge_backup_results(results, previous_hosts)
+
+    assert list(reducer.result().items()) == list(expected.items())
+    first = next((result['hosts'] for result in results if result), None)
+    expected_created_hosts = (previous_created_hosts or set()).difference(first) if first is not None else set()
+    assert reducer.created_hosts() == expected_created_hosts
+    assert _refined(reducer.result(), reducer.created_hosts()) == _refined(expected, expected_created_hosts)
@@ -0,0 +1,124 @@
+# coding: utf-8
+"""The values expected here are those MySQLdb returns for the same rows
+once the dump is loaded into MySQL, as the mysql backend reads them."""
+import datetime
+import decimal
+import os
+
+import pytest
+
+from starcompactor.extractors import machine, sqldump
+
+BACKUP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'mysql_backup_20170101-000000.sql')
+
+
+def _parse(values, *column_types):
+    return sqldump.parse_values(values, [sqldump._converter(column_type) for column_type in column_types])
+
+
+@pytest.mark.parametrize('literal, value', [
+    (r"'it\'s'", "it's"),
+    (r"'a\\b'", 'a\\b'),
+    (r"'\\'", '\\'),
+    (r"'\\\''", "\\'"),
+    (r"'say \"hi\"'", 'say "hi"'),
+    (r"'(a,b),(c)'", '(a,b),(c)'),
+    (r"'x\ny\tz\r\0\Z'", 'x\ny\tz\r\0\x1a'),
+    (r"'\%\_\q'", '\\%\\_q'),
+    ("''", ''),
+    ("'naïve'", 'naïve'),
+])
+def test_string_escapes(literal, value):
+    assert _parse('({});'.format(literal), 'varchar') == [[value]]
+
+
+def test_binary_and_hex_literals():
+    assert _parse(r"(_binary 'a\'b\\c\0',0x00FF10,_binary '',0x,0xab);",
+                  'varbinary', 'blob', 'blob', 'blob', 'varbinary') == [
+        [b"a'b\\c\x00", b'\x00\xff\x10', b'', b'', b'\xab']]
+
+
+def test_null_and_zero_dates():
+    assert _parse("(NULL,NULL,NULL,NULL,'0000-00-00 00:00:00','0000-00-00','0000-00-00 00:00:00');",
+                  'datetime', 'int', 'varchar', 'decimal', 'datetime', 'date', 'timestamp') == [
+        [None, None, None, None, None, None, None]]
+
+
+def test_numbers_and_times():
+    assert _parse("(1,-2,1.50,16,2.5e3,'2016-01-02 03:04:05.250000','2016-01-02',12);",
+                  'int', 'bigint', 'decimal', 'float', 'double', 'datetime', 'date', 'tinyint') == [
+        [1, -2, decimal.Decimal('1.50'), 16.0, 2500.0,
+         datetime.datetime(2016, 1, 2, 3, 4, 5, 250000), datetime.date(2016, 1, 2), 12]]
+
+
+def test_multi_row_insert():
+    assert _parse("(1,'a'),(2,'b,c'), (3,NULL);", 'int', 'varchar') == [[1, 'a'], [2, 'b,c'], [3, None]]
+
+
+@pytest.mark.parametrize('values', ["(1,'a'", "(1,'a')x", "1,'a');", "(1 2);"])
+def test_malformed_values(values):
+    with pytest.raises(ValueError):
+        _parse(values, 'int', 'varchar')
+
+
+def test_read_tables():
+    columns = {}
+    with open(BACKUP, 'rb') as f:
+        tables = sqldump.read_tables(f, [('nova', 'compute_nodes'), ('nova', 'services'), ('ironic', 'nodes'),
+                                         ('blazar', 'computehosts')], columns)
+
+    assert sorted(tables) == [('blazar', 'computehosts'), ('ironic', 'nodes'), ('nova', 'compute_nodes'),
+                              ('nova', 'services')]
+    assert tables[('blazar', 'computehosts')] == [
+        {'created_at': datetime.datetime(2016, 1, 2, 3, 4, 5), 'updated_at': None, 'id': '1',
+         'hypervisor_hostname': 'node-1'},
+        {'created_at': datetime.datetime(2016, 1, 3), 'updated_at': None, 'id': '2', 'hypervisor_hostname': 'node-2'}]
+    assert columns[('ironic', 'nodes')] == [
+        ('created_at', 'datetime'), ('updated_at', 'datetime'), ('id', 'int'), ('uuid', 'varchar'),
+        ('maintenance', 'tinyint'), ('provisioned_on', 'date'), ('fingerprint', 'varbinary'), ('image', 'blob')]
+    compute_nodes = tables[('nova', 'compute_nodes')]
+    assert compute_nodes[0] == {
+        'created_at': datetime.datetime(2016, 1, 2, 3, 4, 5), 'updated_at': datetime.datetime(2017, 1, 1),
+        'deleted_at': None, 'id': 1, 'vcpus': 48, 'memory_mb': 128000, 'local_gb': 200,
+        'cpu_info': '{"vendor": "Intel", "model": "it\'s \\\\ (x86), y"}',
+        'hypervisor_hostname': 'c01-01.chameleon.tacc.utexas.edu', 'cpu_allocation_ratio': 16.0,
+        'disk_available_least': decimal.Decimal('1.50'), 'host': 'c01-01', 'deleted': 0}
+    assert compute_nodes[1]['updated_at'] is None  # zero date
+    assert compute_nodes[1]['cpu_info'] == 'line one\nline two\ttab\r\0end'
+    assert compute_nodes[1]['disk_available_least'] == decimal.Decimal('-3.25')
+    assert compute_nodes[2]['created_at'] == datetime.datetime(2016, 1, 4, 0, 0, 0, 250000)
+    assert [row['id'] for row in compute_nodes] == [1, 2, 3]
+
+    # column-list INSERT
+    services = tables[('nova', 'services')]
+    assert [(row['host'], row['binary'], row['disabled'], row['disabled_reason'], row['last_seen_up'])
+            for row in services] == [
+        ('c01-01', 'nova-compute', 0, None, datetime.datetime(2017, 1, 1)),
+        ('c01-02', 'nova-compute', 1, 'it\'s "broken", (really)', None),
+        ('ctl', 'nova-scheduler', 0, '', None)]
+
+    assert tables[('ironic', 'nodes')] == [
+        {'created_at': datetime.datetime(2016, 1, 2, 3, 4, 5), 'updated_at': datetime.datetime(2016, 2, 1), 'id': 1,
+         'uuid': 'node-1', 'maintenance': 0, 'provisioned_on': datetime.date(2016, 1, 2),
+         'fingerprint': b"a'b\\c\x00", 'image': b'\x00\xff\x10'},
+        {'created_at': datetime.datetime(2016, 1, 3), 'updated_at': datetime.datetime(2016, 2, 2), 'id': 2,
+         'uuid': 'node-2', 'maintenance': 1, 'provisioned_on': None, 'fingerprint': b'', 'image': b''}]
+
+
+def test_read_tables_column_list_before_create_table():
+    lines = [b'USE `nova`;\n', b"INSERT INTO `services` (`id`, `host`) VALUES (1,'h1'),(2,NULL);\n"]
+    assert sqldump.read_tables(lines, [('nova', 'services')]) == {
+        ('nova', 'services'): [{'id': 1, 'host': 'h1'}, {'id': 2, 'host': None}]}
+
+
+@pytest.mark.parametrize('instance_type', ['vm', 'baremetal'])
+def test_split_tables_matches_sed(instance_type):
+    tables = machine.backup_tables(instance_type) + [('nova', 'instances'), ('nova', 'missing')]
+    python = machine.read_sections(BACKUP, tables, 'tmp_backup.sql', 'python')
+    sed = machine.read_sections(BACKUP, tables, 'tmp_backup.sql', 'sed')
+
+    assert len(python) >= 3
+    assert sorted(python) == sorted(sed)
+    for key in python:
+        assert python[key] == sed[key], key
+        assert python[key].startswith(b'DROP TABLE') and python[key].endswith(b'UNLOCK TABLES;\n')
@@ -0,0 +1,34 @@
+# coding: utf-8
+import os
+
+import pytest
+
+from starcompactor.util import atomic_write
+
+
+def test_atomic_write(tmp_path):
+    path = str(tmp_path / 'state.json')
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write('new')
+    atomic_write(path, write)
+
+    with open(path) as f:
+        assert f.read() == 'new'
+    assert os.listdir(str(tmp_path)) == ['state.json']
+
+
+def test_failed_atomic_write_leaves_file_unchanged(tmp_path):
+    path = tmp_path / 'state.json'
+    path.write_text('old')
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write('partial')
+        raise IOError('disk full')
+    with pytest.raises(IOError):
+        atomic_write(str(path), write)
+
+    assert path.read_text() == 'old'
+    assert os.listdir(str(tmp_path)) == ['state.json']